@@ -0,0 +1,107 @@
+"""
+Views served in the event loop of ASGI server, the other views run in threads of Django
+The bodies never block, creating tunnels and writing journal are done in executor.
+"""
+from asgiref.sync import sync_to_async
+from django.http import HttpRequest
+
+from util import response_json, check_authorization
+from util.metrics import instrument
+from . import views
+
+
+def _csrf_exempt(view):
+    # csrf_exempt of Django 3.2 wraps coroutine function into a sync one
+    view.csrf_exempt = True
+    return view
+
+
+@instrument("list")
+@check_authorization
+@response_json
+async def get_proxy_list(request: HttpRequest):
+    """
+    Same as views.get_proxy_list
+    :param request:
+    :return:
+    """
+    return views._proxy_list(request)
+
+
+@instrument("find")
+@check_authorization
+@response_json
+async def find_tunnels(request: HttpRequest):
+    """
+    Same as views.find_tunnels
+    :param request:
+    :return:
+    """
+    return views._find(request)
+
+
+@check_authorization
+@response_json
+async def get_events(request: HttpRequest):
+    """
+    Changes of tunnels after version `since`, long-polled
+    Streaming responses are iterated in the event loop by Django 3.2, the blocking event stream is not served here.
+    :param request:
+    :return:
+    """
+    since = views._since(request)
+    event_list, reset = await views.tunnels.events.wait_async(since, views._poll_timeout(request))
+    return views._poll_result(since, event_list, reset)
+
+
+@_csrf_exempt
+@instrument("create")
+@check_authorization
+@response_json
+async def create_tunnel(request: HttpRequest):
+    """
+    Same as views.create_tunnel, starting processes and waiting for ports are done in executor
+    :param request:
+    :return:
+    """
+    return await sync_to_async(views._create, thread_sensitive=False)(request.POST)
+
+
+@_csrf_exempt
+@instrument("remove")
+@check_authorization
+@response_json
+async def remove_tunnel(request: HttpRequest):
+    """
+    :param request:
+    :return:
+    """
+    tid = int(request.POST["id"])
+    if views.journal is not None:
+        # Journal is written in place
+        return await sync_to_async(views._remove, thread_sensitive=False)(tid)
+    return views._remove(tid)
+
+
+@_csrf_exempt
+@instrument("heartbeat")
+@check_authorization
+@response_json
+async def tunnel_heartbeat(request: HttpRequest):
+    """
+    :param request:
+    :return:
+    """
+    return views._heartbeat(int(request.POST["id"]))
+
+
+@_csrf_exempt
+@instrument("query")
+@check_authorization
+@response_json
+async def query_tunnel(request: HttpRequest):
+    """
+    :param request:
+    :return:
+    """
+    return views._query(int(request.GET["id"]))
@@ -1,3 +1,1143 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.test import RequestFactory, SimpleTestCase
+
+from util import events
+from util.events import EventLog
+from util.expiry import ExpiryScheduler
+from util import goproxy
+from util.backend import process_group_options
+from util.goproxy import ExposeConfig, MultiTunnel, TunnelsCheckThread, apply_ports
+from util.http_response import _request_key
+from util.index import comment_tags
+from util.journal import SqliteJournal, TunnelJournal, adopt_process
+from util.lazy import LazyActivator
+from util.lease import LeaseRegistry
+from util.permanent import PermanentReconciler
+from util.ports import PortAllocator, parse_port_range
+from util.ratelimit import TokenBucketLimiter
+from util.registry import TunnelRegistry
+from util.reaper import ProcessReaper, ShutdownCoordinator
+from util.relay import RelayBackend, RelayEngine
+from util import supervisor
+from util.supervisor import ProcessSupervisor
+from util.traffic import TrafficSampler
+
+
+class ExpirySchedulerTest(SimpleTestCase):
+    def test_pop_due_in_deadline_order(self):
+        scheduler = ExpiryScheduler()
+        scheduler.push("b", 20)
+        scheduler.push("a", 10)
+        scheduler.push("c", 30)
+        self.assertEqual(scheduler.next_deadline(), 10)
+        self.assertEqual(scheduler.pop_due(25), [(10, "a"), (20, "b")])
+        self.assertEqual(len(scheduler), 1)
+        self.assertEqual(scheduler.pop_due(25), [])
+        self.assertEqual(scheduler.next_deadline(), 30)
+
+    def test_same_deadline_keeps_push_order(self):
+        scheduler = ExpiryScheduler()
+        for key in range(5):
+            scheduler.push(key, 10)
+        self.assertEqual([key for _, key in scheduler.pop_due(10)], list(range(5)))
+
+    def test_empty(self):
+        scheduler = ExpiryScheduler()
+        self.assertIsNone(scheduler.next_deadline())
+        self.assertEqual(scheduler.pop_due(), [])
+
+    def test_wait_returns_at_due_deadline(self):
+        scheduler = ExpiryScheduler()
+        scheduler.push("a", time.time() - 1)
+        start = time.time()
+        scheduler.wait(5)
+        self.assertLess(time.time() - start, 1)
+
+    def test_earlier_push_wakes_waiter(self):
+        scheduler = ExpiryScheduler()
+        scheduler.push("late", time.time() + 60)
+        timer = threading.Timer(0.1, scheduler.push, ("early", time.time()))
+        timer.start()
+        start = time.time()
+        scheduler.wait(5)
+        timer.join()
+        self.assertLess(time.time() - start, 2)
+
+
+class PortAllocatorTest(SimpleTestCase):
+    def setUp(self):
+        self.allocator = PortAllocator((21000, 21002), (26000, 26002))
+
+    def test_allocate_in_range(self):
+        bridge = self.allocator.allocate(PortAllocator.BRIDGE)
+        expose = self.allocator.allocate(PortAllocator.EXPOSE)
+        self.assertTrue(21000 <= bridge <= 21002)
+        self.assertTrue(26000 <= expose <= 26002)
+        self.assertTrue(self.allocator.is_taken(bridge))
+        self.assertEqual(self.allocator.json["taken"], 2)
+        self.assertEqual(self.allocator.json["reserved"], 2)
+
+    def test_exhausted(self):
+        ports = {self.allocator.allocate(PortAllocator.BRIDGE) for _ in range(3)}
+        self.assertEqual(len(ports), 3)
+        with self.assertRaises(RuntimeError):
+            self.allocator.allocate(PortAllocator.BRIDGE)
+
+    def test_claim_taken_port(self):
+        self.allocator.claim(30000)
+        with self.assertRaises(ValueError):
+            self.allocator.claim(30000)
+
+    def test_pinned_port_skipped_by_allocation(self):
+        self.allocator.claim(21000)
+        ports = {self.allocator.allocate(PortAllocator.BRIDGE) for _ in range(2)}
+        self.assertNotIn(21000, ports)
+
+    def test_reserve_all_or_nothing(self):
+        self.allocator.claim(26001)
+        with self.assertRaises(ValueError):
+            self.allocator.reserve([PortAllocator.BRIDGE, 26000, 26001])
+        self.assertFalse(self.allocator.is_taken(26000))
+        self.assertEqual(self.allocator.json["taken"], 1)
+
+    def test_reserve_many(self):
+        results = self.allocator.reserve_many([
+            [PortAllocator.BRIDGE, 26000],
+            [PortAllocator.BRIDGE, 26000],
+            [26001, PortAllocator.EXPOSE],
+        ])
+        self.assertEqual(results[0][1], 26000)
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2][0], 26001)
+        # Ports of the failed item are released
+        self.assertEqual(self.allocator.json["taken"], 4)
+
+    def test_occupied_port_skipped(self):
+        occupied = []
+        try:
+            for port in (21000, 21001):
+                sock = socket.socket()
+                sock.bind(('', port))
+                occupied.append(sock)
+            self.assertEqual(self.allocator.allocate(PortAllocator.BRIDGE), 21002)
+            with self.assertRaises(RuntimeError):
+                self.allocator.allocate(PortAllocator.BRIDGE)
+            self.assertEqual(self.allocator.json["taken"], 1)
+        finally:
+            for sock in occupied:
+                sock.close()
+
+    def test_release_and_confirm(self):
+        port = self.allocator.allocate(PortAllocator.EXPOSE)
+        self.allocator.confirm(port)
+        self.assertEqual(self.allocator.json["reserved"], 0)
+        self.allocator.release(port)
+        self.assertFalse(self.allocator.is_taken(port))
+        self.assertEqual(self.allocator.json["taken"], 0)
+        # Released ports go back to pool
+        ports = {self.allocator.allocate(PortAllocator.EXPOSE) for _ in range(3)}
+        self.assertIn(port, ports)
+
+    def test_parse_port_range(self):
+        self.assertEqual(parse_port_range("20000-24999"), (20000, 24999))
+        for text in ("0-10", "20-10", "1-70000"):
+            with self.assertRaises(ValueError):
+                parse_port_range(text)
+
+
+class EventLogTest(SimpleTestCase):
+    def test_since(self):
+        log = EventLog()
+        log.append(events.CREATE, 1)
+        log.append(events.REMOVE, 1)
+        event_list, reset = log.since(0)
+        self.assertFalse(reset)
+        self.assertEqual([(e["version"], e["type"]) for e in event_list], [(1, events.CREATE), (2, events.REMOVE)])
+        self.assertEqual(log.since(1)[0][0]["version"], 2)
+        self.assertEqual(log.since(2), ([], False))
+
+    def test_dropped_events_reset(self):
+        log = EventLog(capacity=2)
+        for tid in range(3):
+            log.append(events.CREATE, tid)
+        self.assertEqual(log.since(0), ([], True))
+        self.assertEqual(len(log.since(1)[0]), 2)
+        # Version from the future
+        self.assertEqual(log.since(10), ([], True))
+
+    def test_cursor(self):
+        log = EventLog()
+        log.append(events.CREATE, 1)
+        self.assertEqual(log.version_of(log.cursor(1)), 1)
+        self.assertEqual(log.version_of(log.cursor(0)), 0)
+
+    def test_cursor_of_another_run_resets(self):
+        old = EventLog()
+        old.epoch -= 1000
+        log = EventLog()
+        for tid in range(3):
+            log.append(events.CREATE, tid)
+        # Lower than the current version, but from another run
+        version = log.version_of(old.cursor(1))
+        self.assertIsNone(version)
+        self.assertEqual(log.since(version), ([], True))
+        for cursor in ("1", "", "abc", "{}-x".format(log.epoch)):
+            self.assertIsNone(log.version_of(cursor))
+
+    def test_wait(self):
+        log = EventLog()
+        threading.Timer(0.1, log.append, (events.CREATE, 1)).start()
+        event_list, reset = log.wait(0, 5)
+        self.assertFalse(reset)
+        self.assertEqual(len(event_list), 1)
+        start = time.time()
+        self.assertEqual(log.wait(None, 5), ([], True))
+        self.assertLess(time.time() - start, 1)
+
+
+class TokenBucketLimiterTest(SimpleTestCase):
+    def test_burst_then_throttled(self):
+        limiter = TokenBucketLimiter(rate=1, burst=3)
+        for _ in range(3):
+            self.assertEqual(limiter.retry_after("a"), 0)
+            limiter.consume("a")
+        retry = limiter.retry_after("a")
+        self.assertTrue(0 < retry <= 1)
+        self.assertEqual(limiter.json["limited"], 1)
+        # Other keys are not affected
+        self.assertEqual(limiter.retry_after("b"), 0)
+
+    def test_refill(self):
+        limiter = TokenBucketLimiter(rate=20, burst=1)
+        limiter.consume("a")
+        self.assertGreater(limiter.retry_after("a"), 0)
+        time.sleep(0.1)
+        self.assertEqual(limiter.retry_after("a"), 0)
+        # Full buckets are dropped
+        self.assertEqual(len(limiter), 0)
+
+    def test_capacity(self):
+        limiter = TokenBucketLimiter(rate=1, burst=1, capacity=2)
+        for key in ("a", "b", "c"):
+            limiter.consume(key)
+        self.assertEqual(len(limiter), 2)
+        self.assertEqual(limiter.json["evicted"], 1)
+        # The least recently consumed one is evicted
+        self.assertEqual(limiter.retry_after("a"), 0)
+        self.assertGreater(limiter.retry_after("c"), 0)
+
+    def test_invalid_rate(self):
+        with self.assertRaises(ValueError):
+            TokenBucketLimiter(rate=0, burst=1)
+
+
+class TunnelIndexTest(SimpleTestCase):
+    def setUp(self):
+        self.tunnels = TunnelRegistry()
+        # Not started, ports are given
+        self.web = MultiTunnel([ExposeConfig(80, 25080)], bridge_port=20080, comment="web #home #http", expired=600)
+        self.ssh = MultiTunnel([ExposeConfig(22, 25022)], bridge_port=20022, comment="ssh #home", expired=5)
+        self.jupyter = MultiTunnel([ExposeConfig(8888, 25888)], bridge_port=20888, comment="jupyter", expired=-1)
+        for tid, tunnel in ((1, self.web), (2, self.ssh), (3, self.jupyter)):
+            self.tunnels.add(tid, tunnel)
+
+    def find(self, **conditions):
+        found, more = self.tunnels.find(**conditions)
+        return [tid for tid, _ in found], more
+
+    def test_comment_tags(self):
+        self.assertEqual(comment_tags("web #home #http-1 #a.b"), {"home", "http-1", "a.b"})
+        self.assertEqual(comment_tags(None), set())
+
+    def test_find_by_ports(self):
+        self.assertEqual(self.find(expose_port=25022), ([2], False))
+        self.assertEqual(self.find(bridge_port=20888), ([3], False))
+        self.assertEqual(self.find(innet_port=80), ([1], False))
+        self.assertEqual(self.find(expose_port=1), ([], False))
+
+    def test_find_by_comment(self):
+        self.assertEqual(self.find(tag="home"), ([1, 2], False))
+        self.assertEqual(self.find(tag="home", innet_port=22), ([2], False))
+        self.assertEqual(self.find(comment_prefix="j"), ([3], False))
+        self.assertEqual(self.find(comment_prefix="x"), ([], False))
+
+    def test_pagination(self):
+        self.assertEqual(self.find(limit=2), ([1, 2], True))
+        self.assertEqual(self.find(limit=2, after_id=2), ([3], False))
+        self.assertEqual(self.find(tag="home", limit=1, after_id=1), ([2], False))
+
+    def test_expiring_within(self):
+        self.assertEqual(self.find(expiring_within=60), ([2], False))
+        # Heartbeat moves the deadline forward without updating the index
+        self.ssh.last_check_time += 1000
+        self.assertEqual(self.find(expiring_within=60), ([], False))
+        self.assertEqual(self.find(expiring_within=2000), ([1, 2], False))
+
+    def test_port_owner(self):
+        self.assertEqual(self.tunnels.index.port_owner(25080), 1)
+        self.assertEqual(self.tunnels.index.port_owner(20022), 2)
+        self.assertIsNone(self.tunnels.index.port_owner(30000))
+
+    def test_shared_bridge_port_not_owned(self):
+        shared = MultiTunnel([ExposeConfig(22, 25023)], bridge_port=20500)
+        shared.shared_bridge = object()
+        self.tunnels.add(4, shared)
+        self.assertIsNone(self.tunnels.index.port_owner(20500))
+        self.assertEqual(self.find(bridge_port=20500), ([4], False))
+
+    def test_removed(self):
+        self.tunnels.pop(2)
+        self.tunnels.pop_many([3])
+        self.assertEqual(len(self.tunnels.index), 1)
+        self.assertEqual(self.find(tag="home"), ([1], False))
+        self.assertIsNone(self.tunnels.index.port_owner(25022))
+        self.assertEqual(self.find(expiring_within=60), ([], False))
+
+
+class TunnelRegistryTest(SimpleTestCase):
+    def setUp(self):
+        self.tunnels = TunnelRegistry(shard_count=4, heartbeat_event_interval=60)
+
+    @staticmethod
+    def tunnel(tid: int) -> MultiTunnel:
+        # Not started, ports are given
+        return MultiTunnel([ExposeConfig(22, 30000 + tid)], bridge_port=40000 + tid, expired=60)
+
+    def event_counts(self) -> Counter:
+        event_list, _ = self.tunnels.events.since(0)
+        return Counter(event["type"] for event in event_list)
+
+    def test_concurrent_add_remove_heartbeat(self):
+        def work(worker: int):
+            tids = range(worker * 100, worker * 100 + 100)
+            for tid in tids:
+                self.tunnels.add(tid, self.tunnel(tid))
+            for tid in tids:
+                self.assertTrue(self.tunnels.heartbeat(tid))
+            for tid in tids[::2]:
+                self.assertIsNotNone(self.tunnels.pop(tid))
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.tunnels), 400)
+        self.assertEqual(list(self.tunnels), sorted(tid for tid in range(800) if tid % 2 == 1))
+        self.assertEqual(self.event_counts(), Counter({events.CREATE: 800, events.HEARTBEAT: 800, events.REMOVE: 400}))
+        self.assertEqual(self.tunnels.version, 2000)
+        # Indexes follow the changes
+        self.assertEqual(self.tunnels.index.port_owner(30001), 1)
+        self.assertIsNone(self.tunnels.index.port_owner(30002))
+
+    def test_heartbeat_event_throttled(self):
+        self.tunnels.add(1, self.tunnel(1))
+        self.assertTrue(self.tunnels.heartbeat(1))
+        self.assertTrue(self.tunnels.heartbeat(1))
+        self.assertFalse(self.tunnels.heartbeat(2))
+        self.assertEqual(self.event_counts()[events.HEARTBEAT], 1)
+
+    def test_batch(self):
+        self.tunnels.add_many([(tid, self.tunnel(tid)) for tid in range(10)])
+        self.assertEqual(len(self.tunnels), 10)
+        removed = self.tunnels.pop_many([1, 2, 2, 42], events.EXPIRE)
+        self.assertEqual(sorted(removed), [1, 2])
+        self.assertNotIn(1, self.tunnels)
+        self.assertEqual(self.event_counts(), Counter({events.CREATE: 10, events.EXPIRE: 2}))
+
+    def test_pop_with_predicate(self):
+        tunnel = self.tunnel(1)
+        self.tunnels.add(1, tunnel)
+        self.assertIsNone(self.tunnels.pop(1, lambda t: t.stopped))
+        self.assertIs(self.tunnels.pop(1, lambda t: not t.stopped), tunnel)
+        self.assertIsNone(self.tunnels.pop(1))
+
+
+class LeaseExpiryTest(SimpleTestCase):
+    def setUp(self):
+        self.tunnels = TunnelRegistry()
+        self.leases = LeaseRegistry()
+        self.checker = TunnelsCheckThread(self.tunnels, leases=self.leases)
+
+    def add(self, tid: int, lease=None, expired: float = 60) -> MultiTunnel:
+        # Not started, ports are given
+        tunnel = MultiTunnel([ExposeConfig(22, 30000 + tid)], bridge_port=40000 + tid, expired=expired, lease=lease)
+        self.tunnels.add(tid, tunnel)
+        self.checker.watch(tid, tunnel)
+        return tunnel
+
+    def test_members_expire_with_lease(self):
+        lease = self.leases.create(0.1)
+        members = [self.add(1, lease), self.add(2, lease)]
+        self.add(3)
+        self.assertEqual(lease.members, {1, 2})
+        time.sleep(0.15)
+        self.checker.check_due()
+        self.assertEqual(list(self.tunnels), [3])
+        self.assertTrue(all(tunnel.stopped for tunnel in members))
+        self.assertTrue(lease.released)
+        self.assertIsNone(self.leases.get(lease.id))
+        event_list, _ = self.tunnels.events.since(0)
+        self.assertEqual(sorted(e["id"] for e in event_list if e["type"] == events.EXPIRE), [1, 2])
+
+    def test_renewed_lease_keeps_members(self):
+        lease = self.leases.create(0.3)
+        self.add(1, lease)
+        time.sleep(0.2)
+        lease.check()
+        time.sleep(0.15)
+        self.checker.check_due()
+        self.assertIn(1, self.tunnels)
+        self.assertTrue(lease.scheduled)
+        time.sleep(0.2)
+        self.checker.check_due()
+        self.assertNotIn(1, self.tunnels)
+
+    def test_member_ignores_own_expiry(self):
+        lease = self.leases.create(60)
+        self.add(1, lease, expired=0.01)
+        time.sleep(0.05)
+        self.checker.check_due()
+        self.assertIn(1, self.tunnels)
+        self.assertFalse(lease.released)
+
+
+class RequestKeyTest(SimpleTestCase):
+    def test_order(self):
+        factory = RequestFactory()
+        self.assertEqual(_request_key(factory.post("/api/create?key=query", {"key": "form"})), "form")
+        self.assertEqual(_request_key(factory.post("/api/create?key=query", {})), "query")
+        request = factory.post("/api/create?key=query", {"key": "form"}, HTTP_AUTHORIZATION="Bearer header")
+        self.assertEqual(_request_key(request), "header")
+        self.assertIsNone(_request_key(factory.get("/api/create")))
+
+
+class PermanentReconcilerTest(SimpleTestCase):
+    def setUp(self):
+        self.next_id = 0
+        self.running = dict()
+        self.waited = []
+        self.reconciler = PermanentReconciler(self.start, self.stop, lambda tid: tid in self.running)
+
+    def start(self, item: dict) -> int:
+        if item.get("fail"):
+            raise RuntimeError("Failed")
+        self.next_id += 1
+        self.running[self.next_id] = item
+        return self.next_id
+
+    def stop(self, tid: int, wait: bool):
+        self.running.pop(tid, None)
+        self.waited.append(wait)
+
+    def test_added_removed_changed(self):
+        result = self.reconciler.reconcile([{"name": "ssh", "port": 22}, {"port": 80}])
+        self.assertEqual(len(result["added"]), 2)
+        self.assertEqual(len(self.running), 2)
+        result = self.reconciler.reconcile([{"name": "ssh", "port": 2222}, {"port": 8080}])
+        self.assertEqual(result["changed"], ["ssh"])
+        # Entries without name are keyed by the whole entry
+        self.assertEqual(len(result["added"]), 1)
+        self.assertEqual(len(result["removed"]), 1)
+        self.assertEqual(sorted(item["port"] for item in self.running.values()), [2222, 8080])
+        result = self.reconciler.reconcile([{"port": 8080}])
+        self.assertEqual(result["removed"], ["ssh"])
+        self.assertEqual(result["unchanged"], 1)
+        self.assertEqual(len(self.running), 1)
+        # Only the changed one is waited for, it's started again at once
+        self.assertEqual(self.waited, [False, True, False])
+
+    def test_restart_missing(self):
+        self.reconciler.reconcile([{"name": "ssh", "port": 22}])
+        self.running.clear()
+        result = self.reconciler.reconcile([{"name": "ssh", "port": 22}])
+        self.assertEqual(result["restarted"], ["ssh"])
+        self.assertEqual(len(self.running), 1)
+
+    def test_duplicate_and_invalid_entries(self):
+        result = self.reconciler.reconcile([
+            {"name": "ssh", "port": 22},
+            {"name": "ssh", "port": 2222},
+            {"port": 80},
+            {"port": 80},
+            "web",
+        ])
+        self.assertEqual(set(result["failed"]), {"ssh", '{"port": 80}', "#4"})
+        # The rest are still reconciled, the former of duplicates wins
+        self.assertEqual(len(result["added"]), 2)
+        self.assertEqual(sorted(item["port"] for item in self.running.values()), [22, 80])
+
+    def test_failed_start_retried(self):
+        result = self.reconciler.reconcile([{"name": "ssh", "fail": True}, {"name": "web"}])
+        self.assertEqual(list(result["failed"]), ["ssh"])
+        self.assertEqual([entry["key"] for entry in self.reconciler.json], ["web"])
+        result = self.reconciler.reconcile([{"name": "ssh", "fail": True}, {"name": "web"}])
+        self.assertEqual(result["added"], ["ssh"])
+        self.assertEqual(result["unchanged"], 1)
+
+
+@skipUnless(goproxy.proxy_bin is not None and os.path.exists(goproxy.proxy_bin), "goproxy is not installed")
+class PermanentPinnedPortsTest(SimpleTestCase):
+    def setUp(self):
+        from api import views
+        self.views = views
+        self.reconciler = PermanentReconciler(
+            views._start_permanent, views._stop_permanent, lambda tid: views.tunnels.get(tid) is not None
+        )
+        bridge, expose = apply_ports(2)
+        self.entry = {"name": "pinned", "innet": 22, "expose": expose, "bridge": bridge, "expire": -1}
+
+    def tearDown(self):
+        tids = [entry["id"] for entry in self.reconciler.json]
+        self.reconciler.reconcile([])
+        for tid in tids:
+            self.views._reaper.wait("tunnel {}".format(tid), 10)
+
+    def assert_running(self, result: dict):
+        self.assertEqual(result["failed"], {})
+        tunnel = self.views.tunnels.get(self.reconciler.json[0]["id"])
+        self.assertTrue(tunnel.wait_ready(10))
+        self.assertEqual(tunnel.bridge_port, self.entry["bridge"])
+
+    def test_changed_entry_restarted_on_same_ports(self):
+        self.assert_running(self.reconciler.reconcile([self.entry]))
+        result = self.reconciler.reconcile([dict(self.entry, comment="edited")])
+        self.assertEqual(result["changed"], ["pinned"])
+        self.assert_running(result)
+
+    def test_removed_tunnel_restarted_on_same_ports(self):
+        self.reconciler.reconcile([self.entry])
+        tid = self.reconciler.json[0]["id"]
+        # Like /api/remove, stopped by reaper in background
+        self.views.tunnels.pop(tid).stop(self.views._reaper, "tunnel {}".format(tid))
+        result = self.reconciler.reconcile([self.entry])
+        self.assertEqual(result["restarted"], ["pinned"])
+        self.assert_running(result)
+
+
+@skipUnless(goproxy.proxy_bin is not None and os.path.exists(goproxy.proxy_bin), "goproxy is not installed")
+class BatchCreateTest(SimpleTestCase):
+    def setUp(self):
+        from api import views
+        self.views = views
+        self.created = []
+
+    def tearDown(self):
+        for tid in self.created:
+            self.views.tunnels.pop(tid).stop(name="tunnel {}".format(tid))
+
+    def create(self, configs: list) -> list:
+        response = self.client.post(
+            "/api/batch/create?wait=true&wait_timeout=10", json.dumps(configs), content_type="application/json"
+        )
+        results = json.loads(response.content)["results"]
+        self.created += [result["id"] for result in results if result["status"] == "success"]
+        return results
+
+    def test_conflicting_item_fails_alone(self):
+        expose, = apply_ports(1)
+        results = self.create([
+            {"innet": 22, "expose": expose, "expire": -1},
+            {"innet": 80, "expose": expose, "expire": -1},
+            {"innet": 443, "expire": -1},
+        ])
+        self.assertEqual([result["status"] for result in results], ["success", "error", "success"])
+        self.assertIn(str(expose), results[1]["error_info"])
+        self.assertTrue(all(result["readiness"]["ready"] for result in results if result["status"] == "success"))
+
+    def test_conflicting_item_fails_alone_with_allocator(self):
+        with mock.patch.object(self.views, "port_allocator", PortAllocator((21000, 21009), (26000, 26009))):
+            self.test_conflicting_item_fails_alone()
+            self.assertEqual(self.views.port_allocator.json["taken"], 4)
+
+
+@skipUnless(shutil.which("openssl"), "openssl is not installed")
+class RelayBridgeTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        certification = tempfile.mkdtemp()
+        cls.certfile, cls.keyfile = os.path.join(certification, "proxy.crt"), os.path.join(certification, "proxy.key")
+        subprocess.run([
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=proxy",
+            "-keyout", cls.keyfile, "-out", cls.certfile
+        ], check=True, capture_output=True)
+        cls.engine = RelayEngine(cls.certfile, cls.keyfile)
+        cls.backend = RelayBackend(cls.engine)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.port = apply_ports(1)[0]
+        self.bridge = self.backend.start_bridge(self.port)
+        self.context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=self.certfile)
+        self.context.load_cert_chain(self.certfile, self.keyfile)
+        self.context.check_hostname = False
+
+    def tearDown(self):
+        self.bridge.terminate()
+        self.bridge.wait(5)
+
+    def connect(self, line: str) -> ssl.SSLSocket:
+        connection = self.context.wrap_socket(socket.create_connection(("127.0.0.1", self.port), timeout=5))
+        connection.sendall(line.encode())
+        return connection
+
+    def assert_closed(self, connection: ssl.SSLSocket):
+        try:
+            self.assertEqual(connection.recv(1), b"")
+        except ConnectionError:
+            pass
+        connection.close()
+
+    def test_malformed_handshake_closed(self):
+        for line in ("DATA x\n", "DATA a b c\n", "CONNECT 1 22\n", "\n"):
+            self.assert_closed(self.connect(line))
+        # Bridge still serving
+        self.assertIsNone(self.bridge.poll())
+
+    def test_data_connection_needs_token_of_key(self):
+        control = self.connect("CONTROL a\n")
+        deadline = time.time() + 5
+        while "a" not in self.bridge.controls and time.time() < deadline:
+            time.sleep(0.01)
+        opened = []
+        thread = threading.Thread(target=lambda: opened.append(self.engine.run_coroutine(self.bridge.open("a", 22))))
+        thread.start()
+        command, token, innet_port = control.makefile().readline().split()
+        self.assertEqual((command, innet_port), ("CONNECT", "22"))
+        # Token sent to the agent of another key, or guessed
+        self.assert_closed(self.connect("DATA b {}\n".format(token)))
+        self.assert_closed(self.connect("DATA a 0\n"))
+        data = self.connect("DATA a {}\n".format(token))
+        thread.join(5)
+        self.assertEqual(len(opened), 1)
+        self.engine.loop.call_soon_threadsafe(opened[0][1].close)
+        data.close()
+        control.close()
+
+
+class LazyActivatorTest(SimpleTestCase):
+    def setUp(self):
+        self.activator = LazyActivator(idle_timeout=60, check_interval=1)
+        self.activator.start()
+        self.port = apply_ports(1)[0]
+        self.tunnel = MultiTunnel([ExposeConfig(22, self.port)], lazy_activator=self.activator)
+        self.tunnel.dormant = True
+        self.activator.register(self.tunnel)
+
+    def tearDown(self):
+        # Processes started if it's activated
+        self.tunnel.stop()
+        self.activator.stop()
+
+    def bindable(self) -> bool:
+        sock = socket.socket()
+        try:
+            sock.bind(("", self.port))
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.close()
+
+    def test_dormant_ports_listened(self):
+        socket.create_connection(("127.0.0.1", self.port), timeout=5).close()
+
+    def test_stop_by_reaper_queued_after_listeners_closed(self):
+        submitted = threading.Event()
+        test = self
+
+        class Reaper:
+            def submit(self, name, processes, callback=None):
+                test.assertTrue(test.bindable())
+                submitted.set()
+
+        # Returns without waiting for activator thread
+        self.tunnel.stop(Reaper())
+        self.assertTrue(submitted.wait(5))
+
+    def test_stop_waits_for_listeners_closed(self):
+        self.tunnel.stop()
+        self.assertTrue(self.bindable())
+
+
+class _EchoTunnel:
+    """
+    Lazy tunnel whose server is an echo server in this process
+    """
+    def __init__(self, port: int):
+        self.exposes = [ExposeConfig(22, port)]
+        self.dormant = True
+        self.stopped = False
+        self.server: socket.socket = None
+
+    def activate(self) -> bool:
+        self.dormant = False
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", self.exposes[0].expose_port))
+        self.server.listen(16)
+        threading.Thread(target=self.serve, daemon=True).start()
+        return True
+
+    def serve(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.echo, args=(connection,), daemon=True).start()
+
+    @staticmethod
+    def echo(connection: socket.socket):
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                break
+            connection.sendall(data)
+        connection.close()
+
+    def deactivate(self) -> bool:
+        return False
+
+    def stop(self):
+        self.stopped = True
+        if self.server is not None:
+            self.server.close()
+
+
+class LazyRelayTest(SimpleTestCase):
+    def activate(self, relay_limit: int) -> socket.socket:
+        self.activator = LazyActivator(idle_timeout=60, check_interval=1, relay_limit=relay_limit)
+        self.activator.start()
+        self.tunnel = _EchoTunnel(apply_ports(1)[0])
+        self.activator.register(self.tunnel)
+        # Accepted by activator before the server listening
+        return socket.create_connection(("127.0.0.1", self.tunnel.exposes[0].expose_port), timeout=5)
+
+    def tearDown(self):
+        self.tunnel.stop()
+        self.activator.stop()
+
+    def test_accepted_connection_relayed(self):
+        connection = self.activate(relay_limit=1)
+        connection.sendall(b"ping")
+        self.assertEqual(connection.recv(4), b"ping")
+        self.assertEqual(self.activator.json["relaying"], 1)
+        connection.close()
+        deadline = time.time() + 5
+        while self.activator.json["relaying"] > 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.activator.json["relaying"], 0)
+
+    def test_connections_over_limit_closed(self):
+        connection = self.activate(relay_limit=0)
+        try:
+            self.assertEqual(connection.recv(1), b"")
+        except ConnectionError:
+            pass
+        connection.close()
+        self.assertEqual(self.activator.json["relay_dropped"], 1)
+
+
+class TrafficSamplerTest(SimpleTestCase):
+    def setUp(self):
+        self.tunnels = TunnelRegistry()
+        self.tunnel = MultiTunnel(
+            [ExposeConfig(22, 25022)], bridge_port=20022, expired=60, liveness=MultiTunnel.TRAFFIC
+        )
+        self.tunnels.add(1, self.tunnel)
+        self.sampler = TrafficSampler(self.tunnels)
+
+    def sample(self, bridge: int, expose: int):
+        self.tunnel.last_check_time = 0
+        with mock.patch("util.traffic.count_connections", return_value=(
+                Counter({20022: bridge, 25022: expose}), Counter({20022: bridge, 25022: expose})
+        )):
+            self.sampler.sample()
+
+    def test_idle_agent_connection_not_counted(self):
+        self.sample(bridge=1, expose=0)
+        self.assertEqual(self.tunnel.last_check_time, 0)
+        self.assertFalse(self.tunnel.traffic["active"])
+        self.assertEqual(self.tunnel.traffic["bridge_connections"], 1)
+
+    def test_expose_connection_checks_tunnel(self):
+        self.sample(bridge=1, expose=2)
+        self.assertGreater(self.tunnel.last_check_time, 0)
+        self.assertTrue(self.tunnel.traffic["active"])
+        self.assertEqual(self.tunnel.traffic["expose_connections"], {"25022": 2})
+
+    def test_heartbeat_liveness_not_checked(self):
+        self.tunnel.liveness = MultiTunnel.HEARTBEAT
+        self.sample(bridge=0, expose=1)
+        self.assertEqual(self.tunnel.last_check_time, 0)
+
+
+def _start_sleeper(ignore_term: bool = False, group: int = None) -> subprocess.Popen:
+    """
+    A child process in its own process group, returns after it's ready for signals
+    :param ignore_term: ignore SIGTERM
+    :param group: process group to join
+    :return:
+    """
+    code = "import signal, sys, time\n"
+    if ignore_term:
+        code += "signal.signal(signal.SIGTERM, signal.SIG_IGN)\n"
+    code += "print('ready', flush=True)\ntime.sleep(60)\n"
+    process = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE, **process_group_options(group))
+    process.stdout.readline()
+    process.stdout.close()
+    return process
+
+
+class ProcessReaperTest(SimpleTestCase):
+    def setUp(self):
+        self.reaper = ProcessReaper(timeout=0.5)
+
+    def tearDown(self):
+        self.reaper.stop()
+        for job in self.reaper.drain():
+            for process in job.processes:
+                process.kill()
+                process.wait()
+
+    def test_callback_after_exit(self):
+        self.reaper.start()
+        processes = [_start_sleeper(), _start_sleeper()]
+        exited = []
+        self.reaper.submit("tunnel 1", processes, lambda: exited.append([p.poll() for p in processes]))
+        self.assertTrue(self.reaper.wait("tunnel 1", 5))
+        self.assertEqual(len(exited), 1)
+        self.assertTrue(all(code is not None for code in exited[0]))
+        self.assertEqual(self.reaper.json["finished_jobs"], 1)
+        self.assertEqual(self.reaper.json["stopped_processes"], 2)
+
+    def test_killed_after_timeout(self):
+        self.reaper.start()
+        stubborn = _start_sleeper(ignore_term=True)
+        start = time.time()
+        self.reaper.submit("stubborn", [stubborn])
+        self.assertTrue(self.reaper.wait("stubborn", 5))
+        self.assertGreaterEqual(time.time() - start, 0.5)
+        self.assertIsNotNone(stubborn.poll())
+        self.assertEqual(self.reaper.json["killed_processes"], 1)
+
+    def test_callback_error_not_stop_reaper(self):
+        self.reaper.start()
+        self.reaper.submit("broken", [_start_sleeper()], lambda: 1 / 0)
+        called = []
+        self.reaper.submit("next", [_start_sleeper()], lambda: called.append(True))
+        self.assertTrue(self.reaper.wait("next", 5))
+        self.assertEqual(called, [True])
+
+    def test_drain(self):
+        # Not started, jobs stay queued
+        process = _start_sleeper()
+        self.reaper.submit("queued", [process])
+        self.assertFalse(self.reaper.wait("queued", 0.1))
+        self.assertEqual([job["name"] for job in self.reaper.json["queued"]], ["queued"])
+        jobs = self.reaper.drain()
+        self.assertEqual([job.name for job in jobs], ["queued"])
+        self.assertEqual(jobs[0].processes, [process])
+        self.assertEqual(self.reaper.json["queued"], [])
+        coordinator = ShutdownCoordinator(timeout=5)
+        for job in jobs:
+            coordinator.add(job)
+        coordinator.run()
+        self.assertIsNotNone(process.poll())
+
+
+def _start_exiting(code: int) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, "-c", "import sys; sys.exit({})".format(code)])
+
+
+class _CrashingTunnel:
+    def __init__(self, process_supervisor: ProcessSupervisor, crashes: int):
+        """
+        Works like MultiTunnel for supervisor, the process restarted crashes again for `crashes` times
+        :param process_supervisor:
+        :param crashes:
+        """
+        self.process_supervisor = process_supervisor
+        self.crashes = crashes
+        self.bridge_port = 0
+        self.stopped = False
+        self.state = supervisor.STARTING
+        self.exits = deque(maxlen=10)
+        self.restart_times = deque()
+        self.restart_count = 0
+        self.processes = []
+        self.start()
+
+    def start(self):
+        if self.crashes > 0:
+            self.crashes -= 1
+            self.processes = [_start_exiting(3)]
+        else:
+            self.processes = [_start_sleeper()]
+        self.process_supervisor.watch(self, self.processes[0])
+
+    def owns(self, process) -> bool:
+        return any(p is process for p in self.processes)
+
+    @property
+    def forwarding(self) -> bool:
+        return any(p.poll() is None for p in self.processes)
+
+    def restart(self) -> bool:
+        if self.stopped:
+            return False
+        self.start()
+        self.state = supervisor.RUNNING
+        return True
+
+    def stop(self):
+        self.stopped = True
+        for process in self.processes:
+            process.kill()
+            process.wait()
+
+
+class ProcessSupervisorTest(SimpleTestCase):
+    def setUp(self):
+        self.supervisor = ProcessSupervisor(backoff_base=0.05, backoff_max=1, restart_budget=3, budget_window=60)
+        self.supervisor.start()
+        self.tunnels = []
+
+    def tearDown(self):
+        self.supervisor.stop()
+        for tunnel in self.tunnels:
+            tunnel.stop()
+
+    def run_tunnel(self, crashes: int) -> _CrashingTunnel:
+        tunnel = _CrashingTunnel(self.supervisor, crashes)
+        self.tunnels.append(tunnel)
+        return tunnel
+
+    @staticmethod
+    def wait_until(condition, timeout: float = 5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_restart_crashed(self):
+        tunnel = self.run_tunnel(1)
+        self.assertTrue(self.wait_until(lambda: tunnel.restart_count == 1 and tunnel.forwarding))
+        self.assertEqual([exit_info["returncode"] for exit_info in tunnel.exits], [3])
+        self.assertEqual(tunnel.state, supervisor.RUNNING)
+        self.assertEqual(self.supervisor.json["restarts"], 1)
+
+    def test_backoff_and_budget(self):
+        tunnel = self.run_tunnel(10)
+        self.assertTrue(self.wait_until(lambda: tunnel.state == supervisor.FAILED))
+        self.assertEqual(tunnel.restart_count, 3)
+        self.assertEqual(len(tunnel.exits), 4)
+        # Delay doubled by each restart in budget window
+        times = list(tunnel.restart_times)
+        for i in range(1, len(times)):
+            self.assertGreaterEqual(times[i] - times[i - 1], 0.05 * 2 ** i)
+        self.assertEqual(self.supervisor.json["failed_tunnels"], 1)
+
+    def test_stopped_tunnel_not_restarted(self):
+        tunnel = self.run_tunnel(0)
+        self.assertTrue(self.wait_until(lambda: self.supervisor.json["watched_processes"] == 1))
+        tunnel.stop()
+        self.assertTrue(self.wait_until(lambda: self.supervisor.json["watched_processes"] == 0))
+        self.assertEqual(tunnel.restart_count, 0)
+        self.assertEqual(len(tunnel.exits), 0)
+
+
+class ShutdownCoordinatorTest(SimpleTestCase):
+    def test_all_groups_terminated_together(self):
+        coordinator = ShutdownCoordinator(timeout=5)
+        callbacks = []
+        for i in range(3):
+            leader = _start_sleeper()
+            member = _start_sleeper(group=leader.pid)
+            coordinator.submit("tunnel {}".format(i), [leader, member], lambda i=i: callbacks.append(i))
+        summary = coordinator.run()
+        self.assertLess(summary["seconds"], 2)
+        self.assertEqual(summary["processes"], 6)
+        self.assertEqual(summary["process_groups"], 3)
+        self.assertEqual(summary["terminated_processes"], 6)
+        # Groups emptied are not signaled again
+        self.assertEqual(summary["killed_groups"], 0)
+        self.assertEqual(sorted(callbacks), [0, 1, 2])
+
+    def test_killed_after_timeout(self):
+        coordinator = ShutdownCoordinator(timeout=0.5)
+        stubborn = _start_sleeper(ignore_term=True)
+        coordinator.submit("stubborn", [stubborn, _start_sleeper()])
+        summary = coordinator.run()
+        self.assertGreaterEqual(summary["seconds"], 0.5)
+        self.assertLess(summary["seconds"], 2)
+        self.assertEqual(summary["killed_processes"], 1)
+        self.assertEqual(summary["unstopped_processes"], 0)
+        self.assertIsNotNone(stubborn.poll())
+
+
+class TunnelJournalTest(SimpleTestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "tunnels.json")
+        self.tunnels = TunnelRegistry()
+        self.journal = TunnelJournal(self.path, self.tunnels)
+
+    def add(self, tid: int, innet_port: int):
+        tunnel = MultiTunnel([ExposeConfig(innet_port, 25000 + tid)], bridge_port=20000 + tid)
+        tunnel.config = {"innet": innet_port}
+        self.tunnels.add(tid, tunnel)
+
+    def load(self) -> dict:
+        return TunnelJournal(self.path, TunnelRegistry()).load()
+
+    def test_changes_appended_to_log(self):
+        self.add(1, 22)
+        self.journal.save()
+        snapshot_size = os.path.getsize(self.path)
+        self.add(2, 80)
+        self.journal.save()
+        self.tunnels.pop(1)
+        self.journal.save()
+        # Only the log grows between snapshots
+        self.assertEqual(os.path.getsize(self.path), snapshot_size)
+        with open(self.journal.log_path) as fp:
+            self.assertEqual(len(fp.readlines()), 3)
+        self.assertEqual([record["id"] for record in self.load()["tunnels"]], [2])
+
+    def test_flush_starts_new_log(self):
+        self.add(1, 22)
+        self.journal.save()
+        self.add(2, 80)
+        self.journal.save()
+        self.tunnels.heartbeat(2)
+        self.journal.flush()
+        with open(self.journal.log_path) as fp:
+            self.assertEqual(len(fp.readlines()), 1)
+        state = self.load()
+        self.assertEqual([record["id"] for record in state["tunnels"]], [1, 2])
+        self.assertEqual(state["tunnels"][1]["last_check_time"], self.tunnels.get(2).last_check_time)
+
+    def test_torn_line_ignored(self):
+        self.add(1, 22)
+        self.journal.save()
+        self.add(2, 80)
+        self.journal.save()
+        with open(self.journal.log_path, "a") as fp:
+            fp.write('{"create": {"id"')
+        self.assertEqual([record["id"] for record in self.load()["tunnels"]], [1, 2])
+
+    def test_log_of_older_snapshot_ignored(self):
+        self.add(1, 22)
+        self.journal.save()
+        self.add(2, 80)
+        self.journal.save()
+        with open(self.journal.log_path) as fp:
+            old_log = fp.read()
+        self.tunnels.pop(2)
+        self.journal.flush()
+        # Crashed after the snapshot replaced and before the log
+        with open(self.journal.log_path, "w") as fp:
+            fp.write(old_log)
+        self.assertEqual([record["id"] for record in self.load()["tunnels"]], [1])
+
+    def test_processes_adopted_after_restart(self):
+        self.add(1, 22)
+        process = _start_sleeper()
+        self.tunnels.get(1).bridge_process = process
+        try:
+            self.journal.save()
+            record = self.load()["tunnels"][0]
+            adopted = adopt_process(record["bridge_process"])
+            self.assertEqual(adopted.pid, process.pid)
+            self.assertIsNone(adopted.poll())
+        finally:
+            process.kill()
+            process.wait()
+        self.assertIsNone(adopt_process(record["bridge_process"]))
+
+
+class SqliteJournalTest(SimpleTestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "tunnels.db")
+        self.tunnels = TunnelRegistry()
+        self.leases = LeaseRegistry()
+        self.journal = SqliteJournal(self.path, self.tunnels, leases=self.leases)
+        self.processes = []
+
+    def tearDown(self):
+        for process in self.processes:
+            process.kill()
+            process.wait()
+
+    def add(self, tid: int, innet_port: int, lease=None) -> MultiTunnel:
+        tunnel = MultiTunnel([ExposeConfig(innet_port, 25000 + tid)], bridge_port=20000 + tid, lease=lease)
+        tunnel.config = {"innet": innet_port}
+        self.tunnels.add(tid, tunnel)
+        return tunnel
+
+    def load(self, tunnels: TunnelRegistry = None) -> dict:
+        # Like the manager started again
+        return SqliteJournal(self.path, TunnelRegistry() if tunnels is None else tunnels).load()
+
+    def test_changes_and_heartbeats(self):
+        lease = self.leases.create(60, "group")
+        self.add(1, 22, lease)
+        self.add(2, 80)
+        self.journal.save()
+        self.tunnels.pop(1)
+        self.journal.save()
+        self.tunnels.heartbeat(2)
+        self.journal.flush()
+        state = self.load()
+        self.assertEqual([record["id"] for record in state["tunnels"]], [2])
+        self.assertEqual(state["tunnels"][0]["last_check_time"], self.tunnels.get(2).last_check_time)
+        self.assertEqual(state["tunnels"][0]["expose_ports"], [25002])
+        self.assertEqual([(record["id"], record["comment"]) for record in state["leases"]], [(lease.id, "group")])
+
+    def test_processes_adopted_after_restart(self):
+        tunnel = self.add(1, 22)
+        self.journal.save()
+        # Restarted processes are written by flush
+        tunnel.bridge_process = _start_sleeper()
+        tunnel.client_processes = [_start_sleeper()]
+        self.processes += [tunnel.bridge_process] + tunnel.client_processes
+        self.journal.flush()
+        record = self.load()["tunnels"][0]
+        bridge = adopt_process(record["bridge_process"])
+        self.assertEqual(bridge.pid, tunnel.bridge_process.pid)
+        self.assertEqual(
+            [adopt_process(r).pid for r in record["client_processes"]],
+            [tunnel.client_processes[0].pid]
+        )
+        bridge.terminate()
+        self.assertEqual(bridge.wait(5), 0)
+        self.assertIsNone(adopt_process(record["bridge_process"]))
+
+    def test_tunnels_not_restored_dropped(self):
+        self.add(1, 22)
+        self.add(2, 80)
+        self.journal.save()
+        # Only tunnel 2 restored in next run, the first save rewrites all
+        restored = TunnelRegistry()
+        journal = SqliteJournal(self.path, restored)
+        restored.add(2, MultiTunnel([ExposeConfig(80, 25002)], bridge_port=20002))
+        journal.save()
+        self.assertEqual([record["id"] for record in self.load()["tunnels"]], [2])
@@ -1,11 +1,32 @@
 from django.urls import path
 
+from tunnel_manager.settings import ASGI_MODE
 from . import views
 
+if ASGI_MODE:
+    # Served in event loop, not by the thread of Django
+    from . import async_views as hot_views
+else:
+    hot_views = views
+
 urlpatterns = [
-    path(r'list', views.get_proxy_list, name='list'),
-    path(r'create', views.create_tunnel, name='create'),
-    path(r'remove', views.remove_tunnel, name='remove'),
-    path(r'heartbeat', views.tunnel_heartbeat, name='heartbeat'),
-    path(r'query', views.query_tunnel, name='query'),
+    path(r'list', hot_views.get_proxy_list, name='list'),
+    path(r'events', hot_views.get_events, name='events'),
+    path(r'create', hot_views.create_tunnel, name='create'),
+    path(r'remove', hot_views.remove_tunnel, name='remove'),
+    path(r'heartbeat', hot_views.tunnel_heartbeat, name='heartbeat'),
+    path(r'query', hot_views.query_tunnel, name='query'),
+    path(r'find', hot_views.find_tunnels, name='find'),
+    path(r'lease/create', views.create_lease, name='lease_create'),
+    path(r'lease/renew', views.renew_lease, name='lease_renew'),
+    path(r'lease/query', views.query_lease, name='lease_query'),
+    path(r'lease/remove', views.remove_lease, name='lease_remove'),
+    path(r'batch/create', views.batch_create_tunnels, name='batch_create'),
+    path(r'batch/remove', views.batch_remove_tunnels, name='batch_remove'),
+    path(r'batch/heartbeat', views.batch_tunnel_heartbeat, name='batch_heartbeat'),
+    path(r'permanent', views.permanent_tunnels, name='permanent'),
+    path(r'reaper', views.get_reaper_status, name='reaper'),
+    path(r'pool', views.get_pool_status, name='pool'),
+    path(r'metrics', views.get_metrics, name='metrics'),
+    path(r'traffic', views.get_traffic, name='traffic'),
 ]
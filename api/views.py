@@ -1,43 +1,137 @@
+import asyncio
 import atexit
 import json
 import logging
+import os
 import sys
 import time
-from threading import Lock
-from typing import Dict, Mapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Mapping, Optional, Tuple
 
-from django.http import HttpRequest
+from django.http import HttpRequest, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import parse_etags
 # Create your views here.
 from django.views.decorators.csrf import csrf_exempt
 
-from tunnel_manager.settings import DEBUG
-from util import MutexLock, TunnelsCheckThread, response_json, check_authorization
+from tunnel_manager.settings import DEBUG, BRIDGE_PORT_RANGE, EXPOSE_PORT_RANGE, SHARED_BRIDGE_COUNT, \
+    WARM_POOL_SIZE, WARM_POOL_REFILL_INTERVAL, TUNNEL_JOURNAL, TUNNEL_DATABASE, JOURNAL_FLUSH_INTERVAL, \
+    METRICS_SAMPLE_INTERVAL, TRAFFIC_SAMPLE_INTERVAL, LAZY_IDLE_TIMEOUT, TUNNEL_BACKEND, RELAY_CERT, RELAY_KEY, \
+    RELAY_BUFFER_SIZE, RESTART_BACKOFF, RESTART_BUDGET, RESTART_BUDGET_WINDOW, READY_TIMEOUT, BATCH_MAX_SIZE, BATCH_WORKERS, \
+    HEARTBEAT_UDP_PORT, HEARTBEAT_UDP_WINDOW, ASGI_MODE, SHUTDOWN_TIMEOUT, FIND_MAX_LIMIT, \
+    PERMANENT_FILE, PERMANENT_RELOAD_INTERVAL, LAZY_RELAY_LIMIT
+from util import TunnelRegistry, TunnelsCheckThread, response_json, check_authorization, events, metrics
 # Initialize
-from util.goproxy import ExposeConfig, MultiTunnel
+from util.asyncproc import AsyncGoproxyBackend, ProcessLoop
+from util.goproxy import BridgeWarmPool, ExposeConfig, MultiTunnel, SharedBridgePool, goproxy_backend
+from util.heartbeat import HeartbeatListener
+from util.http_response import _auth_key, _failure_limiter, get_json_response
+from util.journal import SqliteJournal, TunnelJournal, adopt_process
+from util.lease import LeaseRegistry
+from util.lazy import LazyActivator
+from util.metrics import TunnelUsageSampler, instrument
+from util.permanent import PermanentFileWatcher, PermanentReconciler
+from util.ports import PortAllocator, parse_port_range
+from util.reaper import ProcessReaper, ShutdownCoordinator
+from util.relay import RelayBackend, RelayEngine
+from util.supervisor import ProcessSupervisor
+from util.traffic import TrafficSampler
 
-tunnels: Dict[int, MultiTunnel] = dict()
-
-tunnels_op_lock = Lock()
-_check_thread = TunnelsCheckThread(tunnels, tunnels_op_lock)
-_check_thread.start()
+tunnels = TunnelRegistry()
+if BRIDGE_PORT_RANGE and EXPOSE_PORT_RANGE:
+    port_allocator = PortAllocator(
+        parse_port_range(BRIDGE_PORT_RANGE),
+        parse_port_range(EXPOSE_PORT_RANGE)
+    )
+elif BRIDGE_PORT_RANGE or EXPOSE_PORT_RANGE:
+    raise ValueError("BRIDGE_PORT_RANGE and EXPOSE_PORT_RANGE should be set together")
+else:
+    port_allocator = None
+if TUNNEL_BACKEND == "relay":
+    backend = RelayBackend(RelayEngine(RELAY_CERT, RELAY_KEY, RELAY_BUFFER_SIZE))
+elif TUNNEL_BACKEND == "goproxy":
+    backend = goproxy_backend
+elif TUNNEL_BACKEND == "asyncio":
+    backend = AsyncGoproxyBackend(ProcessLoop())
+else:
+    raise ValueError("Unknown tunnel backend: {}".format(TUNNEL_BACKEND))
+bridge_pool = SharedBridgePool(SHARED_BRIDGE_COUNT, port_allocator, backend) if SHARED_BRIDGE_COUNT > 0 else None
+warm_pool = BridgeWarmPool(
+    WARM_POOL_SIZE, port_allocator, WARM_POOL_REFILL_INTERVAL, backend
+) if WARM_POOL_SIZE > 0 else None
+if warm_pool is not None:
+    warm_pool.start()
 
-tunnel_id = 0
+_reaper = ProcessReaper()
+_reaper.start()
+leases = LeaseRegistry()
+_check_thread = TunnelsCheckThread(tunnels, _reaper, leases=leases)
+if not ASGI_MODE:
+    # Run as a task in the event loop of ASGI server, see start_check_task
+    _check_thread.start()
+if TUNNEL_DATABASE:
+    journal = SqliteJournal(TUNNEL_DATABASE, tunnels, bridge_pool, JOURNAL_FLUSH_INTERVAL, leases)
+elif TUNNEL_JOURNAL:
+    journal = TunnelJournal(TUNNEL_JOURNAL, tunnels, bridge_pool, JOURNAL_FLUSH_INTERVAL, leases)
+else:
+    journal = None
+usage_sampler = TunnelUsageSampler(tunnels, METRICS_SAMPLE_INTERVAL) if METRICS_SAMPLE_INTERVAL > 0 else None
+if usage_sampler is not None:
+    usage_sampler.start()
+traffic_sampler = TrafficSampler(tunnels, TRAFFIC_SAMPLE_INTERVAL) if TRAFFIC_SAMPLE_INTERVAL > 0 else None
+if traffic_sampler is not None:
+    traffic_sampler.start()
+lazy_activator = LazyActivator(LAZY_IDLE_TIMEOUT, relay_limit=LAZY_RELAY_LIMIT)
+lazy_activator.start()
+process_supervisor = ProcessSupervisor(
+    RESTART_BACKOFF, restart_budget=RESTART_BUDGET, budget_window=RESTART_BUDGET_WINDOW
+) if RESTART_BUDGET > 0 else None
+if process_supervisor is not None:
+    process_supervisor.start()
+heartbeat_listener = HeartbeatListener(
+    tunnels, HEARTBEAT_UDP_PORT, _auth_key, HEARTBEAT_UDP_WINDOW
+) if HEARTBEAT_UDP_PORT > 0 else None
+if heartbeat_listener is not None:
+    heartbeat_listener.start()
 
 log = logging.getLogger(__file__)
 
 
-def _new_tunnel_id():
+def _collect_gauges() -> list:
+    tunnel_list = tunnels.items()
+    process_count = sum(len(tunnel.processes) for _, tunnel in tunnel_list)
+    if bridge_pool is not None:
+        process_count += len(bridge_pool.processes)
+    if warm_pool is not None:
+        process_count += warm_pool.json["idle"]
+    lines = metrics.gauge_lines("tunnel_manager_tunnels", "Living tunnels.", [({}, len(tunnel_list))])
+    lines += metrics.gauge_lines(
+        "tunnel_manager_child_processes", "goproxy processes owned by manager.", [({}, process_count)]
+    )
+    states = dict()
+    for _, tunnel in tunnel_list:
+        states[tunnel.state] = states.get(tunnel.state, 0) + 1
+    lines += metrics.gauge_lines(
+        "tunnel_manager_tunnels_by_state", "Living tunnels by supervision state.",
+        [({"state": state}, count) for state, count in sorted(states.items())]
+    )
+    if usage_sampler is not None:
+        lines += usage_sampler.collect()
+    return lines
+
+
+metrics.register_collector(_collect_gauges)
+
+_CONFIG_KEYS = ("exposes", "innet", "expose", "bridge", "comment", "expire", "client_key", "liveness", "lazy",
+                "lease")
+
+
+def _is_true(value) -> bool:
     """
-    UNSAFE! Use it in mutex lock
+    Boolean in json or string in form
+    :param value:
     :return:
     """
-    global tunnel_id
-    current_tick = int(time.time() * 1000)
-    if tunnel_id < current_tick:
-        tunnel_id = current_tick
-    else:
-        tunnel_id += 1
-    return tunnel_id
+    return value is True or str(value).lower() in ("1", "true", "yes")
 
 
 def _create_from_dict(config: Mapping):
@@ -66,62 +160,315 @@ def _create_from_dict(config: Mapping):
         )
     else:
         raise ValueError("Can't find innet or exposes in configuration")
+    pinned = [expose.expose_port for expose in exposes if expose.expose_port is not None]
+    if "bridge" in config:
+        pinned.append(int(config["bridge"]))
+    for port in pinned:
+        owner = tunnels.index.port_owner(port)
+        if owner is not None:
+            raise ValueError("Port {} is used by tunnel {}".format(port, owner))
+
+    liveness = config.get("liveness", MultiTunnel.HEARTBEAT)
+    if liveness != MultiTunnel.HEARTBEAT and traffic_sampler is None:
+        raise ValueError("Liveness mode {} needs traffic sampling enabled".format(liveness))
+    lease = None
+    if config.get("lease") not in (None, ""):
+        lease = leases.get(int(config["lease"]))
+        if lease is None or lease.released:
+            raise ValueError("Lease {} not found".format(config["lease"]))
 
     tunnel = MultiTunnel(
         exposes,
         bridge_port=int(config["bridge"]) if "bridge" in config else None,
         comment=config.get("comment", ""),
-        expired=config.get("expire", 60)
+        expired=float(config.get("expire", 60)),
+        port_allocator=port_allocator,
+        bridge_pool=bridge_pool,
+        key=config.get("client_key"),
+        warm_pool=warm_pool,
+        config={k: config[k] for k in _CONFIG_KEYS if k in config},
+        liveness=liveness,
+        lazy_activator=lazy_activator if _is_true(config.get("lazy")) else None,
+        backend=backend,
+        process_supervisor=process_supervisor,
+        lease=lease
     )
 
     return tunnel
 
 
-def _add_permanent_proxy():
+def _save_journal():
+    if journal is not None:
+        try:
+            journal.save()
+        except Exception as ex:
+            log.error("Error while saving tunnel journal.", exc_info=ex)
+
+
+def _restore_tunnels() -> list:
+    """
+    Take over the tunnels in journal, only the exited processes are restarted
+    :return: configurations of restored tunnels by id
+    """
+    state = journal.load()
+    if bridge_pool is not None:
+        bridge_pool.adopt([
+            (bridge["port"], adopt_process(bridge["process"]))
+            for bridge in state["shared_bridges"]
+        ])
+    for record in state.get("leases", []):
+        lease = leases.create(record["expire_time"], record["comment"], record["id"])
+        lease.last_check_time = record["last_check_time"]
+        _check_thread.watch_lease(lease)
+    restored = dict()
+    for record in state["tunnels"]:
+        tid = record["id"]
+        try:
+            tunnel = _create_from_dict(record["config"])
+            tunnel.bridge_port = record["bridge_port"]
+            for expose_config, expose_port in zip(tunnel.exposes, record["expose_ports"]):
+                expose_config.expose_port = expose_port
+            tunnel.key = record["key"]
+            tunnel.last_check_time = record["last_check_time"]
+            bridge_process = adopt_process(record["bridge_process"])
+            client_processes = [adopt_process(r) for r in record["client_processes"]]
+            tunnel.resume(bridge_process, client_processes, record["shared"] and bridge_pool is not None)
+            tunnels.add(tid, tunnel)
+            _check_thread.watch(tid, tunnel)
+            restored[tid] = tunnel.config
+            log.info("Tunnel {} restored, {} of {} processes adopted.".format(
+                tid,
+                len([p for p in [bridge_process] + client_processes if p is not None]),
+                len(tunnel.processes)
+            ))
+        except Exception as ex:
+            log.error("Error while restoring tunnel {}.".format(tid), exc_info=ex)
+    if journal is not None:
+        journal.start()
+    return restored
+
+
+def _start_permanent(item: dict) -> int:
+    tunnel = _create_from_dict(item)
+    tunnel.start()
+    tid = tunnels.new_id()
+    tunnels.add(tid, tunnel)
+    _check_thread.watch(tid, tunnel)
+    log.info("Permanent tunnel {} started.".format(tid))
+    return tid
+
+
+def _stop_permanent(tid: int, wait: bool = False):
+    """
+    Detach and stop the permanent tunnel
+    :param tid:
+    :param wait: stop it here instead of in reaper, so the pinned ports are free for the tunnel replacing it
+    :return:
+    """
+    name = "tunnel {}".format(tid)
+    tunnel = tunnels.pop(tid)
+    if tunnel is not None:
+        tunnel.stop(None if wait else _reaper, name)
+        log.info("Permanent tunnel {} stopped.".format(tid))
+    elif wait and not _reaper.wait(name, _reaper.timeout + 1):
+        # Removed or expired before, still being terminated by reaper
+        log.warning("Permanent tunnel {} is not terminated in time.".format(tid))
+
+
+permanent = PermanentReconciler(_start_permanent, _stop_permanent, lambda tid: tunnels.get(tid) is not None)
+permanent_watcher: Optional[PermanentFileWatcher] = None
+
+
+def _permanent_entries(document) -> List[dict]:
+    if not isinstance(document, list):
+        raise ValueError("Permanent tunnels should be a JSON array")
+    return [dict({"expire": -1}, **item) if isinstance(item, dict) else item for item in document]
+
+
+def _read_permanent() -> List[dict]:
     try:
-        with open("permanent.json", "r") as fp:
-            with MutexLock(tunnels_op_lock) as _:
-                for item in json.load(fp):
-                    if "expire" not in item:
-                        item["expire"] = -1
-                    tid = _new_tunnel_id()
-                    tunnels[tid] = _create_from_dict(item)
-                    tunnels[tid].start()
+        with open(PERMANENT_FILE, "r") as fp:
+            return _permanent_entries(json.load(fp))
+    except FileNotFoundError:
+        return []
+
+
+def _reconcile_permanent(entries: List[dict]) -> dict:
+    result = permanent.reconcile(entries)
+    if result["added"] or result["removed"] or result["changed"] or result["restarted"]:
+        _save_journal()
+    if result["added"] or result["removed"] or result["changed"] or result["restarted"] or result["failed"]:
+        log.info("Permanent tunnels reconciled: {} added, {} removed, {} changed, {} restarted, {} failed.".format(
+            len(result["added"]), len(result["removed"]), len(result["changed"]), len(result["restarted"]),
+            len(result["failed"])
+        ))
+    return result
+
+
+def _reload_permanent():
+    _reconcile_permanent(_read_permanent())
+
+
+def _add_permanent_proxy(restored: Mapping[int, dict] = None):
+    try:
+        entries = _read_permanent()
+        restored = dict(restored or {})
+        for item in entries:
+            for tid, config in restored.items():
+                if {k: item[k] for k in _CONFIG_KEYS if k in item} == config:
+                    # Taken over from journal
+                    permanent.adopt(item, tid)
+                    del restored[tid]
+                    break
+        _reconcile_permanent(entries)
     except Exception as ex:
         log.error("Error while initialize permanent tunnels.", exc_info=ex)
+    _save_journal()
 
 
-if sys.argv[1] == "runserver":
-    _add_permanent_proxy()
+if ASGI_MODE or sys.argv[1] == "runserver":
+    _add_permanent_proxy(_restore_tunnels() if journal is not None else None)
+    if PERMANENT_RELOAD_INTERVAL > 0:
+        permanent_watcher = PermanentFileWatcher(PERMANENT_FILE, _reload_permanent, PERMANENT_RELOAD_INTERVAL)
+        permanent_watcher.start()
 else:
     log.info("Not `runserver` mode, permanent proxy will not started.")
 
 
 def _close_all_tunnel():
     """
-    Acquire the lock and release the tunnel
+    Detach all the tunnels and release them in SHUTDOWN_TIMEOUT seconds
+    If journal enabled, tunnels are kept running for next run of manager
     :return:
     """
+    if process_supervisor is not None:
+        # Processes stopped below are not restarted
+        process_supervisor.stop()
     _check_thread.stop()
-    tunnels_op_lock.acquire()
-    for tid, tunnel in tunnels.items():
-        log.info("Releasing tunnel {}...".format(tid))
-        tunnel.stop()
+    _reaper.stop()
+    if usage_sampler is not None:
+        usage_sampler.stop()
+    if traffic_sampler is not None:
+        traffic_sampler.stop()
+    lazy_activator.stop()
+    if heartbeat_listener is not None:
+        heartbeat_listener.stop()
+    if permanent_watcher is not None:
+        permanent_watcher.stop()
+    coordinator = ShutdownCoordinator(SHUTDOWN_TIMEOUT)
+    if warm_pool is not None:
+        warm_pool.stop(coordinator)
+    # Tunnels removed or expired before, still being terminated
+    _reaper.join(SHUTDOWN_TIMEOUT)
+    if not _reaper.is_alive():
+        for job in _reaper.drain():
+            coordinator.add(job)
+    if journal is not None:
+        journal.stop()
+        log.info("Tunnels saved to journal, {} tunnels are kept running.".format(len(tunnels)))
+    else:
+        detached = tunnels.pop_many([tid for tid, _ in tunnels.items()])
+        log.info("Releasing {} tunnels...".format(len(detached)))
+        for tid, tunnel in detached.items():
+            tunnel.stop(coordinator, "tunnel {}".format(tid))
+        if bridge_pool is not None:
+            bridge_pool.stop(coordinator)
+    summary = coordinator.run()
+    log.info("Shutdown finished in {:.3f} seconds: {}".format(summary["seconds"], json.dumps(summary)))
 
 
 atexit.register(_close_all_tunnel)
 
+_check_task: Optional[asyncio.Task] = None
 
+
+def start_check_task() -> asyncio.Task:
+    """
+    Start the check loop as a task in the running event loop once, in ASGI mode
+    :return:
+    """
+    global _check_task
+    if _check_task is None:
+        _check_task = asyncio.get_running_loop().create_task(_check_thread.run_async())
+    return _check_task
+
+
+def _list_etag(version: int) -> str:
+    return '"{}"'.format(tunnels.events.cursor(version))
+
+
+def _delta_json(tunnel: MultiTunnel) -> dict:
+    # from_last_check changes every moment, client computes it from last_check_time
+    info = tunnel.json
+    del info["from_last_check"]
+    return info
+
+
+def _list_delta(event_list: list) -> dict:
+    """
+    Merge events into the changes of tunnels
+    :param event_list:
+    :return: added/removed/changed tunnels
+    """
+    added, removed, changed = set(), set(), set()
+    for event in event_list:
+        tid = event["id"]
+        if event["type"] == events.CREATE:
+            added.add(tid)
+        elif event["type"] in (events.REMOVE, events.EXPIRE):
+            if tid in added:
+                # Created and removed between versions, consumer never knows it
+                added.discard(tid)
+            else:
+                removed.add(tid)
+            changed.discard(tid)
+        elif tid not in added:
+            changed.add(tid)
+    result = {"added": [], "removed": sorted(removed), "changed": []}
+    for name, ids in (("added", added), ("changed", changed)):
+        for tid in sorted(ids):
+            tunnel = tunnels.get(tid)
+            if tunnel is not None:
+                result[name].append({"id": tid, "tunnel": _delta_json(tunnel)})
+    return result
+
+
+@instrument("list")
 @check_authorization
 @response_json
 def get_proxy_list(request: HttpRequest):
     """
     Get proxy list
+    Returns 304 if `If-None-Match` matches the current version,
+    or only the changes after version if `since` set
     :param request:
     :return:
     """
-    return {
+    return _proxy_list(request)
+
+
+def _proxy_list(request: HttpRequest):
+    if any(name in request.GET for name in _FIND_PARAMETERS):
+        return _find(request)
+    # Read version before the snapshot, events after it may be applied on the snapshot again
+    version = tunnels.version
+    etag = _list_etag(version)
+    if etag in parse_etags(request.headers.get("If-None-Match", "")):
+        response = HttpResponseNotModified()
+        response["ETag"] = etag
+        return response
+    if "since" in request.GET:
+        since = tunnels.events.version_of(request.GET["since"])
+        event_list, reset = tunnels.events.since(since)
+        if not reset:
+            if len(event_list) > 0:
+                since = event_list[-1]["version"]
+            result = {"status": "success", "version": tunnels.events.cursor(since), "reset": False}
+            result.update(_list_delta(event_list))
+            return result
+    result = {
         "status": "success",
+        "version": tunnels.events.cursor(version),
         "data": [
             {
                 "id": tid,
@@ -130,9 +477,182 @@ def get_proxy_list(request: HttpRequest):
             for tid, tunnel in tunnels.items()
         ]
     }
+    if "since" in request.GET:
+        result["reset"] = True
+    response = get_json_response(result)
+    response["ETag"] = etag
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
+# Query parameter: (keyword of TunnelRegistry.find, type)
+_FIND_CONDITIONS = {
+    "expose_port": ("expose_port", int),
+    "bridge_port": ("bridge_port", int),
+    "innet_port": ("innet_port", int),
+    "tag": ("tag", str),
+    "comment": ("comment_prefix", str),
+    "expiring_within": ("expiring_within", float),
+}
+_FIND_PARAMETERS = set(_FIND_CONDITIONS) | {"limit", "after_id"}
+
+
+def _find(request: HttpRequest) -> dict:
+    """
+    Tunnels matching the conditions in query string, a page of `limit` tunnels with id greater than `after_id`
+    :param request:
+    :return:
+    """
+    conditions = {
+        keyword: parse(request.GET[name])
+        for name, (keyword, parse) in _FIND_CONDITIONS.items() if name in request.GET
+    }
+    limit = min(int(request.GET.get("limit", FIND_MAX_LIMIT)), FIND_MAX_LIMIT)
+    if limit <= 0:
+        raise ValueError("Limit should be positive")
+    version = tunnels.version
+    found, more = tunnels.find(
+        after_id=int(request.GET["after_id"]) if "after_id" in request.GET else None,
+        limit=limit,
+        **conditions
+    )
+    return {
+        "status": "success",
+        "version": tunnels.events.cursor(version),
+        "data": [
+            {
+                "id": tid,
+                "tunnel": tunnel.json
+            }
+            for tid, tunnel in found
+        ],
+        # Cursor of the next page, None on the last page
+        "next_after_id": found[-1][0] if more and found else None
+    }
+
+
+@instrument("find")
+@check_authorization
+@response_json
+def find_tunnels(request: HttpRequest):
+    """
+    Find tunnels by indexes: `expose_port`, `bridge_port`, `innet_port`, `tag`, `comment` (prefix),
+    `expiring_within` (seconds), paginated by `limit` and `after_id`
+    :param request:
+    :return:
+    """
+    return _find(request)
+
+
+def _event_stream(version: Optional[int], keepalive: float = 15):
+    """
+    Generate Server-Sent Events after version, ids of events are cursors of their versions
+    :param version: None if the cursor of consumer is from another run of manager
+    :param keepalive: seconds between keepalive comments while no event
+    :return:
+    """
+    yield "retry: 3000\n\n"
+    while True:
+        event_list, reset = tunnels.events.wait(version, keepalive)
+        if reset:
+            # Consumer should reload the whole list
+            version = tunnels.version
+            yield "id: {}\nevent: reset\ndata: {{}}\n\n".format(tunnels.events.cursor(version))
+        elif len(event_list) <= 0:
+            yield ": keepalive\n\n"
+        for event in event_list:
+            version = event["version"]
+            yield "id: {}\nevent: {}\ndata: {}\n\n".format(
+                tunnels.events.cursor(version), event["type"], json.dumps(event)
+            )
+
+
+def _poll_timeout(request: HttpRequest) -> float:
+    return min(float(request.GET.get("timeout", 25)), 60)
+
+
+def _since(request: HttpRequest) -> Optional[int]:
+    """
+    Version of the cursor in `Last-Event-ID` or `since`, the latest version if not set
+    :param request:
+    :return: None if the cursor is from another run of manager
+    """
+    cursor = request.headers.get("Last-Event-ID") or request.GET.get("since")
+    if cursor is None:
+        return tunnels.version
+    return tunnels.events.version_of(cursor)
+
+
+def _poll_result(since: Optional[int], event_list: list, reset: bool) -> dict:
+    if len(event_list) > 0:
+        version = event_list[-1]["version"]
+    else:
+        version = tunnels.version if reset else since
+    return {
+        "status": "success",
+        "version": tunnels.events.cursor(version),
+        "reset": reset,
+        "events": event_list
+    }
+
+
+@check_authorization
+@response_json
+def get_events(request: HttpRequest):
+    """
+    Changes of tunnels after version `since`, streamed as Server-Sent Events,
+    or long-polled if `poll` set or client doesn't accept event stream
+    :param request:
+    :return:
+    """
+    since = _since(request)
+    if "poll" in request.GET or "text/event-stream" not in request.headers.get("Accept", ""):
+        event_list, reset = tunnels.events.wait(since, _poll_timeout(request))
+        return _poll_result(since, event_list, reset)
+    response = StreamingHttpResponse(_event_stream(since), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def _start_tunnel(tunnel: MultiTunnel, wait: bool, wait_timeout: float, reserved: List[int] = None) -> Optional[dict]:
+    """
+    Start the tunnel and wait for its ports listening if required, the unready tunnel is stopped
+    :param tunnel:
+    :param wait:
+    :param wait_timeout: seconds
+    :param reserved: ports reserved for the prepared tunnel, see `MultiTunnel.prepare`
+    :return: readiness report if waited
+    """
+    tunnel.start(max(wait_timeout, READY_TIMEOUT), reserved)
+    if not wait:
+        return None
+    start = time.time()
+    ready = tunnel.wait_ready(wait_timeout)
+    readiness = {
+        "ready": ready,
+        "seconds": time.time() - start,
+        "ports": dict(tunnel.readiness)
+    }
+    if not ready:
+        # Not registered yet, nobody else knows it
+        tunnel.stop(_reaper, "unready tunnel")
+        log.warning("Tunnel not ready in {} seconds, ports: {}.".format(wait_timeout, tunnel.readiness))
+    return readiness
+
+
+def _unready_error(readiness: dict) -> dict:
+    return {
+        "status": "error",
+        "error_info": "Ports {} are not listening".format(
+            sorted(port for port, seconds in readiness["ports"].items() if seconds is None)
+        ),
+        "readiness": readiness
+    }
 
 
 @csrf_exempt
+@instrument("create")
 @check_authorization
 @response_json
 def create_tunnel(request: HttpRequest):
@@ -141,79 +661,457 @@ def create_tunnel(request: HttpRequest):
     :param request:
     :return:
     """
+    return _create(request.POST)
+
+
+def _create(params: Mapping):
+    tunnel = _create_from_dict(params)
+    readiness = _start_tunnel(
+        tunnel,
+        _is_true(params.get("wait")),
+        float(params.get("wait_timeout", READY_TIMEOUT))
+    )
+    if readiness is not None and not readiness["ready"]:
+        return get_json_response(_unready_error(readiness), status_code=504)
+    tid = tunnels.new_id()
+    tunnels.add(tid, tunnel)
+    _check_thread.watch(tid, tunnel)
+    _save_journal()
+    log.info("Tunnel {} created by API.".format(tid))
+    result = {
+        "status": "success",
+        "id": tid,
+        "tunnel": tunnel.json
+    }
+    if readiness is not None:
+        result["readiness"] = readiness
+    return result
+
 
-    with MutexLock(tunnels_op_lock) as _:
-        tid = _new_tunnel_id()
-        # noinspection PyTypeChecker
-        tunnels[tid] = _create_from_dict(request.POST)
-        tunnels[tid].start()
-        log.info("Tunnel {} created by API.".format(tid))
+@csrf_exempt
+@instrument("remove")
+@check_authorization
+@response_json
+def remove_tunnel(request: HttpRequest):
+    """
+    :param request:
+    :return:
+    """
+    return _remove(int(request.POST["id"]))
+
+
+def _remove(tid: int) -> dict:
+    tunnel = tunnels.pop(tid)
+    if tunnel is not None:
+        # Detached already, processes are terminated in background
+        tunnel.stop(_reaper, "tunnel {}".format(tid))
+        _save_journal()
+        log.info("Tunnel {} removed by API.".format(tid))
         return {
             "status": "success",
-            "id": tid,
-            "tunnel": tunnels[tid].json
+            "id": tid
         }
+    else:
+        raise Exception("ID {} not found".format(tid))
 
 
 @csrf_exempt
+@instrument("heartbeat")
 @check_authorization
 @response_json
-def remove_tunnel(request: HttpRequest):
+def tunnel_heartbeat(request: HttpRequest):
     """
     :param request:
     :return:
     """
-    tid = int(request.POST["id"])
-    if tid in tunnels:
-        with MutexLock(tunnels_op_lock) as _:
-            tunnel = tunnels.pop(tid)
-            tunnel.stop()
-            log.info("Tunnel {} removed by API.".format(tid))
-            return {
-                "status": "success",
-                "id": tid
-            }
+    return _heartbeat(int(request.POST["id"]))
+
+
+def _heartbeat(tid: int) -> dict:
+    tunnel = tunnels.get(tid)
+    if tunnel is not None and not tunnel.heartbeat_liveness:
+        raise Exception("Tunnel {} is checked by traffic only".format(tid))
+    if tunnels.heartbeat(tid):
+        if DEBUG:
+            print("Tunnel {} re-check heartbeat by API.".format(tid))
+        return {
+            "status": "success",
+            "id": tid
+        }
     else:
         raise Exception("ID {} not found".format(tid))
 
 
+def _read_json_array(request: HttpRequest) -> list:
+    items = json.loads(request.body)
+    if not isinstance(items, list):
+        raise ValueError("Request body should be a JSON array")
+    if len(items) > BATCH_MAX_SIZE:
+        raise ValueError("At most {} items in a batch, got {}".format(BATCH_MAX_SIZE, len(items)))
+    return items
+
+
+def _item_error(ex: Exception) -> dict:
+    return {
+        "status": "error",
+        "error_info": str(ex)
+    }
+
+
 @csrf_exempt
+@instrument("batch_create")
 @check_authorization
 @response_json
-def tunnel_heartbeat(request: HttpRequest):
+def batch_create_tunnels(request: HttpRequest):
     """
+    Create the tunnels in a JSON array of configurations, processes of them are started concurrently
+    Ports of the whole batch are reserved in one call before any process started, all or nothing for each item.
+    Failed items are reported in place, the others are created anyway
     :param request:
     :return:
     """
-    tid = int(request.POST["id"])
-    if tid in tunnels:
-        with MutexLock(tunnels_op_lock) as _:
-            tunnels[tid].check()
-            if DEBUG:
-                print("Tunnel {} re-check heartbeat by API.".format(tid))
-            return {
+    configs = _read_json_array(request)
+    wait = _is_true(request.GET.get("wait"))
+    wait_timeout = float(request.GET.get("wait_timeout", READY_TIMEOUT))
+    results: List[Optional[dict]] = [None] * len(configs)
+    started: List[Tuple[int, MultiTunnel]] = []
+    prepared: Dict[int, MultiTunnel] = dict()
+    wanted: Dict[int, list] = dict()
+    batch_pinned = set()
+
+    def fail(index: int, ex: Exception):
+        log.warning("Error while creating tunnel {} of batch.".format(index), exc_info=ex)
+        results[index] = _item_error(ex)
+
+    for index, config in enumerate(configs):
+        try:
+            if not isinstance(config, dict):
+                raise ValueError("Configuration should be a JSON object")
+            tunnel = _create_from_dict(config)
+            # Pinned twice in batch, before the shared bridge taken as bridge port
+            pinned = [e.expose_port for e in tunnel.exposes if e.expose_port is not None]
+            pinned += [tunnel.bridge_port] if tunnel.bridge_port is not None else []
+            for port in pinned:
+                if port in batch_pinned:
+                    raise ValueError("Port {} is used by another tunnel".format(port))
+            batch_pinned.update(pinned)
+            if port_allocator is not None:
+                wanted[index] = tunnel.prepare()
+            prepared[index] = tunnel
+        except Exception as ex:
+            fail(index, ex)
+    reserved: Dict[int, List[int]] = dict()
+    if len(wanted) > 0:
+        for index, ports in zip(wanted, port_allocator.reserve_many(list(wanted.values()))):
+            if isinstance(ports, Exception):
+                prepared.pop(index).stop(name="failed tunnel")
+                fail(index, ports)
+            else:
+                reserved[index] = ports
+
+    def create(index: int, tunnel: MultiTunnel):
+        try:
+            readiness = _start_tunnel(tunnel, wait, wait_timeout, reserved.get(index))
+            if readiness is not None and not readiness["ready"]:
+                results[index] = _unready_error(readiness)
+                return
+            results[index] = {
                 "status": "success",
-                "id": tid
+                "tunnel": tunnel
             }
+            if readiness is not None:
+                results[index]["readiness"] = readiness
+        except Exception as ex:
+            fail(index, ex)
+
+    if len(prepared) > 0:
+        with ThreadPoolExecutor(min(len(prepared), BATCH_WORKERS)) as executor:
+            for future in [executor.submit(create, i, tunnel) for i, tunnel in prepared.items()]:
+                future.result()
+    for result in results:
+        if result["status"] == "success":
+            tunnel = result["tunnel"]
+            result["id"] = tunnels.new_id()
+            result["tunnel"] = tunnel.json
+            started.append((result["id"], tunnel))
+    tunnels.add_many(started)
+    for tid, tunnel in started:
+        _check_thread.watch(tid, tunnel)
+    if len(started) > 0:
+        _save_journal()
+    log.info("{} of {} tunnels created by batch API.".format(len(started), len(configs)))
+    return {
+        "status": "success",
+        "results": results
+    }
+
+
+@csrf_exempt
+@instrument("batch_remove")
+@check_authorization
+@response_json
+def batch_remove_tunnels(request: HttpRequest):
+    """
+    Remove the tunnels in a JSON array of ids
+    :param request:
+    :return:
+    """
+    tids = [int(tid) for tid in _read_json_array(request)]
+    removed = tunnels.pop_many(tids)
+    for tid, tunnel in removed.items():
+        tunnel.stop(_reaper, "tunnel {}".format(tid))
+    if len(removed) > 0:
+        _save_journal()
+    log.info("{} of {} tunnels removed by batch API.".format(len(removed), len(tids)))
+    return {
+        "status": "success",
+        "results": [
+            {"status": "success", "id": tid} if tid in removed else
+            dict(_item_error(Exception("ID {} not found".format(tid))), id=tid)
+            for tid in tids
+        ]
+    }
+
+
+@csrf_exempt
+@instrument("batch_heartbeat")
+@check_authorization
+@response_json
+def batch_tunnel_heartbeat(request: HttpRequest):
+    """
+    Heartbeat the tunnels in a JSON array of ids
+    :param request:
+    :return:
+    """
+    results = []
+    for tid in (int(tid) for tid in _read_json_array(request)):
+        tunnel = tunnels.get(tid)
+        if tunnel is not None and not tunnel.heartbeat_liveness:
+            results.append(dict(_item_error(Exception("Tunnel {} is checked by traffic only".format(tid))), id=tid))
+        elif tunnels.heartbeat(tid):
+            results.append({"status": "success", "id": tid})
+        else:
+            results.append(dict(_item_error(Exception("ID {} not found".format(tid))), id=tid))
+    return {
+        "status": "success",
+        "results": results
+    }
+
+
+def _get_lease(request: HttpRequest):
+    lid = int(request.GET.get("id", request.POST.get("id")))
+    lease = leases.get(lid)
+    if lease is None:
+        raise Exception("Lease {} not found".format(lid))
+    return lease
+
+
+@csrf_exempt
+@check_authorization
+@response_json
+def create_lease(request: HttpRequest):
+    """
+    Create a lease, pass its id by `lease` when creating tunnels
+    :param request:
+    :return:
+    """
+    lease = leases.create(float(request.POST.get("expire", 60)), request.POST.get("comment", ""))
+    _check_thread.watch_lease(lease)
+    _save_journal()
+    log.info("Lease {} created by API.".format(lease.id))
+    return {
+        "status": "success",
+        "lease": lease.json
+    }
+
+
+@csrf_exempt
+@instrument("lease_renew")
+@check_authorization
+@response_json
+def renew_lease(request: HttpRequest):
+    """
+    Renew the lease and all of its member tunnels
+    :param request:
+    :return:
+    """
+    lease = _get_lease(request)
+    lease.check()
+    for tid in lease.members.copy():
+        tunnels.heartbeat(tid)
+    return {
+        "status": "success",
+        "id": lease.id
+    }
+
+
+@csrf_exempt
+@check_authorization
+@response_json
+def query_lease(request: HttpRequest):
+    """
+    :param request:
+    :return:
+    """
+    return {
+        "status": "success",
+        "lease": _get_lease(request).json
+    }
+
+
+@csrf_exempt
+@check_authorization
+@response_json
+def remove_lease(request: HttpRequest):
+    """
+    Remove the lease and all of its member tunnels
+    :param request:
+    :return:
+    """
+    lease = leases.pop(_get_lease(request).id)
+    if lease is None:
+        raise Exception("Lease not found")
+    removed = tunnels.pop_many(lease.members.copy())
+    for tid, tunnel in removed.items():
+        tunnel.stop(_reaper, "tunnel {}".format(tid))
+    _save_journal()
+    log.info("Lease {} removed by API with {} tunnels.".format(lease.id, len(removed)))
+    return {
+        "status": "success",
+        "id": lease.id,
+        "removed": sorted(removed)
+    }
+
+
+@csrf_exempt
+@instrument("query")
+@check_authorization
+@response_json
+def query_tunnel(request: HttpRequest):
+    """
+    :param request:
+    :return:
+    """
+    return _query(int(request.GET["id"]))
+
+
+def _query(tid: int) -> dict:
+    tunnel = tunnels.get(tid)
+    if tunnel is not None:
+        return {
+            "status": "success",
+            "id": tid,
+            "tunnel": tunnel.json
+        }
     else:
         raise Exception("ID {} not found".format(tid))
 
 
+@check_authorization
+@response_json
+def get_reaper_status(request: HttpRequest):
+    """
+    Get the status of process termination queue
+    :param request:
+    :return:
+    """
+    return {
+        "status": "success",
+        "data": _reaper.json
+    }
+
+
+def _write_permanent(document: list):
+    temp_path = PERMANENT_FILE + ".tmp"
+    with open(temp_path, "w") as fp:
+        json.dump(document, fp, indent=2)
+    os.replace(temp_path, PERMANENT_FILE)
+
+
 @csrf_exempt
+@instrument("permanent")
 @check_authorization
 @response_json
-def query_tunnel(request: HttpRequest):
+def permanent_tunnels(request: HttpRequest):
     """
+    PUT: replace all the permanent tunnels by the JSON array in body, only the added, removed and changed ones
+    are started or stopped, and the array is saved to permanent.json
+    GET: the running permanent tunnels
     :param request:
     :return:
     """
-    tid = int(request.GET["id"])
-    if tid in tunnels:
-        with MutexLock(tunnels_op_lock) as _:
-            return {
-                "status": "success",
+    if request.method == "PUT":
+        document = json.loads(request.body)
+        result = _reconcile_permanent(_permanent_entries(document))
+        _write_permanent(document)
+        return dict(status="success", **result)
+    return {
+        "status": "success",
+        "data": permanent.json,
+        "watcher": permanent_watcher.json if permanent_watcher is not None else None
+    }
+
+
+@check_authorization
+@response_json
+def get_pool_status(request: HttpRequest):
+    """
+    Get the status of shared bridges, warm pool, lazy tunnels and process supervisor
+    :param request:
+    :return:
+    """
+    return {
+        "status": "success",
+        "data": {
+            "backend": backend.name,
+            "shared_bridges": bridge_pool.json if bridge_pool is not None else [],
+            "warm_pool": warm_pool.json if warm_pool is not None else None,
+            "lazy": lazy_activator.json,
+            "supervisor": process_supervisor.json if process_supervisor is not None else None,
+            "heartbeat_listener": heartbeat_listener.json if heartbeat_listener is not None else None,
+            "auth_limiter": _failure_limiter.json if _failure_limiter is not None else None,
+            "ports": port_allocator.json if port_allocator is not None else None
+        }
+    }
+
+
+@check_authorization
+@response_json
+def get_traffic(request: HttpRequest):
+    """
+    Connections and bytes of the tunnels in the last sample
+    :param request:
+    :return:
+    """
+    if traffic_sampler is None:
+        raise Exception("Traffic sampling is disabled")
+    return {
+        "status": "success",
+        "interval": traffic_sampler.interval,
+        "sample_time": traffic_sampler.sample_time,
+        "data": [
+            {
                 "id": tid,
-                "tunnel": tunnels[tid].json
+                "traffic": tunnel.traffic
             }
-    else:
-        raise Exception("ID {} not found".format(tid))
+            for tid, tunnel in tunnels.items()
+        ],
+        "shared_bridges": [
+            {
+                "port": bridge.port,
+                "connections": traffic_sampler.remote_connections(bridge.port)
+            }
+            for bridge in (bridge_pool.bridges if bridge_pool is not None else [])
+        ]
+    }
+
+
+@instrument("metrics")
+@check_authorization
+def get_metrics(request: HttpRequest):
+    """
+    Metrics of manager and tunnels in Prometheus text format
+    :param request:
+    :return:
+    """
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,74 @@
+"""
+Compare process count and memory between one-bridge-per-tunnel and shared bridge layouts with a stub binary
+Usage: python -m benchmark.bridge_benchmark [tunnel count]
+"""
+import sys
+import time
+from typing import Optional
+from os.path import abspath, dirname, join
+
+import util.goproxy
+from tunnel_manager.settings import BRIDGE_PORT_RANGE, EXPOSE_PORT_RANGE
+from util.goproxy import ExposeConfig, MultiTunnel, SharedBridgePool
+from util.ports import PortAllocator, parse_port_range, wait_listening
+
+
+def _rss_kb(pid: int) -> Optional[int]:
+    try:
+        with open("/proc/{}/status".format(pid)) as fp:
+            for line in fp:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        # Exited, e.g. failed to listen
+        return None
+    return 0
+
+
+def measure(count: int, bridge_pool_size: int):
+    # Ranges of manager if set, else the ports are applied from OS
+    allocator = PortAllocator(
+        parse_port_range(BRIDGE_PORT_RANGE), parse_port_range(EXPOSE_PORT_RANGE)
+    ) if BRIDGE_PORT_RANGE and EXPOSE_PORT_RANGE else None
+    bridge_pool = SharedBridgePool(bridge_pool_size, allocator) if bridge_pool_size > 0 else None
+    tunnels = []
+    processes = []
+    try:
+        start = time.time()
+        for _ in range(count):
+            tunnel = MultiTunnel(
+                [ExposeConfig(22)],
+                port_allocator=allocator,
+                bridge_pool=bridge_pool
+            )
+            tunnel.start()
+            tunnels.append(tunnel)
+        create_cost = time.time() - start
+        processes = [p for t in tunnels for p in t.processes]
+        if bridge_pool is not None:
+            processes += bridge_pool.processes
+        ports = {t.bridge_port for t in tunnels} | {e.expose_port for t in tunnels for e in t.exposes}
+        wait_listening(ports, timeout=60)
+        rss_list = [_rss_kb(p.pid) for p in processes]
+        return len(processes), sum(r for r in rss_list if r is not None), rss_list.count(None), create_cost
+    finally:
+        for tunnel in tunnels:
+            tunnel.stop()
+        if bridge_pool is not None:
+            bridge_pool.stop()
+        # Ports are reused by next layout only after all the processes are reaped
+        for process in processes:
+            process.wait()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    util.goproxy.proxy_bin = join(dirname(abspath(__file__)), "stub_proxy.py")
+    print("{:>24} {:>10} {:>8} {:>12} {:>12}".format("layout", "processes", "exited", "RSS(MiB)", "create(s)"))
+    for name, pool_size in (("bridge per tunnel", 0), ("shared bridge x1", 1), ("shared bridge x4", 4)):
+        process_count, rss, exited, create_cost = measure(count, pool_size)
+        print("{:>24} {:>10} {:>8} {:>12.1f} {:>12.2f}".format(name, process_count, exited, rss / 1024, create_cost))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Compare the cost of one expiry check round between the legacy full scan and the deadline heap
+Usage: python -m benchmark.expiry_benchmark
+"""
+import gc
+import random
+import time
+import timeit
+
+from util.expiry import ExpiryScheduler
+from util.goproxy import ExposeConfig, MultiTunnel
+
+
+def _build_tunnels(count: int, due_ratio: float):
+    now = time.time()
+    tunnels = {}
+    for tid in range(count):
+        tunnel = MultiTunnel([ExposeConfig(22, 10000)], bridge_port=20000, expired=60)
+        # Part of the tunnels are overdue, the others are due in 30~60 seconds
+        if random.random() < due_ratio:
+            tunnel.last_check_time = now - 120
+        else:
+            tunnel.last_check_time = now - random.uniform(0, 30)
+        tunnels[tid] = tunnel
+    return tunnels
+
+
+def _full_scan(tunnels):
+    return [x for x, tunnel in tunnels.items() if not tunnel.valid]
+
+
+def _heap_round(tunnels, scheduler: ExpiryScheduler):
+    now = time.time()
+    expired = []
+    for _, tid in scheduler.pop_due(now):
+        deadline = tunnels[tid].deadline
+        if deadline > now:
+            scheduler.push(tid, deadline)
+        else:
+            expired.append(tid)
+    return expired
+
+
+def bench(count: int, due_ratio: float, repeat: int = 20):
+    tunnels = _build_tunnels(count, due_ratio)
+    scan_cost = min(timeit.repeat(lambda: _full_scan(tunnels), number=1, repeat=repeat))
+
+    heap_costs = []
+    for _ in range(repeat):
+        scheduler = ExpiryScheduler()
+        for tid, tunnel in tunnels.items():
+            scheduler.push(tid, tunnel.deadline)
+        gc.collect()
+        start = time.perf_counter()
+        _heap_round(tunnels, scheduler)
+        heap_costs.append(time.perf_counter() - start)
+    return scan_cost, min(heap_costs)
+
+
+def main():
+    random.seed(0)
+    print("{:>8} {:>8} {:>14} {:>14}".format("tunnels", "due", "full scan(ms)", "heap(ms)"))
+    for count in (10000, 100000):
+        for due_ratio in (0, 0.01):
+            scan_cost, heap_cost = bench(count, due_ratio)
+            print("{:>8} {:>7.0%} {:>14.3f} {:>14.3f}".format(
+                count, due_ratio, scan_cost * 1000, heap_cost * 1000
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Heartbeats per second on one core: Django view, bare WSGI route and UDP datagrams
+Usage: python -m benchmark.heartbeat_benchmark [seconds per case]
+"""
+import io
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+_KEY = "benchmark-key"
+
+
+def _wsgi_rate(application, path: str, tid: int, seconds: float) -> float:
+    body = "id={}&key={}".format(tid, _KEY).encode()
+    statuses = []
+
+    def start_response(status, headers):
+        statuses.append(status)
+
+    count = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        environ = {
+            "REQUEST_METHOD": "POST",
+            "PATH_INFO": path,
+            "QUERY_STRING": "",
+            "CONTENT_TYPE": "application/x-www-form-urlencoded",
+            "CONTENT_LENGTH": str(len(body)),
+            "SERVER_NAME": "127.0.0.1",
+            "SERVER_PORT": "8000",
+            "HTTP_HOST": "127.0.0.1",
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+        }
+        response = application(environ, start_response)
+        b"".join(response)
+        if hasattr(response, "close"):
+            response.close()
+        count += 1
+    assert statuses[-1].startswith("200"), statuses[-1]
+    return count / seconds
+
+
+def _udp_sender(port: int, tid: int, seconds: float, window: int, result):
+    from util.heartbeat import OK, pack_heartbeat
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(("127.0.0.1", port))
+    sock.settimeout(1)
+    replied = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        for _ in range(window):
+            sock.send(pack_heartbeat(tid, _KEY))
+        for _ in range(window):
+            try:
+                if sock.recv(64)[0] == OK:
+                    replied += 1
+            except socket.timeout:
+                break
+    result.put(replied / seconds)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    os.environ["AUTHORIZE_KEYS"] = _KEY
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tunnel_manager.settings")
+    # Not `runserver`, no permanent tunnel is started
+    sys.argv = ["heartbeat_benchmark", "benchmark"]
+    from tunnel_manager.wsgi import application
+    from api import views
+    from util.goproxy import ExposeConfig, MultiTunnel
+    from util.heartbeat import HeartbeatListener
+
+    tid = views.tunnels.new_id()
+    # Registered only, no process started
+    views.tunnels.add(tid, MultiTunnel([ExposeConfig(22, 25000)], bridge_port=20000, expired=600))
+
+    print("Django /api/heartbeat: {:.0f} heartbeats/s".format(_wsgi_rate(application, "/api/heartbeat", tid, seconds)))
+    print("WSGI /api/hb: {:.0f} heartbeats/s".format(_wsgi_rate(application, "/api/hb", tid, seconds)))
+
+    listener = HeartbeatListener(views.tunnels, 0, [_KEY])
+    listener.start()
+    context = multiprocessing.get_context("spawn")
+    result = context.Queue()
+    sender = context.Process(target=_udp_sender, args=(listener.port, tid, seconds, 32, result))
+    sender.start()
+    rate = result.get()
+    sender.join()
+    listener.stop()
+    print("UDP datagrams: {:.0f} heartbeats/s ({} dropped)".format(rate, listener.dropped_count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Throughput and connection latency of the relay backend, no goproxy binary needed
+Usage: python -m benchmark.relay_benchmark [tunnel count] [MiB per tunnel]
+"""
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import join
+from threading import Thread
+
+from util.goproxy import ExposeConfig, MultiTunnel
+from util.ports import PortAllocator, wait_listening
+from util.relay import RelayBackend, RelayEngine, run_agent
+
+
+def _echo_server() -> int:
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(128)
+
+    def serve(connection):
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                break
+            connection.sendall(data)
+        connection.close()
+
+    def accept():
+        while True:
+            connection, _ = server.accept()
+            Thread(target=serve, args=(connection,), daemon=True).start()
+
+    Thread(target=accept, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def _round_trip(port: int, payload: bytes) -> float:
+    start = time.time()
+    connection = socket.create_connection(("127.0.0.1", port))
+    Thread(target=connection.sendall, args=(payload,), daemon=True).start()
+    received = 0
+    while received < len(payload):
+        data = connection.recv(65536)
+        if not data:
+            raise ConnectionError("Closed after {} bytes".format(received))
+        received += len(data)
+    connection.close()
+    return time.time() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    certification = tempfile.mkdtemp()
+    certfile, keyfile = join(certification, "proxy.crt"), join(certification, "proxy.key")
+    subprocess.run([
+        "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=proxy",
+        "-keyout", keyfile, "-out", certfile
+    ], check=True, capture_output=True)
+
+    backend = RelayBackend(RelayEngine(certfile, keyfile))
+    allocator = PortAllocator((40000, 44999), (45000, 49999))
+    innet_port = _echo_server()
+    agents = asyncio.new_event_loop()
+    Thread(target=agents.run_forever, daemon=True).start()
+    tunnels = []
+    agent_futures = []
+    try:
+        for i in range(count):
+            tunnel = MultiTunnel([ExposeConfig(innet_port)], port_allocator=allocator, backend=backend,
+                                 key="tunnel{}".format(i))
+            tunnel.start()
+            tunnels.append(tunnel)
+            agent_futures.append(asyncio.run_coroutine_threadsafe(
+                run_agent("127.0.0.1", tunnel.bridge_port, certfile, keyfile, tunnel.key), agents
+            ))
+        wait_listening([t.exposes[0].expose_port for t in tunnels], timeout=10)
+        time.sleep(1)
+
+        latencies = [_round_trip(t.exposes[0].expose_port, b"ping") for t in tunnels]
+        print("connect + 4 bytes round trip: avg {:.2f} ms, max {:.2f} ms".format(
+            sum(latencies) / len(latencies) * 1000, max(latencies) * 1000
+        ))
+
+        payload = os.urandom(size * 1024 * 1024)
+        costs = []
+        workers = [
+            Thread(target=lambda port: costs.append(_round_trip(port, payload)), args=(t.exposes[0].expose_port,))
+            for t in tunnels
+        ]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        cost = time.time() - start
+        print("{} tunnels echo {} MiB each: {:.2f} s, {:.1f} MiB/s in total".format(
+            count, size, cost, count * size * 2 / cost
+        ))
+    finally:
+        for tunnel in tunnels:
+            tunnel.stop()
+
+
+if __name__ == '__main__':
+    main()
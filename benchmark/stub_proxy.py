@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+A stub of goproxy binary for benchmarks, listens the ports in arguments and holds some memory
+Usage: stub_proxy.py bridge|server [goproxy arguments]
+"""
+import os
+import signal
+import socket
+import sys
+import time
+
+
+def main():
+    args = sys.argv[1:]
+    ports = []
+    for i, arg in enumerate(args):
+        if arg == "-p":
+            ports.append(int(args[i + 1].split(":")[-1]))
+        elif arg == "-r":
+            ports.append(int(args[i + 1].split("@")[0].split(":")[-1]))
+    # Simulate the resident memory of TLS context and buffers
+    ballast = bytearray(int(os.environ.get("STUB_PROXY_BALLAST", 4 * 1024 * 1024)))
+    ballast[::4096] = b"\1" * len(ballast[::4096])
+    sockets = []
+    for port in ports:
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("", port))
+        sock.listen()
+        sockets.append(sock)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == '__main__':
+    main()
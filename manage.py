@@ -1,11 +1,20 @@
 #!/usr/bin/env python
 """Django's command-line utility for administrative tasks."""
 import os
+import signal
 import sys
 
 
+def _exit_on_sigterm(signum, frame):
+    # Exit like Ctrl-C, so the tunnels are closed by atexit instead of left running
+    sys.exit(0)
+
+
 def main():
     os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tunnel_manager.settings')
+    if len(sys.argv) > 1 and sys.argv[1] == "runserver":
+        # Servers like gunicorn and uvicorn handle SIGTERM themselves
+        signal.signal(signal.SIGTERM, _exit_on_sigterm)
     try:
         from django.core.management import execute_from_command_line
     except ImportError as exc:
@@ -0,0 +1,60 @@
+"""
+ASGI config for tunnel_manager project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Run by an ASGI server, e.g. ``uvicorn tunnel_manager.asgi:application``.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tunnel_manager.settings')
+# Read by settings, set before util imports it
+os.environ['TUNNEL_MANAGER_ASGI'] = '1'
+# goproxy processes are started and awaited by asyncio
+os.environ.setdefault('TUNNEL_BACKEND', 'asyncio')
+
+from util.heartbeat import AsgiHeartbeatFastPath  # noqa: E402
+
+
+def _tunnels():
+    from api.views import tunnels
+    return tunnels
+
+
+def _start_check_task():
+    from api.views import start_check_task
+    start_check_task()
+
+
+def _stop_check_task():
+    from api.views import _check_thread
+    _check_thread.stop()
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            _start_check_task()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            _stop_check_task()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+# Heartbeats of agents at /api/hb skip the middlewares and views of Django
+_application = AsgiHeartbeatFastPath(get_asgi_application(), _tunnels)
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    # Servers without lifespan support start the check loop at the first request
+    _start_check_task()
+    return await _application(scope, receive, send)
@@ -112,4 +112,87 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/2.2/howto/static-files/
 
 STATIC_URL = '/static/'
-LOGIN_URL = "/ui/login"
\ No newline at end of file
+LOGIN_URL = "/ui/login"
+
+# Tunnels
+# Ports allocated to the tunnels without pinned ports like "20000-24999", keep them out of the OS ephemeral port range.
+# Set both to enable, by default the ports are applied from OS
+
+BRIDGE_PORT_RANGE = os.environ.get("BRIDGE_PORT_RANGE", "")
+EXPOSE_PORT_RANGE = os.environ.get("EXPOSE_PORT_RANGE", "")
+
+# Count of long-lived bridge processes shared by the tunnels without pinned bridge port,
+# 0 to start a dedicated bridge for each tunnel
+SHARED_BRIDGE_COUNT = int(os.environ.get("SHARED_BRIDGE_COUNT", "0"))
+
+# Count of started bridge processes kept for the new tunnels, 0 to disable
+WARM_POOL_SIZE = int(os.environ.get("WARM_POOL_SIZE", "0"))
+# Seconds between starting two bridges while refilling the warm pool
+WARM_POOL_REFILL_INTERVAL = float(os.environ.get("WARM_POOL_REFILL_INTERVAL", "0.1"))
+
+# Path of tunnel journal, tunnels are kept running after manager exits and taken over by next run if set
+TUNNEL_JOURNAL = os.environ.get("TUNNEL_JOURNAL", "")
+# Path of SQLite database used as tunnel journal instead of TUNNEL_JOURNAL, a row per tunnel
+TUNNEL_DATABASE = os.environ.get("TUNNEL_DATABASE", "")
+# Seconds between flushing the heartbeats of tunnels to journal
+JOURNAL_FLUSH_INTERVAL = float(os.environ.get("JOURNAL_FLUSH_INTERVAL", "5"))
+
+# Seconds between sampling the resource usage of tunnel processes for /api/metrics, 0 to disable
+METRICS_SAMPLE_INTERVAL = float(os.environ.get("METRICS_SAMPLE_INTERVAL", "15"))
+
+# Seconds between sampling the connections and bytes of tunnels from /proc, 0 to disable
+TRAFFIC_SAMPLE_INTERVAL = float(os.environ.get("TRAFFIC_SAMPLE_INTERVAL", "10"))
+
+# Seconds without connection before the server processes of a lazy tunnel are stopped
+LAZY_IDLE_TIMEOUT = float(os.environ.get("LAZY_IDLE_TIMEOUT", "300"))
+# Max connections accepted by manager before activation and relayed to the server processes at the same time
+LAZY_RELAY_LIMIT = int(os.environ.get("LAZY_RELAY_LIMIT", "256"))
+
+# Default seconds `/api/create?wait=true` waits for the ports of new tunnel listening
+READY_TIMEOUT = float(os.environ.get("READY_TIMEOUT", "10"))
+
+# Max items in a request of batch API, and threads starting the tunnels of a batch create
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "1000"))
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "16"))
+
+# Failed authorizations allowed per client address and per key, refilled by AUTH_FAILURE_RATE per second,
+# more failures are rejected by 429 at once. 0 rate to disable throttling
+AUTH_FAILURE_BURST = float(os.environ.get("AUTH_FAILURE_BURST", "10"))
+AUTH_FAILURE_RATE = float(os.environ.get("AUTH_FAILURE_RATE", "1"))
+# Clients tracked by the throttling, the least recently failed ones are forgotten beyond it
+AUTH_LIMITER_SIZE = int(os.environ.get("AUTH_LIMITER_SIZE", "10000"))
+
+# File of permanent tunnels, reconciled with the running ones when it changes
+PERMANENT_FILE = os.environ.get("PERMANENT_FILE", "permanent.json")
+# Seconds between checking mtime of PERMANENT_FILE where inotify is not available, 0 to disable reloading
+PERMANENT_RELOAD_INTERVAL = float(os.environ.get("PERMANENT_RELOAD_INTERVAL", "2"))
+
+# Max tunnels in a page of `/api/find` and filtered `/api/list`
+FIND_MAX_LIMIT = int(os.environ.get("FIND_MAX_LIMIT", "1000"))
+
+# UDP port of the signed heartbeat datagrams, 0 to disable
+HEARTBEAT_UDP_PORT = int(os.environ.get("HEARTBEAT_UDP_PORT", "0"))
+# Max seconds between the time in heartbeat datagram and now
+HEARTBEAT_UDP_WINDOW = float(os.environ.get("HEARTBEAT_UDP_WINDOW", "30"))
+
+# Seconds to stop all the tunnels when manager exits, processes still alive after it are killed
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", "10"))
+
+# Seconds before restarting a crashed goproxy process, doubled by each restart in budget window
+RESTART_BACKOFF = float(os.environ.get("RESTART_BACKOFF", "1"))
+# Restarts allowed in budget window before the tunnel is marked failed, 0 to disable restarting
+RESTART_BUDGET = int(os.environ.get("RESTART_BUDGET", "5"))
+RESTART_BUDGET_WINDOW = float(os.environ.get("RESTART_BUDGET_WINDOW", "600"))
+
+# Program running the bridges and servers: goproxy (processes of bin/proxy), asyncio (processes of bin/proxy
+# started and awaited by an asyncio loop) or relay (experimental asyncio loop in manager, speaks its own protocol,
+# goproxy clients can't connect to it, every agent has to run `python -m util.relay` instead)
+TUNNEL_BACKEND = os.environ.get("TUNNEL_BACKEND", "goproxy")
+# Certificate of relay bridges, agents connect with the same one
+RELAY_CERT = os.environ.get("RELAY_CERT", "certification/proxy.crt")
+RELAY_KEY = os.environ.get("RELAY_KEY", "certification/proxy.key")
+# Max bytes buffered per direction of a relayed connection
+RELAY_BUFFER_SIZE = int(os.environ.get("RELAY_BUFFER_SIZE", "65536"))
+
+# Served by an ASGI server through tunnel_manager/asgi.py, set by it
+ASGI_MODE = os.environ.get("TUNNEL_MANAGER_ASGI") == "1"
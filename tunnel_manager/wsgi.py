@@ -13,4 +13,13 @@ from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tunnel_manager.settings')
 
-application = get_wsgi_application()
+from util.heartbeat import HeartbeatFastPath  # noqa: E402
+
+
+def _tunnels():
+    from api.views import tunnels
+    return tunnels
+
+
+# Heartbeats of agents at /api/hb skip the middlewares and views of Django
+application = HeartbeatFastPath(get_wsgi_application(), _tunnels)
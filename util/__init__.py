@@ -1,3 +1,4 @@
 from .lock import MutexLock
 from .goproxy import Tunnel, TunnelsCheckThread
 from .http_response import response_json, check_authorization
+from .registry import TunnelRegistry
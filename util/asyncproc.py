@@ -0,0 +1,154 @@
+"""
+Backend starting goproxy processes by asyncio subprocess, exits are awaited on one event loop
+"""
+import asyncio
+import concurrent.futures
+import os
+import signal
+import subprocess
+import sys
+import warnings
+from threading import Thread, current_thread
+from typing import List, Optional
+
+from util import metrics
+from util.backend import TunnelBackend, process_group_options
+from util.goproxy import _bridge_command, _server_command, proxy_bin
+
+
+class ProcessLoop(Thread):
+    def __init__(self):
+        """
+        The event loop owning the child processes
+        Exits are watched by pidfd on the loop, no thread or blocking wait per child.
+        """
+        super(ProcessLoop, self).__init__()
+        self.daemon = True
+        self.loop = asyncio.new_event_loop()
+        if sys.version_info < (3, 12) and hasattr(os, "pidfd_open"):
+            # Newer versions use pidfd by default, older ones block a thread per child
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", DeprecationWarning)
+                watcher = asyncio.PidfdChildWatcher()
+                watcher.attach_loop(self.loop)
+                asyncio.set_child_watcher(watcher)
+
+    def run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run_coroutine(self, coroutine, timeout: float = None):
+        """
+        Run coroutine in loop and wait for the result, from threads other than the loop
+        :param coroutine:
+        :param timeout:
+        :return:
+        """
+        if current_thread() is self:
+            coroutine.close()
+            raise RuntimeError("Blocking on process loop from itself")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    async def spawn(self, command: List[str], group: int = None) -> "AsyncProcess":
+        process = await asyncio.create_subprocess_exec(*command, **process_group_options(group))
+        return AsyncProcess(self, process, command)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class AsyncProcess:
+    def __init__(self, process_loop: ProcessLoop, process: asyncio.subprocess.Process, args: List[str]):
+        """
+        A process started on process loop, works like Popen from any thread
+        :param process_loop:
+        :param process:
+        :param args: command line
+        """
+        self.process_loop = process_loop
+        self.process = process
+        self.pid = process.pid
+        self.args = args
+        self.__exit_code: Optional[int] = None
+
+    @property
+    def returncode(self) -> Optional[int]:
+        if self.process.returncode is not None:
+            return self.process.returncode
+        return self.__exit_code
+
+    def poll(self) -> Optional[int]:
+        """
+        Check the exit without reaping, the loop may not have reaped the process yet
+        when pidfd waiters of reaper and supervisor wake up.
+        :return:
+        """
+        if self.returncode is None and hasattr(os, "waitid"):
+            try:
+                result = os.waitid(os.P_PID, self.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+            except ChildProcessError:
+                # Reaped by loop just now
+                return self.returncode
+            if result is not None:
+                self.__exit_code = result.si_status if result.si_code == os.CLD_EXITED else -result.si_status
+        return self.returncode
+
+    async def wait_async(self) -> int:
+        """
+        Await the exit in any event loop
+        :return:
+        """
+        if asyncio.get_running_loop() is self.process_loop.loop:
+            return await self.process.wait()
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(self.process.wait(), self.process_loop.loop)
+        )
+
+    def wait(self, timeout: float = None) -> int:
+        if self.process.returncode is not None:
+            return self.process.returncode
+        try:
+            return self.process_loop.run_coroutine(self.process.wait(), timeout)
+        except concurrent.futures.TimeoutError:
+            raise subprocess.TimeoutExpired(self.args, timeout)
+
+    def send_signal(self, sig: int):
+        if self.poll() is not None:
+            return
+        try:
+            # The loop reaps the process, the pid is not reused before that
+            os.kill(self.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class AsyncGoproxyBackend(TunnelBackend):
+    """
+    Run bridge and server by goproxy processes started on process loop
+    """
+    name = "asyncio"
+
+    def __init__(self, process_loop: ProcessLoop):
+        self.process_loop = process_loop
+        if not process_loop.is_alive():
+            process_loop.start()
+
+    def __spawn(self, command: List[str], role: str, group: int = None) -> AsyncProcess:
+        if proxy_bin is None:
+            raise Exception("Platform not support: " + sys.platform)
+        with metrics.spawn_seconds.labels(role).time() as _:
+            return self.process_loop.run_coroutine(self.process_loop.spawn(command, group))
+
+    def start_bridge(self, bridge_port: int, group: int = None) -> AsyncProcess:
+        return self.__spawn(_bridge_command(bridge_port), "bridge", group)
+
+    def start_server(
+            self, bridge_port: int, expose_port: int, innet_port: int, key: str = None, group: int = None
+    ) -> AsyncProcess:
+        return self.__spawn(_server_command(bridge_port, expose_port, innet_port, key), "server", group)
@@ -0,0 +1,65 @@
+"""
+Interface of the programs running the bridge and server of tunnels
+"""
+import os
+import sys
+from typing import Iterable, Optional
+
+
+def process_group_options(group: int = None) -> dict:
+    """
+    Popen options putting the child into a process group of manager's session
+    :param group: process group to join, None for a new group led by the child
+    :return:
+    """
+    if sys.version_info >= (3, 11):
+        return {"process_group": group or 0}
+    return {"preexec_fn": lambda: os.setpgid(0, group or 0)}
+
+
+def joinable_group(processes: Iterable) -> Optional[int]:
+    """
+    Process group of the living processes which a new child can join
+    Processes adopted from last run of manager are in another session, their groups can't be joined.
+    :param processes:
+    :return: None if there isn't one
+    """
+    for process in processes:
+        if process.pid is None or process.poll() is not None:
+            continue
+        try:
+            if os.getsid(process.pid) == os.getsid(0):
+                return os.getpgid(process.pid)
+        except OSError:
+            continue
+    return None
+
+
+class TunnelBackend:
+    """
+    Start the bridge and server of a tunnel, the returned object works like Popen:
+    `pid` (None if it's not an OS process), `args`, `returncode`, `poll`, `wait`, `send_signal`, `terminate`, `kill`
+    OS processes are put into the process group given, so the processes of a tunnel are signaled together.
+    """
+    name = ""
+
+    def start_bridge(self, bridge_port: int, group: int = None):
+        """
+        Start a bridge which the agents connect to
+        :param bridge_port:
+        :param group: process group to join, None for a new group
+        :return:
+        """
+        raise NotImplementedError()
+
+    def start_server(self, bridge_port: int, expose_port: int, innet_port: int, key: str = None, group: int = None):
+        """
+        Start a reverse server exposing the innet port of agent through the bridge
+        :param bridge_port:
+        :param expose_port:
+        :param innet_port: port on agent side
+        :param key: client key to select the agent on bridge
+        :param group: process group to join, None for a new group
+        :return:
+        """
+        raise NotImplementedError()
@@ -0,0 +1,127 @@
+"""
+Versioned log of tunnel changes
+"""
+import asyncio
+import time
+from collections import deque
+from threading import Condition
+from typing import List, Optional, Set, Tuple
+
+CREATE = "create"
+REMOVE = "remove"
+EXPIRE = "expire"
+HEARTBEAT = "heartbeat"
+
+
+class EventLog:
+    def __init__(self, capacity: int = 10000):
+        """
+        Keep the latest events in memory, each event gets a version increased by 1
+        :param capacity: count of events to keep, older consumers have to reload the whole list
+        """
+        self.__events = deque(maxlen=capacity)
+        self.__version = 0
+        # Versions restart from 0 in every run of manager, the epoch tells them apart
+        self.epoch = int(time.time() * 1000)
+        self.__condition = Condition()
+        # (loop, event) of the coroutines in wait_async
+        self.__wakers: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+
+    @property
+    def version(self) -> int:
+        return self.__version
+
+    def append(self, event_type: str, tid: int, data: dict = None) -> int:
+        """
+        Append an event and wake up the waiting consumers
+        :param event_type: CREATE/REMOVE/EXPIRE/HEARTBEAT
+        :param tid: tunnel id
+        :param data: tunnel information
+        :return: version of the event
+        """
+        with self.__condition:
+            self.__version += 1
+            self.__events.append({
+                "version": self.__version,
+                "type": event_type,
+                "id": tid,
+                "time": time.time(),
+                "data": data,
+            })
+            self.__condition.notify_all()
+            for loop, event in self.__wakers:
+                if not loop.is_closed():
+                    loop.call_soon_threadsafe(event.set)
+            return self.__version
+
+    def cursor(self, version: int) -> str:
+        """
+        Version qualified by epoch, given to consumers to continue from
+        :param version:
+        :return:
+        """
+        return "{}-{}".format(self.epoch, version)
+
+    def version_of(self, cursor: str) -> Optional[int]:
+        """
+        Version of the cursor from consumer
+        :param cursor:
+        :return: None if the cursor is from another run of manager or malformed
+        """
+        epoch, _, version = str(cursor).partition("-")
+        if epoch != str(self.epoch) or not version.isdigit():
+            return None
+        return int(version)
+
+    def since(self, version: Optional[int]) -> Tuple[List[dict], bool]:
+        """
+        Events after version
+        :param version: version of cursor, None if the cursor is from another run of manager
+        :return: (events, reset), reset is True if some events after version are dropped already,
+        or the version is None
+        """
+        with self.__condition:
+            return self.__since(version)
+
+    def __since(self, version: Optional[int]) -> Tuple[List[dict], bool]:
+        if version is None:
+            return [], True
+        if version == self.__version:
+            return [], False
+        if version > self.__version or not self.__events or self.__events[0]["version"] > version + 1:
+            return [], True
+        # Versions in deque are continuous
+        start = len(self.__events) - (self.__version - version)
+        return [self.__events[i] for i in range(start, len(self.__events))], False
+
+    def wait(self, version: Optional[int], timeout: float) -> Tuple[List[dict], bool]:
+        """
+        Block until there are events after version or timeout
+        :param version:
+        :param timeout: seconds
+        :return: same as since
+        """
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__version != version, timeout)
+            return self.__since(version)
+
+    async def wait_async(self, version: Optional[int], timeout: float) -> Tuple[List[dict], bool]:
+        """
+        Same as wait, in an event loop
+        :param version:
+        :param timeout: seconds
+        :return: same as since
+        """
+        waker = (asyncio.get_running_loop(), asyncio.Event())
+        with self.__condition:
+            if self.__version != version:
+                return self.__since(version)
+            self.__wakers.add(waker)
+        try:
+            await asyncio.wait_for(waker[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.__condition:
+                self.__wakers.discard(waker)
+        return self.since(version)
@@ -0,0 +1,116 @@
+"""
+Deadline ordered expiry scheduler
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from threading import Condition
+from typing import Hashable, List, Optional, Set, Tuple
+
+
+class ExpiryScheduler:
+    def __init__(self):
+        """
+        A min-heap of (deadline, key) entries
+        Entries are invalidated lazily: pushing a deadline forward (heartbeat) never touches the heap,
+        the owner re-checks the real deadline of a popped key and pushes it again if it's not due yet.
+        """
+        self.__heap = []
+        self.__counter = itertools.count()
+        self.__condition = Condition()
+        # (loop, event) of the coroutines in wait_async
+        self.__wakers: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+
+    def __len__(self):
+        return len(self.__heap)
+
+    def push(self, key: Hashable, deadline: float):
+        """
+        Schedule key at deadline, wake up the waiter if it becomes the earliest one
+        :param key:
+        :param deadline: timestamp in time.time() scale
+        :return:
+        """
+        with self.__condition:
+            heapq.heappush(self.__heap, (deadline, next(self.__counter), key))
+            if self.__heap[0][0] >= deadline:
+                self.__notify()
+
+    def next_deadline(self) -> Optional[float]:
+        """
+        Earliest deadline in the heap, None if empty
+        :return:
+        """
+        with self.__condition:
+            return self.__heap[0][0] if self.__heap else None
+
+    def pop_due(self, now: float = None) -> List[Tuple[float, Hashable]]:
+        """
+        Pop all the entries which deadline has been reached
+        :param now: current time, time.time() by default
+        :return: list of (deadline, key)
+        """
+        if now is None:
+            now = time.time()
+        due = []
+        with self.__condition:
+            while self.__heap and self.__heap[0][0] <= now:
+                deadline, _, key = heapq.heappop(self.__heap)
+                due.append((deadline, key))
+        return due
+
+    def wait(self, max_wait: float = None):
+        """
+        Block until the earliest deadline reached, a new earlier deadline pushed or wake() called
+        :param max_wait: upper bound of sleeping time, None for unlimited
+        :return:
+        """
+        with self.__condition:
+            timeout = max_wait
+            if self.__heap:
+                until_next = max(self.__heap[0][0] - time.time(), 0)
+                timeout = until_next if timeout is None else min(timeout, until_next)
+            if timeout is None or timeout > 0:
+                self.__condition.wait(timeout)
+
+    async def wait_async(self, max_wait: float = None):
+        """
+        Same as wait, in an event loop
+        :param max_wait: upper bound of sleeping time, None for unlimited
+        :return:
+        """
+        waker = (asyncio.get_running_loop(), asyncio.Event())
+        with self.__condition:
+            timeout = max_wait
+            if self.__heap:
+                until_next = max(self.__heap[0][0] - time.time(), 0)
+                timeout = until_next if timeout is None else min(timeout, until_next)
+            if timeout is not None and timeout <= 0:
+                return
+            self.__wakers.add(waker)
+        try:
+            await asyncio.wait_for(waker[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.__condition:
+                self.__wakers.discard(waker)
+
+    def __notify(self):
+        """
+        Wake up the waiters in threads and event loops, called with condition held
+        :return:
+        """
+        self.__condition.notify_all()
+        for loop, event in self.__wakers:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(event.set)
+
+    def wake(self):
+        """
+        Wake up the waiting thread or coroutine
+        :return:
+        """
+        with self.__condition:
+            self.__notify()
@@ -1,18 +1,32 @@
 """
 A wrapper of goproxy
 """
+import asyncio
 import json
 import logging
+import secrets
 import socket
 import time
-import traceback
 from os import getcwd
 from os.path import join
 from platform import platform
-from subprocess import Popen, TimeoutExpired
-from threading import Lock, Thread
-from typing import Dict, List
-from util import MutexLock
+from subprocess import Popen
+from collections import deque
+from threading import Event, Lock, Thread
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING, Union
+
+from util import events, metrics, supervisor
+from util.backend import TunnelBackend, joinable_group, process_group_options
+from util.expiry import ExpiryScheduler
+from util.lock import MutexLock
+from util.ports import PortAllocator, probe_listening, wait_listening
+from util.reaper import ProcessReaper, terminate_processes
+
+if TYPE_CHECKING:
+    from util.lazy import LazyActivator
+    from util.lease import Lease, LeaseRegistry
+    from util.registry import TunnelRegistry
+    from util.supervisor import ProcessSupervisor
 
 log = logging.getLogger(__file__)
 
@@ -23,7 +37,8 @@ elif platform().startswith("Linux"):
 else:
     # fixme Add win platform here
     # fixme Identify the arch of PC/Server
-    raise Exception("Platform not support: " + platform())
+    # Other backends still work
+    proxy_bin = None
 
 
 def _expand_parameters(parameters: dict) -> list:
@@ -56,6 +71,306 @@ def apply_ports(port_count: int):
     return port_list
 
 
+def _bridge_command(bridge_port: int) -> list:
+    return [proxy_bin, "bridge", "--forever"] + _expand_parameters({
+        "-C": "certification/proxy.crt",
+        "-K": "certification/proxy.key",
+        "-p": ":{}".format(bridge_port)
+    })
+
+
+def _server_command(bridge_port: int, expose_port: int, innet_port: int, key: str = None) -> list:
+    parameters = {
+        "-C": "certification/proxy.crt",
+        "-K": "certification/proxy.key",
+        "-P": "127.0.0.1:{}".format(bridge_port),
+        "-r": ":{}@:{}".format(expose_port, innet_port)
+    }
+    if key is not None:
+        # Client key, to multiplex tunnels on one bridge
+        parameters["--k"] = key
+    return [proxy_bin, "server", "--forever"] + _expand_parameters(parameters)
+
+
+def _spawn(command: list, role: str, group: int = None) -> Popen:
+    """
+    Start a goproxy process in a process group
+    :param command:
+    :param role: bridge or server, for metrics
+    :param group: process group to join, None for a new group
+    :return:
+    """
+    if proxy_bin is None:
+        raise Exception("Platform not support: " + platform())
+    with metrics.spawn_seconds.labels(role).time() as _:
+        return Popen(command, **process_group_options(group))
+
+
+class GoproxyBackend(TunnelBackend):
+    """
+    Run bridge and server by goproxy processes
+    """
+    name = "goproxy"
+
+    def start_bridge(self, bridge_port: int, group: int = None) -> Popen:
+        return _spawn(_bridge_command(bridge_port), "bridge", group)
+
+    def start_server(
+            self, bridge_port: int, expose_port: int, innet_port: int, key: str = None, group: int = None
+    ) -> Popen:
+        return _spawn(_server_command(bridge_port, expose_port, innet_port, key), "server", group)
+
+
+goproxy_backend = GoproxyBackend()
+
+
+class _SharedBridge:
+    def __init__(self, port: int, backend: TunnelBackend = goproxy_backend):
+        self.port = port
+        self.backend = backend
+        self.process: Optional[Popen] = None
+        self.tunnel_count = 0
+
+    def start(self):
+        log.info("Starting shared bridge server at port: {}".format(self.port))
+        self.process = self.backend.start_bridge(self.port)
+        log.info("Shared bridge started in PID: {}".format(self.process.pid))
+
+    @property
+    def json(self):
+        return {
+            "port": self.port,
+            "pid": self.process.pid if self.process is not None else None,
+            "tunnel_count": self.tunnel_count,
+        }
+
+
+class SharedBridgePool:
+    def __init__(self, size: int, port_allocator: PortAllocator = None, backend: TunnelBackend = goproxy_backend):
+        """
+        A fixed pool of long-lived bridge processes shared by tunnels
+        Tunnels on the same bridge are multiplexed by key (--k of goproxy)
+        :param size: count of bridge processes
+        :param port_allocator: allocate bridge ports by it if set, else apply random ports from OS
+        :param backend: program running the bridges
+        """
+        self.size = size
+        self.port_allocator = port_allocator
+        self.backend = backend
+        self.__lock = Lock()
+        self.__bridges: List[_SharedBridge] = []
+
+    def __start_bridges(self):
+        if self.port_allocator is None:
+            ports = apply_ports(self.size)
+        else:
+            ports = [self.port_allocator.allocate(PortAllocator.BRIDGE) for _ in range(self.size)]
+        self.__bridges = [_SharedBridge(port, self.backend) for port in ports]
+        for bridge in self.__bridges:
+            bridge.start()
+
+    def adopt(self, bridges: List[Tuple[int, Optional[Popen]]]):
+        """
+        Take over the bridges survived from last run of manager, dead ones are restarted
+        :param bridges: list of (port, process), process is None if it's dead
+        :return:
+        """
+        with MutexLock(self.__lock) as _:
+            for port, process in bridges:
+                if self.port_allocator is not None:
+                    self.port_allocator.claim(port)
+                    self.port_allocator.confirm(port)
+                bridge = _SharedBridge(port, self.backend)
+                if process is None:
+                    bridge.start()
+                else:
+                    bridge.process = process
+                self.__bridges.append(bridge)
+
+    def acquire(self, port: int = None) -> _SharedBridge:
+        """
+        Assign the least loaded bridge to a tunnel, bridges are started at the first call
+        :param port: assign the bridge at this port
+        :return:
+        """
+        with MutexLock(self.__lock) as _:
+            if len(self.__bridges) <= 0:
+                self.__start_bridges()
+            if port is None:
+                bridge = min(self.__bridges, key=lambda b: b.tunnel_count)
+            else:
+                bridge = next((b for b in self.__bridges if b.port == port), None)
+                if bridge is None:
+                    raise ValueError("Shared bridge at port {} not found".format(port))
+            if bridge.process.poll() is not None:
+                log.warning("Shared bridge at port {} exited with code {}, restarting.".format(
+                    bridge.port, bridge.process.returncode
+                ))
+                bridge.start()
+            bridge.tunnel_count += 1
+            return bridge
+
+    def release(self, bridge: _SharedBridge):
+        with MutexLock(self.__lock) as _:
+            bridge.tunnel_count -= 1
+
+    @property
+    def processes(self) -> List[Popen]:
+        return [b.process for b in self.__bridges if b.process is not None]
+
+    @property
+    def bridges(self) -> List[_SharedBridge]:
+        return list(self.__bridges)
+
+    def stop(self, reaper: ProcessReaper = None):
+        """
+        Stop all the bridge processes
+        :param reaper: if set, processes are submitted to it instead of waiting for them here
+        :return:
+        """
+        with MutexLock(self.__lock) as _:
+            bridges, self.__bridges = self.__bridges, []
+        processes = [bridge.process for bridge in bridges]
+
+        def release():
+            if self.port_allocator is not None:
+                for bridge in bridges:
+                    self.port_allocator.release(bridge.port)
+
+        if reaper is not None:
+            reaper.submit("shared bridges", processes, release)
+        else:
+            terminate_processes(processes)
+            release()
+
+    @property
+    def json(self):
+        return [bridge.json for bridge in self.__bridges]
+
+
+class BridgeWarmPool(Thread):
+    def __init__(
+            self,
+            size: int,
+            port_allocator: PortAllocator = None,
+            refill_interval: float = 0.1,
+            backend: TunnelBackend = goproxy_backend
+    ):
+        """
+        Keep some bridge processes started and listening, the tunnels created take one instead of spawning
+        :param size: count of idle bridges to keep
+        :param port_allocator: allocate bridge ports by it if set, else apply random ports from OS
+        :param refill_interval: seconds between starting two bridges while refilling
+        :param backend: program running the bridges
+        """
+        super(BridgeWarmPool, self).__init__()
+        self.size = size
+        self.port_allocator = port_allocator
+        self.backend = backend
+        self.refill_interval = refill_interval
+        self.is_stop = False
+        self.daemon = True
+        self.hit_count = 0
+        self.miss_count = 0
+        self.__lock = Lock()
+        self.__idle = deque()
+        self.__starting: Optional[Tuple[int, Popen]] = None
+        self.__refill_event = Event()
+
+    def claim(self) -> Optional[Tuple[int, Popen]]:
+        """
+        Take an idle bridge
+        :return: (port, process), None if pool is empty
+        """
+        with MutexLock(self.__lock) as _:
+            slot = None
+            while self.__idle:
+                port, process = self.__idle.popleft()
+                if process.poll() is None:
+                    slot = (port, process)
+                    break
+                log.warning("Idle bridge at port {} exited with code {}.".format(port, process.returncode))
+                if self.port_allocator is not None:
+                    self.port_allocator.release(port)
+            if slot is None:
+                self.miss_count += 1
+            else:
+                self.hit_count += 1
+        self.__refill_event.set()
+        return slot
+
+    def __start_bridge(self):
+        if self.port_allocator is None:
+            port = apply_ports(1)[0]
+        else:
+            port = self.port_allocator.allocate(PortAllocator.BRIDGE)
+        with MutexLock(self.__lock) as _:
+            # Tracked to be terminated if pool stopped before it's listening
+            process = self.backend.start_bridge(port)
+            self.__starting = (port, process)
+        if port in wait_listening([port], timeout=10):
+            if self.port_allocator is not None:
+                self.port_allocator.confirm(port)
+            with MutexLock(self.__lock) as _:
+                self.__starting = None
+                if not self.is_stop:
+                    self.__idle.append((port, process))
+                    return
+        else:
+            log.warning("Warm bridge at port {} is not listening, dropped.".format(port))
+            with MutexLock(self.__lock) as _:
+                self.__starting = None
+        terminate_processes([process])
+        if self.port_allocator is not None:
+            self.port_allocator.release(port)
+
+    def run(self) -> None:
+        while not self.is_stop:
+            self.__refill_event.clear()
+            while not self.is_stop and len(self.__idle) < self.size:
+                try:
+                    self.__start_bridge()
+                except Exception as ex:
+                    log.error("Error while starting warm bridge.", exc_info=ex)
+                time.sleep(self.refill_interval)
+            self.__refill_event.wait()
+
+    def stop(self, reaper: ProcessReaper = None):
+        """
+        Stop refilling and terminate the idle bridges
+        :param reaper: if set, processes are submitted to it instead of waiting for them here
+        :return:
+        """
+        self.is_stop = True
+        self.__refill_event.set()
+        with MutexLock(self.__lock) as _:
+            idle, self.__idle = self.__idle, deque()
+            if self.__starting is not None:
+                # Still waiting for it listening
+                idle.append(self.__starting)
+
+        def release():
+            if self.port_allocator is not None:
+                for port, _ in idle:
+                    self.port_allocator.release(port)
+
+        if reaper is not None:
+            reaper.submit("warm bridges", [process for _, process in idle], release)
+        else:
+            terminate_processes(process for _, process in idle)
+            release()
+
+    @property
+    def json(self):
+        return {
+            "size": self.size,
+            "idle": len(self.__idle),
+            "refill_interval": self.refill_interval,
+            "hit": self.hit_count,
+            "miss": self.miss_count,
+        }
+
+
 class ExposeConfig:
     def __init__(
             self,
@@ -74,13 +389,49 @@ class ExposeConfig:
 
 
 class MultiTunnel:
+    # What resets the last check time
+    HEARTBEAT = "heartbeat"
+    TRAFFIC = "traffic"
+    BOTH = "both"
+
     def __init__(
             self,
             exposes: List[ExposeConfig],
             bridge_port: int = None,
             comment: str = "",
-            expired: float = 60
+            expired: float = 60,
+            port_allocator: PortAllocator = None,
+            bridge_pool: SharedBridgePool = None,
+            key: str = None,
+            warm_pool: BridgeWarmPool = None,
+            config: dict = None,
+            liveness: str = HEARTBEAT,
+            lazy_activator: "LazyActivator" = None,
+            backend: TunnelBackend = goproxy_backend,
+            process_supervisor: "ProcessSupervisor" = None,
+            lease: "Lease" = None
     ):
+        """
+        Manage the bridge and server processes of a tunnel
+        :param exposes: expose configurations
+        :param bridge_port: bridge port, allocated if None
+        :param comment:
+        :param expired: heartbeat timeout in seconds, negative for permanent
+        :param port_allocator: allocate and reserve ports by it if set, else apply random ports from OS
+        :param bridge_pool: use a shared bridge from pool if set and bridge port is not pinned
+        :param key: client key on shared bridge, generated if None
+        :param warm_pool: take a started bridge from warm pool if set and bridge port is not pinned
+        :param config: the original configuration this tunnel created from
+        :param liveness: HEARTBEAT/TRAFFIC/BOTH, in traffic mode the connections observed by TrafficSampler
+        count as checks, and `expired` becomes the idle timeout
+        :param lazy_activator: if set, server processes are started on the first connection to expose ports,
+        and stopped after idle
+        :param backend: program running the bridge and servers
+        :param process_supervisor: if set, the crashed processes are restarted by it
+        :param lease: if set, the tunnel expires with the lease instead of its own `expired`
+        """
+        if liveness not in (MultiTunnel.HEARTBEAT, MultiTunnel.TRAFFIC, MultiTunnel.BOTH):
+            raise ValueError("Unknown liveness mode: {}".format(liveness))
         self.exposes = exposes
         if len(exposes) <= 0:
             log.warning("Do not have expose configuration, only bridge created.")
@@ -90,13 +441,49 @@ class MultiTunnel:
         self.expire_time = expired
         self.bridge_process = None
         self.client_processes = []
+        self.port_allocator = port_allocator
+        self.__reserved_ports = []
+        self.bridge_pool = bridge_pool
+        self.shared_bridge: Optional[_SharedBridge] = None
+        self.key = key
+        self.warm_pool = warm_pool
+        self.config = config
+        self.liveness = liveness
+        self.lazy_activator = lazy_activator
+        self.backend = backend
+        # Lazy tunnel without server processes, expose ports are held by lazy activator
+        self.dormant = False
+        self.stopped = False
+        self.__process_lock = Lock()
+        self.process_supervisor = process_supervisor
+        self.lease = lease
+        self.state = supervisor.STARTING
+        # Unexpected exits, recorded by supervisor
+        self.exits = deque(maxlen=10)
+        self.restart_times = deque()
+        self.restart_count = 0
+        # Seconds from start till each port listening, None for the ports not listening yet
+        self.readiness: Dict[int, Optional[float]] = dict()
+        self.__probed = Event()
+        # Set by TrafficSampler
+        self.traffic: Optional[dict] = None
 
     def check(self):
         """
-        Reset last check time
+        Reset last check time, the lease is renewed as well
         :return:
         """
         self.last_check_time = time.time()
+        if self.lease is not None:
+            self.lease.check()
+
+    @property
+    def heartbeat_liveness(self) -> bool:
+        return self.liveness in (MultiTunnel.HEARTBEAT, MultiTunnel.BOTH)
+
+    @property
+    def traffic_liveness(self) -> bool:
+        return self.liveness in (MultiTunnel.TRAFFIC, MultiTunnel.BOTH)
 
     @property
     def valid(self):
@@ -105,13 +492,27 @@ class MultiTunnel:
         :param timeout:
         :return:
         """
+        if self.lease is not None:
+            return self.lease.valid
         if self.expire_time >= 0:
             return (time.time() - self.last_check_time) < self.expire_time
         else:
             return True
 
-    def start(self):
-        # Apply ports
+    @property
+    def deadline(self) -> Optional[float]:
+        """
+        The time this tunnel expires at, None if it's permanent
+        :return:
+        """
+        if self.lease is not None:
+            return self.lease.deadline
+        if self.expire_time >= 0:
+            return self.last_check_time + self.expire_time
+        else:
+            return None
+
+    def __apply_ports(self):
         port_need_to_apply = 0
         if self.bridge_port is None:
             port_need_to_apply += 1
@@ -125,52 +526,312 @@ class MultiTunnel:
             if expose_config.expose_port is None:
                 expose_config.expose_port = ports.pop(0)
 
-        log.info("Starting bridge server at port: {}".format(self.bridge_port))
-        self.bridge_process = Popen(
-            [proxy_bin, "bridge", "--forever"] + _expand_parameters({
-                "-C": "certification/proxy.crt",
-                "-K": "certification/proxy.key",
-                "-p": ":{}".format(self.bridge_port)
-            })
-        )
-        log.info("Bridge started in PID: {}".format(self.bridge_process.pid))
-
+    def __wanted_ports(self) -> List[Union[int, str]]:
+        wanted = []
+        if self.shared_bridge is not None:
+            # Owned by bridge pool
+            pass
+        elif self.bridge_process is not None:
+            # Taken from warm pool, reserved and confirmed already
+            pass
+        elif self.bridge_port is None:
+            wanted.append(PortAllocator.BRIDGE)
+        else:
+            wanted.append(self.bridge_port)
         for expose_config in self.exposes:
+            wanted.append(PortAllocator.EXPOSE if expose_config.expose_port is None else expose_config.expose_port)
+        return wanted
+
+    def __assign_ports(self, reserved: List[int]):
+        reserved = list(reserved)
+        if self.shared_bridge is None and self.bridge_process is None:
+            self.bridge_port = reserved[0]
+        for expose_config, port in zip(self.exposes, reserved[len(reserved) - len(self.exposes):]):
+            expose_config.expose_port = port
+        if self.shared_bridge is None and self.bridge_process is not None:
+            reserved.insert(0, self.bridge_port)
+        self.__reserved_ports = reserved
+
+    def __reserve_ports(self):
+        """
+        Allocate the missing ports and claim the pinned ones, all or nothing
+        :return:
+        """
+        self.__assign_ports(self.port_allocator.reserve(self.__wanted_ports()))
+
+    def __confirm_ports(self, timeout: float = 10):
+        """
+        Keep the ports reserved until goproxy listening on them in background, stop probing once any process exited
+        :param timeout:
+        :return:
+        """
+        if self.port_allocator is None:
+            ports = [self.bridge_port] if self.shared_bridge is None else []
+            ports += [expose_config.expose_port for expose_config in self.exposes]
+        else:
+            ports = list(self.__reserved_ports)
+        readiness = dict()
+        if self.dormant:
+            # Listened by lazy activator, a probe would activate the tunnel
+            dormant_ports = {expose_config.expose_port for expose_config in self.exposes}
+            if self.port_allocator is not None:
+                for port in dormant_ports:
+                    self.port_allocator.confirm(port)
+            ports = [port for port in ports if port not in dormant_ports]
+            readiness.update((port, 0.0) for port in dormant_ports)
+        readiness.update((port, None) for port in ports)
+        probed = Event()
+        self.readiness, self.__probed = readiness, probed
+
+        def on_ready(port: int, seconds: float):
+            readiness[port] = seconds
+            if port in self.__reserved_ports:
+                self.port_allocator.confirm(port)
+
+        def probe():
+            start = time.time()
+            try:
+                ready = probe_listening(
+                    ports, timeout, on_ready=on_ready,
+                    abort=lambda: self.stopped or any(p.poll() is not None for p in self.processes)
+                )
+                for port in ports:
+                    if port not in ready and not self.stopped:
+                        log.warning("Port {} is not listening after {:.2f} seconds.".format(port, time.time() - start))
+                if self.state == supervisor.STARTING:
+                    self.state = supervisor.RUNNING if len(ready) >= len(ports) else supervisor.DEGRADED
+            finally:
+                probed.set()
+
+        Thread(target=probe, daemon=True).start()
+
+    def wait_ready(self, timeout: float) -> bool:
+        """
+        Wait until all the ports of tunnel listening, returns early if any process exited
+        :param timeout: seconds
+        :return: if all the ports are listening, see `readiness` for the seconds each port took
+        """
+        self.__probed.wait(timeout)
+        return all(seconds is not None for seconds in self.readiness.values())
+
+    def __release_ports(self):
+        reserved, self.__reserved_ports = self.__reserved_ports, []
+        for port in reserved:
+            self.port_allocator.release(port)
+        shared_bridge, self.shared_bridge = self.shared_bridge, None
+        if shared_bridge is not None:
+            self.bridge_pool.release(shared_bridge)
+
+    def __take_bridge(self):
+        if self.bridge_pool is not None and self.bridge_port is None:
+            self.shared_bridge = self.bridge_pool.acquire()
+            self.bridge_port = self.shared_bridge.port
+            if self.key is None:
+                self.key = secrets.token_hex(8)
+        elif self.warm_pool is not None and self.bridge_port is None:
+            slot = self.warm_pool.claim()
+            if slot is not None:
+                self.bridge_port, self.bridge_process = slot
+
+    def prepare(self) -> List[Union[int, str]]:
+        """
+        Take the shared or warm bridge, and tell the ports to reserve before `start`
+        Used to reserve the ports of many tunnels together by `PortAllocator.reserve_many`, the prepared tunnel
+        should be started with the reserved ports or stopped
+        :return: pinned port, or PortAllocator.BRIDGE/PortAllocator.EXPOSE to allocate
+        """
+        self.__take_bridge()
+        return self.__wanted_ports()
+
+    def start(self, ready_timeout: float = 10, reserved: List[int] = None):
+        """
+        Start the processes, ports are probed in background, see `wait_ready`
+        :param ready_timeout: seconds to probe the ports
+        :param reserved: ports reserved for `prepare` already, aligned with the ports it returned
+        :return:
+        """
+        if reserved is None:
+            self.__take_bridge()
+        try:
+            if self.port_allocator is None:
+                self.__apply_ports()
+            elif reserved is None:
+                self.__reserve_ports()
+            else:
+                self.__assign_ports(reserved)
+            self.dormant = self.lazy_activator is not None
+            self.__start_processes()
+            if self.lazy_activator is not None:
+                self.lazy_activator.register(self)
+        except Exception:
+            self.stop(name="failed tunnel")
+            raise
+        self.__confirm_ports(ready_timeout)
+
+    def __start_processes(self):
+        # All the processes of the tunnel in one group, the first one started leads it
+        group = joinable_group(self.processes)
+        if self.bridge_process is not None:
+            log.info("Using warm bridge at port: {}".format(self.bridge_port))
+        elif self.shared_bridge is None:
+            log.info("Starting bridge server at port: {}".format(self.bridge_port))
+            self.bridge_process = self.backend.start_bridge(self.bridge_port, group)
+            log.info("Bridge started in PID: {}".format(self.bridge_process.pid))
+            group = joinable_group([self.bridge_process]) if group is None else group
+        else:
+            log.info("Using shared bridge at port: {}".format(self.bridge_port))
+
+        # Aligned with exposes, None for the processes to start
+        self.client_processes += [None] * (len(self.exposes) - len(self.client_processes))
+        if self.dormant:
+            log.info("Lazy tunnel is dormant, server processes will start on the first connection.")
+        for i, expose_config in enumerate(self.exposes):
+            if self.dormant:
+                break
+            if self.client_processes[i] is not None:
+                continue
             log.info("Starting client server at port: {}".format(self.bridge_port))
-            client_process = Popen(
-                [proxy_bin, "server", "--forever"] + _expand_parameters({
-                    "-C": "certification/proxy.crt",
-                    "-K": "certification/proxy.key",
-                    "-P": "127.0.0.1:{}".format(self.bridge_port),
-                    "-r": ":{}@:{}".format(expose_config.expose_port, expose_config.innet_port)
-                })
+            client_process = self.backend.start_server(
+                self.bridge_port,
+                expose_config.expose_port,
+                expose_config.innet_port,
+                self.key,
+                group
             )
-            self.client_processes.append(client_process)
+            self.client_processes[i] = client_process
+            if group is None:
+                group = joinable_group([client_process])
             log.info("Client started in PID: {}".format(client_process.pid))
+        if self.process_supervisor is not None:
+            for process in self.processes:
+                self.process_supervisor.watch(self, process)
+
+    def activate(self) -> bool:
+        """
+        Start the server processes of the dormant lazy tunnel
+        :return: False if it's not dormant or stopped already
+        """
+        with MutexLock(self.__process_lock) as _:
+            if self.stopped or not self.dormant:
+                return False
+            self.dormant = False
+            self.__start_processes()
+            return True
+
+    def deactivate(self) -> bool:
+        """
+        Stop the server processes of the lazy tunnel and make it dormant
+        :return: False if it's dormant or stopped already
+        """
+        with MutexLock(self.__process_lock) as _:
+            if self.stopped or self.dormant:
+                return False
+            processes = [p for p in self.client_processes if p is not None]
+            self.client_processes = [None] * len(self.exposes)
+            self.dormant = True
+        terminate_processes(processes)
+        return True
+
+    def owns(self, process) -> bool:
+        """
+        If the process is still one of the processes of this tunnel
+        :param process:
+        :return:
+        """
+        return any(p is process for p in self.processes)
 
-    @staticmethod
-    def __stop_process(process: Popen, timeout: float = 5):
+    @property
+    def forwarding(self) -> bool:
+        """
+        If the bridge and at least one server are alive
+        :return:
+        """
+        if self.bridge_process is not None and self.bridge_process.poll() is not None:
+            return False
+        return any(p is not None and p.poll() is None for p in self.client_processes)
+
+    def restart(self) -> bool:
+        """
+        Start the exited processes again, the living ones are kept
+        :return: False if it's stopped already
+        """
+        with MutexLock(self.__process_lock) as _:
+            if self.stopped:
+                return False
+            if self.bridge_process is not None and self.bridge_process.poll() is not None:
+                log.info("Restarting bridge at port {}, exited with code {}.".format(
+                    self.bridge_port, self.bridge_process.returncode
+                ))
+                self.bridge_process = None
+            for i, process in enumerate(self.client_processes):
+                if process is not None and process.poll() is not None:
+                    log.info("Restarting client server at port {}, exited with code {}.".format(
+                        self.exposes[i].expose_port, process.returncode
+                    ))
+                    self.client_processes[i] = None
+            self.state = supervisor.STARTING
+            self.__start_processes()
+        self.__confirm_ports()
+        return True
+
+    @property
+    def processes(self) -> List[Popen]:
+        """
+        All the living goproxy processes of this tunnel
+        :return:
+        """
+        return [p for p in self.client_processes + [self.bridge_process] if p is not None]
+
+    def resume(self, bridge_process=None, client_processes: List = (), shared: bool = False):
+        """
+        Start with the processes survived from last run of manager, only the missing ones are started
+        :param bridge_process: the bridge process, None if it's missing
+        :param client_processes: server processes aligned with exposes, None for the missing ones
+        :param shared: the bridge port is a shared bridge in bridge pool
+        :return:
+        """
+        if shared:
+            self.shared_bridge = self.bridge_pool.acquire(self.bridge_port)
         try:
-            pid = process.pid
-            process.terminate()
-            try:
-                process.wait(timeout=timeout)
-            except TimeoutExpired:
-                process.kill()
-                print("Kill {}".format(pid))
-        except:
-            log.error("Other exception caughted during stopping PID {} caused by {}.".format(
-                process.pid,
-                traceback.format_exc()
-            ))
+            if self.port_allocator is not None:
+                # All the ports are pinned
+                self.__reserve_ports()
+            self.bridge_process = bridge_process
+            self.client_processes = list(client_processes)
+            # Dormant lazy tunnel has no server process
+            self.dormant = self.lazy_activator is not None and all(p is None for p in self.client_processes)
+            self.__start_processes()
+            if self.lazy_activator is not None:
+                self.lazy_activator.register(self)
+        except Exception:
+            self.stop(name="failed tunnel")
+            raise
+        self.__confirm_ports()
 
-    def stop(self):
-        log.info("Stopping the client process...")
-        for client_process in self.client_processes:
-            log.info("Stopping the PID: {}".format(client_process.pid))
-            self.__stop_process(client_process)
-        log.info("Stopping the bridge process...")
-        self.__stop_process(self.bridge_process)
+    def stop(self, reaper: ProcessReaper = None, name: str = "tunnel"):
+        """
+        Stop all the processes
+        :param reaper: if set, processes are queued to reaper and this method returns immediately
+        :param name: name of the tunnel for logging
+        :return:
+        """
+        with MutexLock(self.__process_lock) as _:
+            self.stopped = True
+        if reaper is not None:
+            # Ports are released after processes exited
+            if self.lazy_activator is not None:
+                # Queued after the listeners closed in activator thread, never blocks the caller
+                self.lazy_activator.unregister(
+                    self, lambda: reaper.submit(name, self.processes, self.__release_ports)
+                )
+            else:
+                reaper.submit(name, self.processes, self.__release_ports)
+        else:
+            if self.lazy_activator is not None:
+                self.lazy_activator.unregister(self)
+            log.info("Stopping the processes of {}...".format(name))
+            terminate_processes(self.processes)
+            self.__release_ports()
         return self
 
     @property
@@ -184,10 +845,20 @@ class MultiTunnel:
             "exposes": [
                 expose.json for expose in self.exposes
             ],
+            "shared_bridge": self.bridge_pool is not None and self.bridge_process is None,
+            "key": self.key,
             "comment": self.comment,
             "expire_time": self.expire_time,
+            "lease": self.lease.id if self.lease is not None else None,
+            "liveness": self.liveness,
+            "lazy": self.lazy_activator is not None,
+            "dormant": self.dormant,
+            "state": self.state,
+            "restarts": self.restart_count,
+            "exits": list(self.exits),
             "last_check_time": self.last_check_time,
-            "from_last_check": time.time() - self.last_check_time
+            "from_last_check": time.time() - self.last_check_time,
+            "traffic": self.traffic
         }
 
 
@@ -218,31 +889,136 @@ class Tunnel(MultiTunnel):
 
 
 class TunnelsCheckThread(Thread):
-    def __init__(self, tunnels: Dict[int, MultiTunnel], op_lock: Lock, interval: float = 2):
+    def __init__(
+            self,
+            tunnels: "TunnelRegistry",
+            reaper: ProcessReaper = None,
+            interval: float = 60,
+            leases: "LeaseRegistry" = None
+    ):
         """
-        A thread to check invalid tunnels and shut them
-        :param tunnels: tunnels list
-        :param op_lock: operation lock
-        :param interval: interval between check
+        A thread to shut the invalid tunnels down when their deadline reached
+        Tunnels in a lease are not scheduled themselves, the lease is scheduled and its members expire together.
+        :param tunnels: tunnels registry
+        :param reaper: the expired tunnels are stopped by reaper if set
+        :param interval: max sleeping time while nothing is scheduled
+        :param leases: the expired leases are removed from it if set
         """
         super(TunnelsCheckThread, self).__init__()
         self.tunnels = tunnels
-        self.op_lock = op_lock
+        self.reaper = reaper
+        self.leases = leases
         self.is_stop = False
         self.interval = interval
+        self.scheduler = ExpiryScheduler()
         self.daemon = True
 
+    def watch(self, tid: int, tunnel: MultiTunnel):
+        """
+        Register the tunnel to expiry scheduler, permanent tunnels are ignored
+        :param tid: tunnel id
+        :param tunnel:
+        :return:
+        """
+        if tunnel.lease is not None:
+            self.watch_lease(tunnel.lease)
+            return
+        deadline = tunnel.deadline
+        if deadline is not None:
+            self.scheduler.push(tid, deadline)
+
+    def watch_lease(self, lease: "Lease"):
+        """
+        Register the lease to expiry scheduler once, permanent leases are ignored
+        :param lease:
+        :return:
+        """
+        deadline = lease.deadline
+        if deadline is not None and not lease.scheduled:
+            lease.scheduled = True
+            self.scheduler.push(lease, deadline)
+
+    def __expire_lease(self, lease: "Lease", now: float) -> List[Tuple[int, MultiTunnel]]:
+        """
+        Detach all the members of the expired lease in one batch
+        :param lease:
+        :param now:
+        :return: the detached tunnels
+        """
+        lease.scheduled = False
+        deadline = lease.deadline
+        if deadline is None:
+            return []
+        elif deadline > now:
+            # Renewed since it was scheduled
+            self.watch_lease(lease)
+            return []
+        if self.leases is not None:
+            self.leases.pop(lease.id)
+        lease.released = True
+        expired = self.tunnels.pop_many(lease.members.copy(), events.EXPIRE)
+        log.info("Lease {} expired, {} tunnels detached.".format(lease.id, len(expired)))
+        return list(expired.items())
+
+    def check_due(self):
+        """
+        Expire the tunnels and leases which deadline has been reached
+        :return:
+        """
+        due = self.scheduler.pop_due()
+        if len(due) <= 0:
+            return
+        log.debug("Checking {} due tunnels.".format(len(due)))
+        expired = []
+        now = time.time()
+        for _, tid in due:
+            if not isinstance(tid, int):
+                expired += self.__expire_lease(tid, now)
+                continue
+            tunnel = self.tunnels.get(tid)
+            if tunnel is None:
+                # Removed already
+                continue
+            deadline = tunnel.deadline
+            if deadline is None:
+                continue
+            elif deadline > now:
+                # Heartbeat pushed the deadline forward since it was scheduled
+                self.scheduler.push(tid, deadline)
+            else:
+                # Re-check in the shard lock in case heartbeat arrived just now
+                removed = self.tunnels.pop(tid, lambda t: not t.valid, events.EXPIRE)
+                if removed is not None:
+                    expired.append((tid, removed))
+                elif tid in self.tunnels:
+                    self.watch(tid, tunnel)
+        # Detached from registry already, stop them in background
+        for tid, tunnel in expired:
+            tunnel.stop(self.reaper, "tunnel {}".format(tid))
+            log.info("Tunnel {} closed caused by expired: {}".format(
+                tid,
+                json.dumps(tunnel.json)
+            ))
+
     def run(self) -> None:
         while not self.is_stop:
-            with MutexLock(self.op_lock) as _:
-                log.debug("Checking the tunnels status.")
-                for tid in [x for x, tunnel in self.tunnels.items() if not tunnel.valid]:
-                    tunnel = self.tunnels.pop(tid).stop()
-                    log.info("Tunnel {} closed caused by expired: {}".format(
-                        tid,
-                        json.dumps(tunnel.json)
-                    ))
-            time.sleep(self.interval)
+            self.scheduler.wait(self.interval)
+            self.check_due()
+
+    async def run_async(self):
+        """
+        Run as a task in an event loop instead of starting the thread
+        Without reaper stopping tunnels blocks, then it's done in the default executor.
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        while not self.is_stop:
+            await self.scheduler.wait_async(self.interval)
+            if self.reaper is not None:
+                self.check_due()
+            else:
+                await loop.run_in_executor(None, self.check_due)
 
     def stop(self):
         self.is_stop = True
+        self.scheduler.wake()
@@ -0,0 +1,280 @@
+"""
+Heartbeat paths for agents bypassing Django: a bare WSGI/ASGI route and a UDP listener with HMAC signed datagrams
+Usage of the UDP sender: python -m util.heartbeat -H host:port --id <tunnel id> --k <authorization key>
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import math
+import socket
+import struct
+import time
+from threading import Thread
+from typing import Callable, Iterable, Optional, Tuple, TYPE_CHECKING
+from urllib.parse import parse_qs
+
+if TYPE_CHECKING:
+    from util.registry import TunnelRegistry
+
+log = logging.getLogger(__file__)
+
+# Results of heartbeat
+OK = 0
+NOT_FOUND = 1
+# Checked by traffic only
+REFUSED = 2
+
+_VERSION = 1
+# Version, tunnel id, unix time in seconds, followed by truncated HMAC-SHA256
+_HEADER = struct.Struct("!BQI")
+_DIGEST_SIZE = 16
+PACKET_SIZE = _HEADER.size + _DIGEST_SIZE
+# Result, tunnel id
+_REPLY = struct.Struct("!BQ")
+
+
+def heartbeat(tunnels: "TunnelRegistry", tid: int) -> int:
+    """
+    Heartbeat the tunnel like `/api/heartbeat`
+    :param tunnels:
+    :param tid:
+    :return: OK, NOT_FOUND or REFUSED
+    """
+    tunnel = tunnels.get(tid)
+    if tunnel is None:
+        return NOT_FOUND
+    if not tunnel.heartbeat_liveness:
+        return REFUSED
+    return OK if tunnels.heartbeat(tid) else NOT_FOUND
+
+
+def _sign(header: bytes, key: str) -> bytes:
+    return hmac.new(key.encode(), header, hashlib.sha256).digest()[:_DIGEST_SIZE]
+
+
+def pack_heartbeat(tid: int, key: Optional[str], now: float = None) -> bytes:
+    """
+    Build the datagram of a heartbeat
+    :param tid: tunnel id
+    :param key: authorization key, None if authorization is disabled on manager
+    :param now: unix time, current time by default
+    :return:
+    """
+    header = _HEADER.pack(_VERSION, tid, int(time.time() if now is None else now))
+    return header + (_sign(header, key) if key is not None else bytes(_DIGEST_SIZE))
+
+
+class HeartbeatFastPath:
+    def __init__(self, application: Callable, tunnels: Callable[[], "TunnelRegistry"], path: str = "/api/hb"):
+        """
+        Serve the heartbeats at `path` before Django, the other requests go to application
+        Parameters are the same as `/api/heartbeat`, in query string or urlencoded form.
+        :param application: the WSGI application of Django
+        :param tunnels: returns the tunnels registry, resolved at the first heartbeat after Django loaded
+        :param path:
+        """
+        self.application = application
+        self.tunnels = tunnels
+        self.path = path
+        self.__registry: Optional["TunnelRegistry"] = None
+        self.__auth = None
+
+    def __call__(self, environ: dict, start_response: Callable):
+        if environ.get("PATH_INFO") != self.path:
+            return self.application(environ, start_response)
+        params = parse_qs(environ.get("QUERY_STRING", ""))
+        if environ.get("REQUEST_METHOD") == "POST":
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+            params.update(parse_qs(environ["wsgi.input"].read(length).decode()))
+        status, body = self.handle(params, environ.get("HTTP_AUTHORIZATION"), environ.get("REMOTE_ADDR", ""))
+        start_response(status, [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+        return [body]
+
+    def handle(self, params: dict, authorization: str = None, address: str = "") -> Tuple[str, bytes]:
+        """
+        Heartbeat by the parsed parameters, authorized and throttled like the views of Django
+        :param params: parameters of request, same as the result of parse_qs
+        :param authorization: value of Authorization header
+        :param address: client address
+        :return: HTTP status line and JSON body
+        """
+        if self.__registry is None:
+            # Resolved late, Django is loaded by then
+            from util import http_response
+            self.__auth = http_response
+            self.__registry = self.tunnels()
+        auth = self.__auth
+        if auth._auth_key:
+            key = auth.bearer_key(authorization)
+            if key is None and "key" in params:
+                key = params["key"][0]
+            seconds = max(auth.throttled_seconds(address), auth.throttled_seconds(address, key))
+            if seconds > 0:
+                return self.__respond("429 Too Many Requests", {
+                    "status": "error",
+                    "error_info": "Too many failed authorizations, retry after {:.0f} seconds.".format(
+                        math.ceil(seconds)
+                    )
+                })
+            if not auth.is_authorized_key(key):
+                auth.count_failure(address, key)
+                return self.__respond("401 Unauthorized", {
+                    "status": "error",
+                    "error_info": "Authorization failed."
+                })
+        try:
+            tid = int(params["id"][0])
+        except (KeyError, ValueError):
+            return self.__respond("400 Bad Request", {
+                "status": "error",
+                "error_info": "Tunnel id is required"
+            })
+        result = heartbeat(self.__registry, tid)
+        if result == OK:
+            return self.__respond("200 OK", {"status": "success", "id": tid})
+        elif result == REFUSED:
+            error_info = "Tunnel {} is checked by traffic only".format(tid)
+        else:
+            error_info = "ID {} not found".format(tid)
+        return self.__respond("500 Internal Server Error", {
+            "status": "error",
+            "error_info": error_info
+        })
+
+    @staticmethod
+    def __respond(status: str, obj: dict) -> Tuple[str, bytes]:
+        return status, json.dumps(obj).encode()
+
+
+class AsgiHeartbeatFastPath(HeartbeatFastPath):
+    """
+    Same as HeartbeatFastPath for the ASGI application of Django
+    """
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            return await self.application(scope, receive, send)
+        params = parse_qs(scope.get("query_string", b"").decode())
+        if scope["method"] == "POST":
+            body = b""
+            while True:
+                message = await receive()
+                body += message.get("body", b"")
+                if not message.get("more_body", False):
+                    break
+            params.update(parse_qs(body.decode()))
+        headers = dict(scope.get("headers", []))
+        authorization = headers[b"authorization"].decode("latin-1") if b"authorization" in headers else None
+        status, body = self.handle(params, authorization, (scope.get("client") or ("",))[0])
+        await send({
+            "type": "http.response.start",
+            "status": int(status.split(" ", 1)[0]),
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+class HeartbeatListener(Thread):
+    def __init__(
+            self,
+            tunnels: "TunnelRegistry",
+            port: int,
+            keys: Iterable[str] = None,
+            window: float = 30,
+            host: str = ""
+    ):
+        """
+        Receive heartbeats in UDP datagrams of PACKET_SIZE bytes, replied with the result and tunnel id
+        Datagrams with bad signature or time out of window are dropped without reply.
+        :param tunnels: tunnels registry
+        :param port: UDP port
+        :param keys: authorization keys to verify the signature, not verified if None or empty
+        :param window: max seconds between the time in datagram and now, limits replaying
+        :param host: address to bind
+        """
+        super(HeartbeatListener, self).__init__()
+        self.tunnels = tunnels
+        self.keys = [key.encode() for key in keys] if keys else []
+        self.window = window
+        self.daemon = True
+        self.is_stop = False
+        self.received_count = 0
+        self.dropped_count = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        # Check is_stop every second
+        self.sock.settimeout(1)
+        self.port = self.sock.getsockname()[1]
+
+    def __verify(self, packet: bytes) -> Optional[int]:
+        if len(packet) != PACKET_SIZE:
+            return None
+        header, digest = packet[:_HEADER.size], packet[_HEADER.size:]
+        version, tid, timestamp = _HEADER.unpack(header)
+        if version != _VERSION or abs(time.time() - timestamp) > self.window:
+            return None
+        if self.keys and not any(
+                hmac.compare_digest(hmac.new(key, header, hashlib.sha256).digest()[:_DIGEST_SIZE], digest)
+                for key in self.keys
+        ):
+            return None
+        return tid
+
+    def run(self) -> None:
+        while not self.is_stop:
+            try:
+                packet, address = self.sock.recvfrom(64)
+            except socket.timeout:
+                continue
+            self.received_count += 1
+            tid = self.__verify(packet)
+            if tid is None:
+                self.dropped_count += 1
+                continue
+            try:
+                self.sock.sendto(_REPLY.pack(heartbeat(self.tunnels, tid), tid), address)
+            except OSError as ex:
+                log.debug("Error while replying heartbeat to {}.".format(address), exc_info=ex)
+        self.sock.close()
+
+    def stop(self):
+        self.is_stop = True
+
+    @property
+    def json(self):
+        return {
+            "port": self.port,
+            "received": self.received_count,
+            "dropped": self.dropped_count,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send heartbeats of a tunnel to the UDP heartbeat listener")
+    parser.add_argument("-H", dest="listener", required=True, help="host:port of the listener")
+    parser.add_argument("--id", dest="tid", type=int, required=True, help="tunnel id")
+    parser.add_argument("--k", dest="key", default=None, help="authorization key")
+    parser.add_argument("-i", dest="interval", type=float, default=10, help="seconds between heartbeats")
+    args = parser.parse_args()
+    host, port = args.listener.rsplit(":", 1)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect((host, int(port)))
+    sock.settimeout(min(args.interval, 5))
+    while True:
+        sock.send(pack_heartbeat(args.tid, args.key))
+        try:
+            result, _ = _REPLY.unpack(sock.recv(_REPLY.size))
+            if result != OK:
+                log.warning("Heartbeat of tunnel {} failed: {}".format(
+                    args.tid, "not found" if result == NOT_FOUND else "refused"
+                ))
+        except (socket.timeout, OSError, struct.error):
+            log.warning("No reply from {}.".format(args.listener))
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
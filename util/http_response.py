@@ -4,20 +4,33 @@
 Http Response related functions
 """
 
+import asyncio
+import hashlib
+import hmac
 import json
+import math
 import os
 import sys
 import time
 import traceback
-from typing import Iterable, Union, Callable
+from typing import Iterable, Optional, Union, Callable
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponse, HttpRequest
+from django.http.response import HttpResponseBase
 
 # Auto load authorize key
-from tunnel_manager.settings import DEBUG
+from tunnel_manager.settings import DEBUG, AUTH_FAILURE_RATE, AUTH_FAILURE_BURST, AUTH_LIMITER_SIZE
+from util import metrics
+from util.ratelimit import TokenBucketLimiter
 
 _auth_key = set(os.environ.get("AUTHORIZE_KEYS").split(",")) if os.environ.get("AUTHORIZE_KEYS") is not None else None
+_auth_key_bytes = [key.encode() for key in _auth_key] if _auth_key else []
+# Failed authorizations by client address and by key
+_failure_limiter = TokenBucketLimiter(
+    AUTH_FAILURE_RATE, AUTH_FAILURE_BURST, AUTH_LIMITER_SIZE
+) if AUTH_FAILURE_RATE > 0 else None
 
 
 def get_request_with_default(request, key, default_value):
@@ -97,21 +110,36 @@ def response_json(func):
     :return:
     """
 
+    def respond(result):
+        if isinstance(result, HttpResponseBase):
+            # Streaming or specialized responses are returned as is
+            return result
+        return get_json_response(result)
+
+    def error(ex: Exception):
+        print("Error:" + str(ex), file=sys.stderr)
+        print(traceback.format_exc(), file=sys.stderr)
+        resp = {
+            "status": "error",
+            "error_info": str(ex)
+        }
+        if DEBUG:
+            resp["trace_back"] = traceback.format_exc()
+        return get_json_response(resp, status_code=500)
+
     def wrapper(request):
         try:
-            return get_json_response(func(request))
+            return respond(func(request))
         except Exception as ex:
-            print("Error:" + str(ex), file=sys.stderr)
-            print(traceback.format_exc(), file=sys.stderr)
-            resp = {
-                "status": "error",
-                "error_info": str(ex)
-            }
-            if DEBUG:
-                resp["trace_back"] = traceback.format_exc()
-            return get_json_response(resp, status_code=500)
+            return error(ex)
 
-    return wrapper
+    async def async_wrapper(request):
+        try:
+            return respond(await func(request))
+        except Exception as ex:
+            return error(ex)
+
+    return async_wrapper if asyncio.iscoroutinefunction(func) else wrapper
 
 
 def response_figure_image(func):
@@ -160,22 +188,120 @@ def method_verify(request: HttpRequest, methods: Union[str, Iterable[str]]):
             "Interface should be call by {} method, you're using {}.".format("/".join(methods), current_method)
 
 
-def _authorize(request: HttpRequest) -> None:
+def bearer_key(authorization: Optional[str]) -> Optional[str]:
     """
-    Check the authorization key for request
+    Key in `Authorization: Bearer <key>` header
+    :param authorization: value of the header
+    :return: None if it's not a bearer token
+    """
+    if authorization is not None and authorization[:7].lower() == "bearer ":
+        return authorization[7:].strip()
+    return None
+
+
+def _request_key(request: HttpRequest) -> Optional[str]:
+    """
+    Key from header, form or query string in order, the body is parsed only if key is not found in header
     :param request:
     :return:
     """
-    if _auth_key is None or len(_auth_key) <= 0:
-        pass
+    key = bearer_key(request.headers.get("Authorization"))
+    if key is not None:
+        return key
     elif "key" in request.POST:
-        if request.POST["key"] not in _auth_key:
-            raise Exception("Authorization failed caused by incorrect key")
+        return request.POST["key"]
     elif "key" in request.GET:
-        if request.GET["key"] not in _auth_key:
-            raise Exception("Authorization failed caused by incorrect key")
-    else:
-        raise Exception("Authorization failed caused by key not found.")
+        return request.GET["key"]
+    return None
+
+
+def is_authorized_key(key: Optional[str]) -> bool:
+    """
+    Compare key with every authorization key in constant time
+    :param key:
+    :return:
+    """
+    if key is None:
+        return False
+    given = key.encode()
+    matched = False
+    for expected in _auth_key_bytes:
+        matched |= hmac.compare_digest(expected, given)
+    return matched
+
+
+def _failure_buckets(address: str, key: Optional[str]) -> list:
+    buckets = [("address", address)]
+    if key is not None:
+        # Wrong keys of any length take the same memory
+        buckets.append(("key", hashlib.sha256(key.encode()).digest()))
+    return buckets
+
+
+def throttled_seconds(address: str, key: Optional[str] = None) -> float:
+    """
+    Seconds the client has to wait before trying again, after too many failed authorizations
+    :param address: client address
+    :param key: key given by client, only the address is checked if None
+    :return: 0 if not throttled
+    """
+    if _failure_limiter is None:
+        return 0
+    return max(_failure_limiter.retry_after(bucket) for bucket in _failure_buckets(address, key))
+
+
+def count_failure(address: str, key: Optional[str]):
+    """
+    Take a token from the buckets of the client address and the key
+    :param address:
+    :param key:
+    :return:
+    """
+    metrics.auth_failures.labels("unauthorized").inc()
+    if _failure_limiter is not None:
+        for bucket in _failure_buckets(address, key):
+            _failure_limiter.consume(bucket)
+
+
+def _throttled_response(seconds: float) -> HttpResponse:
+    metrics.auth_failures.labels("throttled").inc()
+    response = get_json_response({
+        "status": "error",
+        "error_info": "Too many failed authorizations, retry after {:.0f} seconds.".format(math.ceil(seconds))
+    }, status_code=429)
+    response["Retry-After"] = str(math.ceil(seconds))
+    return response
+
+
+def _authorize(request: HttpRequest) -> Union[bool, HttpResponse]:
+    """
+    Check the authorization key for request
+    Throttled clients are rejected before their key is read.
+    :param request:
+    :return: True if authorized, False if it's a browser which has to login, or the response of rejection
+    """
+    if _auth_key is None or len(_auth_key) <= 0:
+        return True
+    address = request.META.get("REMOTE_ADDR", "")
+    seconds = throttled_seconds(address)
+    if seconds > 0:
+        return _throttled_response(seconds)
+    key = _request_key(request)
+    seconds = throttled_seconds(address, key)
+    if seconds > 0:
+        return _throttled_response(seconds)
+    if is_authorized_key(key):
+        return True
+    browser = is_browser(request)
+    if key is not None or not browser:
+        # Users of UI carry the session instead of key
+        count_failure(address, key)
+    if browser:
+        return False
+    return get_json_response({
+        "status": "error",
+        "error_info": "Authorization failed."
+    }, status_code=401)
 
 
 def is_browser(request: HttpRequest) -> bool:
@@ -196,24 +322,29 @@ def check_authorization(func) -> Callable:
     If authorization is not set, pass
     If key is correct pass
     If cookies is login, pass
-    If above all failed, then fail
+    If above all failed, then fail, clients failed too many times are rejected by 429 at once
     :param func:
     :return:
     """
 
     def wrapper(request: HttpRequest) -> HttpResponse:
-        try:
-            _authorize(request)
-            return func(request)
-        except:
+        result = _authorize(request)
+        if isinstance(result, HttpResponseBase):
+            return result
+        elif not result:
             # Different behavior between curl/postman/wget/... and browser
-            time.sleep(0.5)
-            if is_browser(request):
-                return login_required(func)(request)
-            else:
-                return get_json_response({
-                    "status": "error",
-                    "error_info": "Authorization failed."
-                }, status_code=401)
-
-    return wrapper
+            return login_required(func)(request)
+        return func(request)
+
+    async def async_wrapper(request: HttpRequest) -> HttpResponse:
+        result = _authorize(request)
+        if isinstance(result, HttpResponseBase):
+            return result
+        elif not result:
+            # Session of the user is loaded from database, not allowed in event loop
+            redirect = await sync_to_async(login_required(lambda r: None))(request)
+            if redirect is not None:
+                return redirect
+        return await func(request)
+
+    return async_wrapper if asyncio.iscoroutinefunction(func) else wrapper
@@ -0,0 +1,230 @@
+"""
+Secondary indexes of the living tunnels
+"""
+import bisect
+import math
+import re
+import time
+from threading import Lock
+from typing import Dict, List, Optional, Set, Tuple
+
+from util.goproxy import MultiTunnel
+from util.lock import MutexLock
+
+# Tags are words like `#home` in comment
+_TAG_PATTERN = re.compile(r"#([\w.-]+)")
+
+
+def comment_tags(comment: str) -> Set[str]:
+    """
+    Tags in comment, without `#`
+    :param comment:
+    :return:
+    """
+    return set(_TAG_PATTERN.findall(comment or ""))
+
+
+class _Entry:
+    def __init__(self, tunnel: MultiTunnel):
+        # Ports and comment never change after the tunnel registered
+        self.bridge_port = tunnel.bridge_port
+        self.expose_ports = [expose.expose_port for expose in tunnel.exposes if expose.expose_port is not None]
+        self.innet_ports = {expose.innet_port for expose in tunnel.exposes}
+        self.comment = tunnel.comment or ""
+        self.tags = comment_tags(self.comment)
+        self.shared_bridge = tunnel.shared_bridge is not None
+        # Bucket of the deadline when indexed, None for permanent
+        self.bucket: Optional[int] = None
+
+
+class TunnelIndex:
+    def __init__(self, bucket_seconds: float = 10):
+        """
+        Indexes of tunnel ids by ports, comment, tags and deadline, kept by registry on every add and pop
+        Deadlines are bucketed when indexed and only moved forward by heartbeat without updating the index,
+        a tunnel found in an earlier bucket than its real deadline is moved at query.
+        :param bucket_seconds: width of the deadline buckets
+        """
+        self.bucket_seconds = bucket_seconds
+        self.__lock = Lock()
+        self.__entries: Dict[int, _Entry] = dict()
+        # All ids in order, for pagination
+        self.__ids: List[int] = []
+        self.__by_expose: Dict[int, int] = dict()
+        self.__by_bridge: Dict[int, Set[int]] = dict()
+        self.__by_innet: Dict[int, Set[int]] = dict()
+        self.__by_tag: Dict[str, Set[int]] = dict()
+        # (comment, id) in order, for prefix search
+        self.__comments: List[Tuple[str, int]] = []
+        self.__by_bucket: Dict[int, Set[int]] = dict()
+
+    def __bucket_of(self, deadline: float) -> int:
+        return math.floor(deadline / self.bucket_seconds)
+
+    def add(self, tid: int, tunnel: MultiTunnel):
+        """
+        Index the tunnel, called by registry in the shard lock
+        :param tid:
+        :param tunnel:
+        :return:
+        """
+        entry = _Entry(tunnel)
+        deadline = tunnel.deadline
+        with MutexLock(self.__lock) as _:
+            if tid in self.__entries:
+                self.__remove(tid)
+            self.__entries[tid] = entry
+            if not self.__ids or self.__ids[-1] < tid:
+                # Ids increase with time, appended mostly
+                self.__ids.append(tid)
+            else:
+                bisect.insort(self.__ids, tid)
+            for port in entry.expose_ports:
+                self.__by_expose[port] = tid
+            if entry.bridge_port is not None:
+                self.__by_bridge.setdefault(entry.bridge_port, set()).add(tid)
+            for port in entry.innet_ports:
+                self.__by_innet.setdefault(port, set()).add(tid)
+            for tag in entry.tags:
+                self.__by_tag.setdefault(tag, set()).add(tid)
+            bisect.insort(self.__comments, (entry.comment, tid))
+            if deadline is not None:
+                entry.bucket = self.__bucket_of(deadline)
+                self.__by_bucket.setdefault(entry.bucket, set()).add(tid)
+
+    def remove(self, tid: int):
+        """
+        Drop the tunnel from indexes, called by registry in the shard lock
+        :param tid:
+        :return:
+        """
+        with MutexLock(self.__lock) as _:
+            self.__remove(tid)
+
+    @staticmethod
+    def __discard(index: dict, key, tid: int):
+        tids = index.get(key)
+        if tids is not None:
+            tids.discard(tid)
+            if not tids:
+                del index[key]
+
+    def __remove(self, tid: int):
+        entry = self.__entries.pop(tid, None)
+        if entry is None:
+            return
+        del self.__ids[bisect.bisect_left(self.__ids, tid)]
+        for port in entry.expose_ports:
+            if self.__by_expose.get(port) == tid:
+                del self.__by_expose[port]
+        self.__discard(self.__by_bridge, entry.bridge_port, tid)
+        for port in entry.innet_ports:
+            self.__discard(self.__by_innet, port, tid)
+        for tag in entry.tags:
+            self.__discard(self.__by_tag, tag, tid)
+        del self.__comments[bisect.bisect_left(self.__comments, (entry.comment, tid))]
+        if entry.bucket is not None:
+            self.__discard(self.__by_bucket, entry.bucket, tid)
+
+    def port_owner(self, port: int) -> Optional[int]:
+        """
+        Id of the tunnel exposing the port or running its own bridge on it
+        :param port:
+        :return: None if the port is not used by any tunnel
+        """
+        with MutexLock(self.__lock) as _:
+            if port in self.__by_expose:
+                return self.__by_expose[port]
+            for tid in self.__by_bridge.get(port, ()):
+                if not self.__entries[tid].shared_bridge:
+                    return tid
+            return None
+
+    def __with_comment_prefix(self, prefix: str) -> Set[int]:
+        start = bisect.bisect_left(self.__comments, (prefix, -1))
+        found = set()
+        for comment, tid in self.__comments[start:]:
+            if not comment.startswith(prefix):
+                break
+            found.add(tid)
+        return found
+
+    def __expiring_before(self, deadline: float, tunnels) -> Set[int]:
+        """
+        Tunnels which deadline is before the time, the ones moved forward by heartbeat are re-bucketed
+        :param deadline:
+        :param tunnels: registry to read the real deadlines
+        :return:
+        """
+        last_bucket = self.__bucket_of(deadline)
+        found = set()
+        for bucket in sorted(b for b in self.__by_bucket if b <= last_bucket):
+            for tid in list(self.__by_bucket.get(bucket, ())):
+                tunnel = tunnels.get(tid)
+                real = tunnel.deadline if tunnel is not None else None
+                if real is None:
+                    continue
+                if real <= deadline:
+                    found.add(tid)
+                real_bucket = self.__bucket_of(real)
+                if real_bucket != bucket:
+                    entry = self.__entries[tid]
+                    self.__discard(self.__by_bucket, bucket, tid)
+                    entry.bucket = real_bucket
+                    self.__by_bucket.setdefault(real_bucket, set()).add(tid)
+        return found
+
+    def find(
+            self,
+            tunnels,
+            expose_port: int = None,
+            bridge_port: int = None,
+            innet_port: int = None,
+            tag: str = None,
+            comment_prefix: str = None,
+            expiring_within: float = None,
+            after_id: int = None,
+            limit: int = None
+    ) -> Tuple[List[int], bool]:
+        """
+        Ids of the tunnels matching all the given conditions, in order
+        :param tunnels: registry, to check the real deadlines
+        :param expose_port:
+        :param bridge_port:
+        :param innet_port:
+        :param tag: tag in comment, without `#`
+        :param comment_prefix:
+        :param expiring_within: seconds from now
+        :param after_id: only the ids greater than it, for pagination
+        :param limit: max count of ids returned
+        :return: (ids, more), more is True if there are more ids after the last one
+        """
+        with MutexLock(self.__lock) as _:
+            matched: List[Set[int]] = []
+            if expose_port is not None:
+                matched.append({self.__by_expose[expose_port]} if expose_port in self.__by_expose else set())
+            if bridge_port is not None:
+                matched.append(self.__by_bridge.get(bridge_port, set()))
+            if innet_port is not None:
+                matched.append(self.__by_innet.get(innet_port, set()))
+            if tag is not None:
+                matched.append(self.__by_tag.get(tag, set()))
+            if comment_prefix is not None:
+                matched.append(self.__with_comment_prefix(comment_prefix))
+            if expiring_within is not None:
+                matched.append(self.__expiring_before(time.time() + expiring_within, tunnels))
+            if matched:
+                matched.sort(key=len)
+                ids = sorted(set.intersection(*matched) if len(matched) > 1 else matched[0])
+                if after_id is not None:
+                    ids = ids[bisect.bisect_right(ids, after_id):]
+            else:
+                start = 0 if after_id is None else bisect.bisect_right(self.__ids, after_id)
+                end = len(self.__ids) if limit is None else start + limit + 1
+                ids = self.__ids[start:end]
+            if limit is not None and len(ids) > limit:
+                return ids[:limit], True
+            return ids, False
+
+    def __len__(self) -> int:
+        return len(self.__entries)
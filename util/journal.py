@@ -0,0 +1,433 @@
+"""
+Durable journal of the tunnels, to take over the running goproxy processes after manager restarted
+"""
+import json
+import logging
+import os
+import sqlite3
+from threading import Event, Lock, Thread
+from typing import Dict, List, Optional, Tuple
+
+from util import events
+from util.goproxy import MultiTunnel, SharedBridgePool
+from util.lease import LeaseRegistry
+from util.lock import MutexLock
+from util.procfs import AdoptedProcess, process_start_time
+from util.registry import TunnelRegistry
+
+log = logging.getLogger(__file__)
+
+
+def _process_record(process) -> Optional[dict]:
+    if process is None or process.poll() is not None:
+        return None
+    return {
+        "pid": process.pid,
+        "start_time": process_start_time(process),
+        "args": [str(arg) for arg in process.args],
+    }
+
+
+def adopt_process(record: Optional[dict]) -> Optional[AdoptedProcess]:
+    """
+    Take over the process in journal if it's still the same process
+    :param record:
+    :return: None if it's exited
+    """
+    if record is None or record["start_time"] is None:
+        return None
+    return AdoptedProcess.adopt(record["pid"], record["start_time"], record["args"])
+
+
+def _process_signature(tunnel: MultiTunnel) -> tuple:
+    # Changes only when processes exit or are restarted, cheaper than the records reading /proc
+    return tuple(
+        p.pid if p is not None and p.poll() is None else None
+        for p in [tunnel.bridge_process] + list(tunnel.client_processes)
+    )
+
+
+def _tunnel_record(tid: int, tunnel: MultiTunnel) -> dict:
+    return {
+        "id": tid,
+        "config": tunnel.config,
+        "bridge_port": tunnel.bridge_port,
+        "expose_ports": [expose.expose_port for expose in tunnel.exposes],
+        "key": tunnel.key,
+        "shared": tunnel.shared_bridge is not None,
+        "last_check_time": tunnel.last_check_time,
+        "bridge_process": _process_record(tunnel.bridge_process),
+        "client_processes": [_process_record(p) for p in tunnel.client_processes],
+    }
+
+
+class TunnelJournal(Thread):
+    def __init__(
+            self,
+            path: str,
+            tunnels: TunnelRegistry,
+            bridge_pool: SharedBridgePool = None,
+            interval: float = 5,
+            leases: LeaseRegistry = None
+    ):
+        """
+        Save the tunnels and their processes to a json file
+        The file is a snapshot rewritten periodically by this thread, taking the heartbeats along.
+        Tunnels created and removed between two snapshots are appended to `<path>.log` by caller on every
+        create/remove, so each of them costs a line instead of rewriting all the tunnels.
+        :param path: file path of journal
+        :param tunnels: tunnels registry
+        :param bridge_pool: save the shared bridges if set
+        :param interval: seconds between periodical saving
+        :param leases: save the leases if set
+        """
+        super(TunnelJournal, self).__init__()
+        self.path = path
+        self.log_path = path + ".log"
+        self.tunnels = tunnels
+        self.bridge_pool = bridge_pool
+        self.leases = leases
+        self.interval = interval
+        self.daemon = True
+        self.__save_lock = Lock()
+        self.__stop_event = Event()
+        # Snapshot the log belongs to, the lines of an older log are in the snapshot already
+        self.__generation = 0
+        # Version of the last event written, None to write a snapshot first
+        self.__version: Optional[int] = None
+        self.__written_pools: Optional[tuple] = None
+
+    def __pools(self) -> dict:
+        return {
+            "shared_bridges": [
+                {"port": bridge.port, "process": _process_record(bridge.process)}
+                for bridge in (self.bridge_pool.bridges if self.bridge_pool is not None else [])
+            ],
+            "leases": [
+                {
+                    "id": lease.id,
+                    "comment": lease.comment,
+                    "expire_time": lease.expire_time,
+                    "last_check_time": lease.last_check_time
+                }
+                for lease in (self.leases.items() if self.leases is not None else [])
+            ]
+        }
+
+    @staticmethod
+    def __pools_signature(pools: dict) -> tuple:
+        # Renewed leases are saved by snapshots only, like the heartbeats of tunnels
+        return (
+            [(bridge["port"], bridge["process"]) for bridge in pools["shared_bridges"]],
+            [(lease["id"], lease["comment"], lease["expire_time"]) for lease in pools["leases"]]
+        )
+
+    @staticmethod
+    def __write_file(path: str, content: str):
+        """
+        Write the file atomically
+        :param path:
+        :param content:
+        :return:
+        """
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as fp:
+            fp.write(content)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_path, path)
+
+    def __write_snapshot(self):
+        # Taken before the tunnels, the ones created meanwhile are appended again by next save
+        version = self.tunnels.events.version
+        generation = self.__generation + 1
+        pools = self.__pools()
+        state = dict(
+            pools,
+            generation=generation,
+            tunnels=[_tunnel_record(tid, tunnel) for tid, tunnel in self.tunnels.items()]
+        )
+        self.__write_file(self.path, json.dumps(state))
+        # Lines of the old log are in the snapshot now
+        self.__write_file(self.log_path, json.dumps({"generation": generation}) + "\n")
+        self.__generation = generation
+        self.__version = version
+        self.__written_pools = self.__pools_signature(pools)
+
+    def save(self):
+        """
+        Append the tunnels created and removed since last writing to the log, and the pools if they changed
+        A snapshot is written instead for the first time, or if the events are dropped from event log already.
+        :return:
+        """
+        with MutexLock(self.__save_lock) as _:
+            if self.__version is None:
+                self.__write_snapshot()
+                return
+            event_list, reset = self.tunnels.events.since(self.__version)
+            if reset:
+                self.__write_snapshot()
+                return
+            version = self.__version
+            changed = dict()
+            for event in event_list:
+                if event["type"] != events.HEARTBEAT:
+                    changed[event["id"]] = event["type"]
+                version = event["version"]
+            lines = []
+            for tid, event_type in changed.items():
+                tunnel = self.tunnels.get(tid) if event_type == events.CREATE else None
+                if tunnel is not None:
+                    lines.append({"create": _tunnel_record(tid, tunnel)})
+                else:
+                    lines.append({"remove": tid})
+            pools = self.__pools()
+            signature = self.__pools_signature(pools)
+            if signature != self.__written_pools:
+                lines.append({"pools": pools})
+            if lines:
+                with open(self.log_path, "a") as fp:
+                    fp.write("".join(json.dumps(line) + "\n" for line in lines))
+                    fp.flush()
+                    os.fsync(fp.fileno())
+            self.__version = version
+            self.__written_pools = signature
+
+    def load(self) -> dict:
+        """
+        Read the snapshot and replay the log of it
+        :return: empty journal if file not exists
+        """
+        try:
+            with open(self.path, "r") as fp:
+                state = json.load(fp)
+        except FileNotFoundError:
+            state = {"tunnels": [], "shared_bridges": [], "leases": []}
+        self.__generation = state.get("generation", 0)
+        records = {record["id"]: record for record in state["tunnels"]}
+        try:
+            with open(self.log_path, "r") as fp:
+                lines = fp.readlines()
+        except FileNotFoundError:
+            lines = []
+        for i, line in enumerate(lines):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Torn by a crash while appending, the lines after it are not written either
+                log.warning("Tunnel journal log is truncated at line {}.".format(i + 1))
+                break
+            if i == 0:
+                if entry.get("generation") != self.__generation:
+                    # Crashed after the snapshot replaced and before the log, all in snapshot
+                    break
+            elif "create" in entry:
+                records[entry["create"]["id"]] = entry["create"]
+            elif "remove" in entry:
+                records.pop(entry["remove"], None)
+            elif "pools" in entry:
+                state.update(entry["pools"])
+        state["tunnels"] = [records[tid] for tid in sorted(records)]
+        return state
+
+    def flush(self):
+        """
+        Periodical saving, write a snapshot with the heartbeats and start a new log
+        :return:
+        """
+        with MutexLock(self.__save_lock) as _:
+            self.__write_snapshot()
+
+    def run(self) -> None:
+        while not self.__stop_event.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as ex:
+                log.error("Error while saving tunnel journal.", exc_info=ex)
+
+    def stop(self):
+        """
+        Stop periodical saving and save it the last time
+        :return:
+        """
+        self.__stop_event.set()
+        self.flush()
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tunnel (id INTEGER PRIMARY KEY, record TEXT NOT NULL, last_check_time REAL);
+CREATE TABLE IF NOT EXISTS shared_bridge (port INTEGER PRIMARY KEY, process TEXT);
+CREATE TABLE IF NOT EXISTS lease (
+    id INTEGER PRIMARY KEY, comment TEXT, expire_time REAL NOT NULL, last_check_time REAL NOT NULL
+);
+"""
+
+
+class SqliteJournal(TunnelJournal):
+    def __init__(
+            self,
+            path: str,
+            tunnels: TunnelRegistry,
+            bridge_pool: SharedBridgePool = None,
+            interval: float = 5,
+            leases: LeaseRegistry = None
+    ):
+        """
+        Save the tunnels and their processes to a SQLite database in WAL mode, a row per tunnel
+        `save` writes only the tunnels created and removed since last time, found from event log of registry,
+        heartbeats and restarted processes are compared in memory and flushed in one transaction every interval.
+        :param path: file path of database
+        :param tunnels: tunnels registry
+        :param bridge_pool: save the shared bridges if set
+        :param interval: seconds between flushing heartbeats
+        :param leases: save the leases if set
+        """
+        super(SqliteJournal, self).__init__(path, tunnels, bridge_pool, interval, leases)
+        self.__db_lock = Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.executescript(_SCHEMA)
+        # Version of the last event written, the first save rewrites all to drop the tunnels not restored
+        self.__version = -1
+        # Written values of every tunnel, compared to skip the unchanged ones
+        self.__written_check_time: Dict[int, float] = dict()
+        self.__written_processes: Dict[int, tuple] = dict()
+        self.__written_bridges: List[Tuple[int, str]] = []
+        self.__written_leases: List[tuple] = []
+
+    def __upsert_tunnels(self, items: List[Tuple[int, MultiTunnel]]):
+        rows = []
+        for tid, tunnel in items:
+            record = _tunnel_record(tid, tunnel)
+            self.__written_check_time[tid] = record.pop("last_check_time")
+            self.__written_processes[tid] = _process_signature(tunnel)
+            rows.append((tid, json.dumps(record), self.__written_check_time[tid]))
+        self.__db.executemany("INSERT OR REPLACE INTO tunnel VALUES (?, ?, ?)", rows)
+
+    def __delete_tunnels(self, tids: List[int]):
+        for tid in tids:
+            self.__written_check_time.pop(tid, None)
+            self.__written_processes.pop(tid, None)
+        self.__db.executemany("DELETE FROM tunnel WHERE id = ?", [(tid,) for tid in tids])
+
+    def __write_changes(self):
+        """
+        Write the tunnels created and removed after last version, all of them if events are dropped already
+        :return:
+        """
+        version = self.tunnels.events.version
+        event_list, reset = self.tunnels.events.since(self.__version)
+        if reset:
+            self.__db.execute("DELETE FROM tunnel")
+            self.__written_check_time.clear()
+            self.__written_processes.clear()
+            self.__upsert_tunnels(self.tunnels.items())
+        else:
+            changed = dict()
+            for event in event_list:
+                if event["type"] != events.HEARTBEAT:
+                    changed[event["id"]] = event["type"]
+                version = event["version"]
+            created = []
+            for tid, event_type in changed.items():
+                tunnel = self.tunnels.get(tid) if event_type == events.CREATE else None
+                if tunnel is not None:
+                    created.append((tid, tunnel))
+            self.__upsert_tunnels(created)
+            self.__delete_tunnels([tid for tid, event_type in changed.items() if event_type != events.CREATE])
+        self.__version = version
+
+    def __write_pools(self):
+        """
+        Rewrite the shared bridges and leases if any of them changed, they are only a few
+        :return:
+        """
+        bridges = [
+            (bridge.port, json.dumps(_process_record(bridge.process)))
+            for bridge in (self.bridge_pool.bridges if self.bridge_pool is not None else [])
+        ]
+        if bridges != self.__written_bridges:
+            self.__db.execute("DELETE FROM shared_bridge")
+            self.__db.executemany("INSERT INTO shared_bridge VALUES (?, ?)", bridges)
+            self.__written_bridges = bridges
+        lease_rows = [
+            (lease.id, lease.comment, lease.expire_time, lease.last_check_time)
+            for lease in (self.leases.items() if self.leases is not None else [])
+        ]
+        if lease_rows != self.__written_leases:
+            self.__db.execute("DELETE FROM lease")
+            self.__db.executemany("INSERT INTO lease VALUES (?, ?, ?, ?)", lease_rows)
+            self.__written_leases = lease_rows
+
+    def __transaction(self, write):
+        with MutexLock(self.__db_lock) as _:
+            self.__db.execute("BEGIN IMMEDIATE")
+            try:
+                write()
+            except Exception:
+                self.__db.execute("ROLLBACK")
+                # Written values in memory may be ahead of database, rewrite all next time
+                self.__version = -1
+                raise
+            self.__db.execute("COMMIT")
+
+    def save(self):
+        """
+        Write the created and removed tunnels synchronously, called on every create/remove
+        :return:
+        """
+        def write():
+            self.__write_changes()
+            self.__write_pools()
+
+        self.__transaction(write)
+
+    def flush(self):
+        """
+        Write the changes, then the heartbeats and restarted processes of all tunnels in one transaction
+        :return:
+        """
+        def write():
+            self.__write_changes()
+            self.__write_pools()
+            check_times = []
+            restarted = []
+            for tid, tunnel in self.tunnels.items():
+                if tid not in self.__written_check_time:
+                    # Created after the changes written above
+                    continue
+                if self.__written_processes[tid] != _process_signature(tunnel):
+                    restarted.append((tid, tunnel))
+                elif self.__written_check_time[tid] != tunnel.last_check_time:
+                    self.__written_check_time[tid] = tunnel.last_check_time
+                    check_times.append((tunnel.last_check_time, tid))
+            self.__db.executemany("UPDATE tunnel SET last_check_time = ? WHERE id = ?", check_times)
+            self.__upsert_tunnels(restarted)
+
+        self.__transaction(write)
+
+    def load(self) -> dict:
+        """
+        Read all the rows in bulk
+        :return: same as TunnelJournal.load
+        """
+        with MutexLock(self.__db_lock) as _:
+            tunnel_list = []
+            for tid, record, last_check_time in self.__db.execute("SELECT id, record, last_check_time FROM tunnel"):
+                record = json.loads(record)
+                record["last_check_time"] = last_check_time
+                tunnel_list.append(record)
+            return {
+                "tunnels": tunnel_list,
+                "shared_bridges": [
+                    {"port": port, "process": json.loads(process)}
+                    for port, process in self.__db.execute("SELECT port, process FROM shared_bridge")
+                ],
+                "leases": [
+                    {"id": lid, "comment": comment, "expire_time": expire_time, "last_check_time": last_check_time}
+                    for lid, comment, expire_time, last_check_time in self.__db.execute(
+                        "SELECT id, comment, expire_time, last_check_time FROM lease"
+                    )
+                ]
+            }
+
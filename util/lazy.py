@@ -0,0 +1,293 @@
+"""
+Socket activation of lazy tunnels
+"""
+import asyncio
+import logging
+import os
+import selectors
+import socket
+import time
+from collections import deque
+from threading import Event, Lock, Thread, current_thread
+from typing import Callable, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+from util.lock import MutexLock
+from util.ports import wait_listening
+from util.relay import _join
+from util.traffic import count_connections
+
+if TYPE_CHECKING:
+    from util.goproxy import MultiTunnel
+
+log = logging.getLogger(__file__)
+
+_RELAY_BUFFER_SIZE = 65536
+
+
+class LazyActivator(Thread):
+    def __init__(self, idle_timeout: float = 300, check_interval: float = 5, relay_limit: int = 256):
+        """
+        Hold the expose ports of dormant lazy tunnels in one selector loop
+        On the first connection the server processes are started, the connections accepted by manager meanwhile
+        are relayed to goproxy; the tunnels without any connection for idle_timeout seconds go dormant again.
+        goproxy can't take over a listening socket or an accepted connection, so the listeners are closed before
+        it starts, and the connections arriving between closing and goproxy listening are refused.
+        :param idle_timeout: seconds without connection before the server processes are stopped
+        :param check_interval: seconds between two idle checks
+        :param relay_limit: max connections relayed at the same time, the ones over it are closed
+        """
+        super(LazyActivator, self).__init__()
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.relay_limit = relay_limit
+        self.relaying_count = 0
+        self.relay_dropped_count = 0
+        # Relayed connections of all the tunnels in one event loop, started on the first relay
+        self.__relay_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__relay_lock = Lock()
+        self.is_stop = False
+        self.daemon = True
+        self.activation_count = 0
+        self.deactivation_count = 0
+        self.__selector = selectors.DefaultSelector()
+        # Only touched in this thread
+        self.__listeners: Dict["MultiTunnel", List[socket.socket]] = dict()
+        self.__last_active: Dict["MultiTunnel", float] = dict()
+        # Calls from other threads, run in this thread
+        self.__calls = deque()
+        self.__calls_lock = Lock()
+        self.__wake_r, self.__wake_w = os.pipe()
+        os.set_blocking(self.__wake_r, False)
+        os.set_blocking(self.__wake_w, False)
+        self.__selector.register(self.__wake_r, selectors.EVENT_READ, None)
+
+    def __call(self, func: Callable, wait: bool = False):
+        done = Event()
+
+        def call():
+            try:
+                func()
+            finally:
+                done.set()
+
+        if current_thread() is self or self.is_stop or not self.is_alive():
+            # No loop to run it
+            call()
+            return
+        with MutexLock(self.__calls_lock) as _:
+            self.__calls.append(call)
+        try:
+            os.write(self.__wake_w, b"\0")
+        except BlockingIOError:
+            # Already woken up
+            pass
+        if wait:
+            done.wait(self.check_interval)
+
+    def register(self, tunnel: "MultiTunnel"):
+        """
+        Listen on the expose ports if tunnel is dormant, else watch it going idle
+        :param tunnel:
+        :return:
+        """
+        if not tunnel.dormant:
+            self.__call(lambda: self.__watch(tunnel))
+            return
+        listeners = []
+        try:
+            for expose in tunnel.exposes:
+                sock = socket.socket()
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                listeners.append(sock)
+                sock.bind(("", expose.expose_port))
+                sock.listen(128)
+                sock.setblocking(False)
+        except Exception:
+            for sock in listeners:
+                sock.close()
+            raise
+        self.__call(lambda: self.__listen(tunnel, listeners))
+
+    def unregister(self, tunnel: "MultiTunnel", then: Callable[[], None] = None):
+        """
+        Close the listeners of tunnel
+        :param tunnel:
+        :param then: if set, returns at once and it's called in this thread after the listeners are closed,
+        for callers which must not block like the event loop of ASGI server; else returns after they are closed
+        :return:
+        """
+        def forget():
+            try:
+                self.__forget(tunnel)
+            finally:
+                if then is not None:
+                    then()
+
+        self.__call(forget, wait=then is None)
+
+    def __watch(self, tunnel: "MultiTunnel"):
+        if not tunnel.stopped:
+            self.__last_active[tunnel] = time.time()
+
+    def __listen(self, tunnel: "MultiTunnel", listeners: List[socket.socket]):
+        if tunnel.stopped:
+            # Stopped before the listeners registered
+            for sock in listeners:
+                sock.close()
+            return
+        self.__listeners[tunnel] = listeners
+        for sock in listeners:
+            self.__selector.register(sock, selectors.EVENT_READ, tunnel)
+
+    def __close_listeners(self, tunnel: "MultiTunnel") -> List[Tuple[socket.socket, int]]:
+        """
+        Close the listeners and accept the connections in their backlog
+        :param tunnel:
+        :return: (connection, expose port)
+        """
+        pending = []
+        for sock in self.__listeners.pop(tunnel, []):
+            port = sock.getsockname()[1]
+            while True:
+                try:
+                    connection, _ = sock.accept()
+                    pending.append((connection, port))
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError as ex:
+                    log.error("Error while accepting connection at port {}.".format(port), exc_info=ex)
+                    break
+            self.__selector.unregister(sock)
+            sock.close()
+        return pending
+
+    def __forget(self, tunnel: "MultiTunnel"):
+        for connection, _ in self.__close_listeners(tunnel):
+            connection.close()
+        self.__last_active.pop(tunnel, None)
+
+    def __activate(self, tunnel: "MultiTunnel", pending: List[Tuple[socket.socket, int]]):
+        try:
+            if tunnel.activate():
+                self.activation_count += 1
+                ports = [expose.expose_port for expose in tunnel.exposes]
+                ready = wait_listening(ports, timeout=10)
+                if len(ready) < len(ports):
+                    log.warning("Ports {} are not listening after activated.".format(sorted(set(ports) - ready)))
+                self.__call(lambda: self.__watch(tunnel))
+                for connection, port in pending:
+                    self.__relay(connection, port)
+                return
+        except Exception as ex:
+            log.error("Error while activating lazy tunnel.", exc_info=ex)
+            self.__deactivate(tunnel)
+        for connection, _ in pending:
+            connection.close()
+
+    def __relay(self, connection: socket.socket, port: int):
+        """
+        Forward a connection accepted by manager to the local port till both sides closed
+        :param connection:
+        :param port:
+        :return:
+        """
+        with MutexLock(self.__relay_lock) as _:
+            if self.relaying_count >= self.relay_limit:
+                self.relay_dropped_count += 1
+                log.warning("Too many relayed connections, connection to port {} closed.".format(port))
+                connection.close()
+                return
+            self.relaying_count += 1
+            if self.__relay_loop is None:
+                self.__relay_loop = asyncio.new_event_loop()
+                Thread(target=self.__relay_loop.run_forever, daemon=True).start()
+            loop = self.__relay_loop
+        asyncio.run_coroutine_threadsafe(self.__relay_async(connection, port), loop)
+
+    async def __relay_async(self, connection: socket.socket, port: int):
+        try:
+            try:
+                upstream = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), 10)
+            except (asyncio.TimeoutError, OSError) as ex:
+                log.error("Error while relaying connection to port {}.".format(port), exc_info=ex)
+                connection.close()
+                return
+            try:
+                downstream = await asyncio.open_connection(sock=connection, limit=_RELAY_BUFFER_SIZE)
+            except OSError:
+                connection.close()
+                upstream[1].close()
+                return
+            await _join(downstream, upstream, _RELAY_BUFFER_SIZE)
+        finally:
+            with MutexLock(self.__relay_lock) as _:
+                self.relaying_count -= 1
+
+    def __deactivate(self, tunnel: "MultiTunnel"):
+        try:
+            if tunnel.deactivate():
+                self.deactivation_count += 1
+                self.register(tunnel)
+        except Exception as ex:
+            log.error("Error while deactivating lazy tunnel.", exc_info=ex)
+
+    def __check_idle(self):
+        now = time.time()
+        count_all, _ = count_connections()
+        for tunnel, last_active in list(self.__last_active.items()):
+            if tunnel.stopped:
+                del self.__last_active[tunnel]
+            elif any(count_all[expose.expose_port] > 0 for expose in tunnel.exposes):
+                self.__last_active[tunnel] = now
+            elif now - last_active >= self.idle_timeout:
+                del self.__last_active[tunnel]
+                log.info("Lazy tunnel at ports {} is idle, going dormant.".format(
+                    [expose.expose_port for expose in tunnel.exposes]
+                ))
+                Thread(target=self.__deactivate, args=(tunnel,), daemon=True).start()
+
+    def run(self) -> None:
+        last_check = time.time()
+        while not self.is_stop:
+            for key, _ in self.__selector.select(self.check_interval):
+                if key.data is None:
+                    try:
+                        os.read(self.__wake_r, 4096)
+                    except BlockingIOError:
+                        pass
+                elif key.data in self.__listeners:
+                    tunnel = key.data
+                    pending = self.__close_listeners(tunnel)
+                    Thread(target=self.__activate, args=(tunnel, pending), daemon=True).start()
+            with MutexLock(self.__calls_lock) as _:
+                calls, self.__calls = self.__calls, deque()
+            for call in calls:
+                try:
+                    call()
+                except Exception as ex:
+                    log.error("Error in lazy activator.", exc_info=ex)
+            if self.__last_active and time.time() - last_check >= self.check_interval:
+                last_check = time.time()
+                try:
+                    self.__check_idle()
+                except Exception as ex:
+                    log.error("Error while checking idle tunnels.", exc_info=ex)
+
+    def stop(self):
+        self.is_stop = True
+        self.__call(lambda: None)
+        with MutexLock(self.__relay_lock) as _:
+            if self.__relay_loop is not None:
+                self.__relay_loop.call_soon_threadsafe(self.__relay_loop.stop)
+
+    @property
+    def json(self):
+        return {
+            "idle_timeout": self.idle_timeout,
+            "dormant": len(self.__listeners),
+            "active": len(self.__last_active),
+            "activations": self.activation_count,
+            "deactivations": self.deactivation_count,
+            "relaying": self.relaying_count,
+            "relay_dropped": self.relay_dropped_count,
+        }
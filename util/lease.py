@@ -0,0 +1,115 @@
+"""
+Leases renewing a group of tunnels together
+"""
+import time
+from threading import Lock
+from typing import Dict, List, Optional, Set
+
+from util.lock import MutexLock
+
+
+class Lease:
+    def __init__(self, lid: int, expired: float = 60, comment: str = ""):
+        """
+        A deadline shared by its member tunnels, the members expire together with it
+        :param lid: lease id
+        :param expired: timeout in seconds, negative for permanent
+        :param comment:
+        """
+        self.id = lid
+        self.expire_time = expired
+        self.comment = comment
+        self.last_check_time = time.time()
+        # Ids of member tunnels, maintained by tunnel registry
+        self.members: Set[int] = set()
+        self.released = False
+        # In the expiry scheduler of TunnelsCheckThread
+        self.scheduled = False
+
+    def check(self):
+        """
+        Reset last check time
+        :return:
+        """
+        self.last_check_time = time.time()
+
+    @property
+    def valid(self) -> bool:
+        if self.expire_time >= 0:
+            return (time.time() - self.last_check_time) < self.expire_time
+        else:
+            return True
+
+    @property
+    def deadline(self) -> Optional[float]:
+        """
+        The time this lease expires at, None if it's permanent
+        :return:
+        """
+        if self.expire_time >= 0:
+            return self.last_check_time + self.expire_time
+        else:
+            return None
+
+    @property
+    def json(self):
+        return {
+            "id": self.id,
+            "comment": self.comment,
+            "expire_time": self.expire_time,
+            "last_check_time": self.last_check_time,
+            "from_last_check": time.time() - self.last_check_time,
+            "members": sorted(self.members),
+        }
+
+
+class LeaseRegistry:
+    def __init__(self):
+        """
+        Living leases by id
+        """
+        self.__lock = Lock()
+        self.__leases: Dict[int, Lease] = dict()
+        self.__last_id = 0
+
+    def create(self, expired: float = 60, comment: str = "", lid: int = None) -> Lease:
+        """
+        Create a lease
+        :param expired: timeout in seconds, negative for permanent
+        :param comment:
+        :param lid: id of the lease restored from journal, generated from current time in millisecond if None
+        :return:
+        """
+        with MutexLock(self.__lock) as _:
+            if lid is None:
+                lid = max(self.__last_id + 1, int(time.time() * 1000))
+            self.__last_id = max(self.__last_id, lid)
+            lease = Lease(lid, expired, comment)
+            self.__leases[lid] = lease
+            return lease
+
+    def get(self, lid: int) -> Optional[Lease]:
+        return self.__leases.get(lid)
+
+    def pop(self, lid: int) -> Optional[Lease]:
+        """
+        Remove the lease, the lease is marked released and can't take new members
+        :param lid:
+        :return: None if not found
+        """
+        with MutexLock(self.__lock) as _:
+            lease = self.__leases.pop(lid, None)
+            if lease is not None:
+                lease.released = True
+            return lease
+
+    def __len__(self) -> int:
+        return len(self.__leases)
+
+    def items(self) -> List[Lease]:
+        """
+        A snapshot of all the leases sorted by id
+        :return:
+        """
+        with MutexLock(self.__lock) as _:
+            return sorted(self.__leases.values(), key=lambda lease: lease.id)
@@ -1,17 +1,35 @@
+import time
 from threading import Lock
 
 
 class MutexLock:
-    def __init__(self, lock: Lock):
+    def __init__(self, lock: Lock, wait_histogram=None, hold_histogram=None):
+        """
+        Hold the lock in with block
+        :param lock:
+        :param wait_histogram: observe the seconds waiting for the lock if set
+        :param hold_histogram: observe the seconds holding the lock if set
+        """
         self.__lock = lock
+        self.__wait_histogram = wait_histogram
+        self.__hold_histogram = hold_histogram
+        self.__acquired_time = None
 
     def __enter__(self):
+        if self.__wait_histogram is None and self.__hold_histogram is None:
+            self.__lock.acquire(blocking=True)
+            return self
+        start = time.perf_counter()
         self.__lock.acquire(blocking=True)
+        self.__acquired_time = time.perf_counter()
+        if self.__wait_histogram is not None:
+            self.__wait_histogram.observe(self.__acquired_time - start)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.__hold_histogram is not None and self.__acquired_time is not None:
+            self.__hold_histogram.observe(time.perf_counter() - self.__acquired_time)
         try:
             self.__lock.release()
         except:
             pass
-
@@ -0,0 +1,335 @@
+"""
+Metrics of manager and tunnels in Prometheus text exposition format
+"""
+import asyncio
+import bisect
+import logging
+import time
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, Iterable, List, Tuple, TYPE_CHECKING
+
+from util.lock import MutexLock
+from util.procfs import read_process_usage
+
+if TYPE_CHECKING:
+    from util.registry import TunnelRegistry
+
+log = logging.getLogger(__file__)
+
+_DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Metrics and collectors in rendering order
+_metrics: List["_Metric"] = []
+_collectors: List[Callable[[], Iterable[str]]] = []
+
+
+def _format_labels(names: Iterable[str], values: Iterable) -> str:
+    return ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                    for name, value in zip(names, values))
+
+
+def _series(name: str, labels: str) -> str:
+    return "{}{{{}}}".format(name, labels) if labels else name
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _CounterChild:
+    def __init__(self):
+        self.__lock = Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        with MutexLock(self.__lock) as _:
+            self.value += amount
+
+    def render(self, name: str, labels: str) -> List[str]:
+        return ["{} {}".format(_series(name, labels), _format_value(self.value))]
+
+
+class _HistogramChild:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.__lock = Lock()
+        self.__buckets = buckets
+        # Not cumulative, the last one is +Inf
+        self.__counts = [0] * (len(buckets) + 1)
+        self.__sum = 0.0
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.__buckets, value)
+        with MutexLock(self.__lock) as _:
+            self.__counts[i] += 1
+            self.__sum += value
+
+    def time(self) -> "_Timer":
+        """
+        Observe the seconds spent in the with block
+        :return:
+        """
+        return _Timer(self)
+
+    def render(self, name: str, labels: str) -> List[str]:
+        with MutexLock(self.__lock) as _:
+            counts, total = list(self.__counts), self.__sum
+        prefix = labels + "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.__buckets + ("+Inf",), counts):
+            cumulative += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, prefix, bound, cumulative))
+        lines.append("{} {}".format(_series(name + "_sum", labels), repr(total)))
+        lines.append("{} {}".format(_series(name + "_count", labels), cumulative))
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: _HistogramChild):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.__lock = Lock()
+        self.__children = dict()
+        _metrics.append(self)
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+    def labels(self, *values):
+        """
+        The child of metric with label values, created at the first call
+        :param values: aligned with label names
+        :return:
+        """
+        child = self.__children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError("{} expects labels {}".format(self.name, self.label_names))
+            with MutexLock(self.__lock) as _:
+                child = self.__children.setdefault(values, self._new_child())
+        return child
+
+    def render(self) -> List[str]:
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+        for values, child in sorted(self.__children.items()):
+            lines += child.render(self.name, _format_labels(self.label_names, values))
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            label_names: Iterable[str] = (),
+            buckets: Iterable[float] = _DEFAULT_BUCKETS
+    ):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self) -> _Timer:
+        return self.labels().time()
+
+
+def register_collector(collector: Callable[[], Iterable[str]]):
+    """
+    Add a function generating exposition lines at rendering time, for the values owned by others
+    :param collector:
+    :return:
+    """
+    _collectors.append(collector)
+
+
+def render() -> str:
+    """
+    Render all the metrics and collectors
+    :return: text in Prometheus exposition format 0.0.4
+    """
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    for collector in _collectors:
+        try:
+            lines += collector()
+        except Exception as ex:
+            log.error("Error in metrics collector.", exc_info=ex)
+    lines.append("")
+    return "\n".join(lines)
+
+
+def _sample_lines(
+        metric_type: str, name: str, documentation: str, samples: Iterable[Tuple[Dict[str, object], float]]
+) -> List[str]:
+    lines = ["# HELP {} {}".format(name, documentation), "# TYPE {} {}".format(name, metric_type)]
+    for labels, value in samples:
+        lines.append("{} {}".format(
+            _series(name, _format_labels(labels.keys(), labels.values())),
+            _format_value(value)
+        ))
+    return lines
+
+
+def gauge_lines(name: str, documentation: str, samples: Iterable[Tuple[Dict[str, object], float]]) -> List[str]:
+    """
+    Render a gauge for collectors
+    :param name:
+    :param documentation:
+    :param samples: (labels, value)
+    :return:
+    """
+    return _sample_lines("gauge", name, documentation, samples)
+
+
+def counter_lines(name: str, documentation: str, samples: Iterable[Tuple[Dict[str, object], float]]) -> List[str]:
+    """
+    Render a counter sampled by collectors, e.g. cumulative values read from /proc
+    :param name: ends with `_total`
+    :param documentation:
+    :param samples: (labels, value)
+    :return:
+    """
+    return _sample_lines("counter", name, documentation, samples)
+
+
+def instrument(endpoint: str) -> Callable:
+    """
+    Count the requests by status and observe the latency of a view
+    :param endpoint: name of the endpoint in labels
+    :return:
+    """
+    latency = request_seconds.labels(endpoint)
+
+    def decorator(func):
+        def wrapper(request):
+            start = time.perf_counter()
+            response = func(request)
+            latency.observe(time.perf_counter() - start)
+            request_count.labels(endpoint, response.status_code).inc()
+            return response
+
+        async def async_wrapper(request):
+            start = time.perf_counter()
+            response = await func(request)
+            latency.observe(time.perf_counter() - start)
+            request_count.labels(endpoint, response.status_code).inc()
+            return response
+
+        return async_wrapper if asyncio.iscoroutinefunction(func) else wrapper
+
+    return decorator
+
+
+class TunnelUsageSampler(Thread):
+    def __init__(self, tunnels: "TunnelRegistry", interval: float = 15):
+        """
+        Sample the resource usage of the processes of all the tunnels from /proc
+        The exposition lines are rendered here once per interval, scraping only joins them.
+        :param tunnels: tunnels registry
+        :param interval: seconds between two samples
+        """
+        super(TunnelUsageSampler, self).__init__()
+        self.tunnels = tunnels
+        self.interval = interval
+        self.daemon = True
+        self.__stop_event = Event()
+        self.__lines: List[str] = []
+
+    def sample(self):
+        rss, cpu, fds = [], [], []
+        for tid, tunnel in self.tunnels.items():
+            usages = [read_process_usage(p.pid) for p in tunnel.processes if p.poll() is None]
+            usages = [u for u in usages if u is not None]
+            labels = {"id": tid}
+            rss.append((labels, sum(u[0] for u in usages)))
+            cpu.append((labels, sum(u[1] for u in usages)))
+            fds.append((labels, sum(u[2] for u in usages)))
+        self.__lines = (
+                gauge_lines("tunnel_manager_tunnel_rss_bytes",
+                            "Resident memory of the goproxy processes of tunnel.", rss) +
+                counter_lines("tunnel_manager_tunnel_cpu_seconds_total",
+                            "CPU time consumed by the goproxy processes of tunnel.", cpu) +
+                gauge_lines("tunnel_manager_tunnel_open_fds",
+                            "Open file descriptors of the goproxy processes of tunnel.", fds)
+        )
+
+    def collect(self) -> List[str]:
+        return self.__lines
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.sample()
+            except Exception as ex:
+                log.error("Error while sampling tunnel processes.", exc_info=ex)
+            if self.__stop_event.wait(self.interval):
+                break
+
+    def stop(self):
+        self.__stop_event.set()
+
+
+request_count = Counter(
+    "tunnel_manager_requests_total", "Requests handled by API endpoint and status code.", ("endpoint", "status")
+)
+request_seconds = Histogram(
+    "tunnel_manager_request_seconds", "Latency of API requests.", ("endpoint",)
+)
+lock_wait_seconds = Histogram(
+    "tunnel_manager_lock_wait_seconds", "Time waiting to acquire the lock.", ("lock",)
+)
+lock_hold_seconds = Histogram(
+    "tunnel_manager_lock_hold_seconds", "Time holding the lock.", ("lock",)
+)
+spawn_seconds = Histogram(
+    "tunnel_manager_process_spawn_seconds", "Time to spawn a goproxy process.", ("role",)
+)
+stop_seconds = Histogram(
+    "tunnel_manager_process_stop_seconds", "Time from SIGTERM till all the processes of a job exited.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+process_exits = Counter(
+    "tunnel_manager_process_exits_total", "Unexpected exits of tunnel processes.", ("role",)
+)
+process_restarts = Counter(
+    "tunnel_manager_process_restarts_total", "Tunnels restarted by supervisor after their processes crashed."
+)
+auth_failures = Counter(
+    "tunnel_manager_auth_failures_total", "Requests rejected by authorization, unauthorized or throttled.", ("result",)
+)
@@ -0,0 +1,245 @@
+"""
+Permanent tunnels kept in line with a desired-state document, reloaded when permanent.json changes
+"""
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import struct
+import sys
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+
+from util.lock import MutexLock
+
+log = logging.getLogger(__file__)
+
+
+def permanent_key(item: dict) -> str:
+    """
+    Key of the entry to tell changed entries from added ones: `name`, or the whole entry without `name`
+    :param item:
+    :return:
+    """
+    if item.get("name") is not None:
+        return str(item["name"])
+    return json.dumps(item, sort_keys=True)
+
+
+class PermanentReconciler:
+    def __init__(
+            self, start: Callable[[dict], int], stop: Callable[[int, bool], None], alive: Callable[[int], bool]
+    ):
+        """
+        Diff the desired entries with the running ones by key, only the added, removed and changed entries are touched
+        :param start: start a tunnel of the entry, return its id
+        :param stop: detach and stop the tunnel of id, wait till its processes exited and ports released if the
+        flag is set, the changed and restarted entries are started again on the same pinned ports right after
+        :param alive: whether the tunnel of id is still in registry
+        """
+        self.__start = start
+        self.__stop = stop
+        self.__alive = alive
+        self.__lock = Lock()
+        # key -> (entry, tunnel id)
+        self.__running: Dict[str, Tuple[dict, int]] = dict()
+        self.reconcile_count = 0
+
+    def adopt(self, item: dict, tid: int):
+        """
+        Take a running tunnel as the one of entry, e.g. restored from journal
+        :param item:
+        :param tid:
+        :return:
+        """
+        with MutexLock(self.__lock) as _:
+            self.__running[permanent_key(item)] = (item, tid)
+
+    def reconcile(self, document: List[dict]) -> dict:
+        """
+        Stop the removed and changed entries, then start the added, changed and missing ones
+        Failed entries are not recorded as running, and retried by next reconciling.
+        :param document: all the desired entries
+        :return: keys of added, removed, changed, restarted (missing from registry) and failed entries,
+        invalid and duplicate entries are failed without touching the others
+        """
+        desired: Dict[str, dict] = dict()
+        failed = dict()
+        for index, item in enumerate(document):
+            if not isinstance(item, dict):
+                failed["#{}".format(index)] = "Permanent tunnel should be a JSON object"
+                continue
+            key = permanent_key(item)
+            if key in desired:
+                failed[key] = "Duplicate permanent tunnel, entry #{} is the same as a former one".format(index)
+                continue
+            desired[key] = item
+        with MutexLock(self.__lock) as _:
+            removed = [key for key in self.__running if key not in desired]
+            changed = [key for key in desired if key in self.__running and self.__running[key][0] != desired[key]]
+            restarted = [
+                key for key in desired
+                if key in self.__running and key not in changed and not self.__alive(self.__running[key][1])
+            ]
+            added = [key for key in desired if key not in self.__running]
+            for key in removed + changed + restarted:
+                _, tid = self.__running.pop(key)
+                self.__stop(tid, key not in removed)
+            for key in added + changed + restarted:
+                try:
+                    self.__running[key] = (desired[key], self.__start(desired[key]))
+                except Exception as ex:
+                    log.error("Error while starting permanent tunnel {}.".format(key), exc_info=ex)
+                    failed[key] = str(ex)
+            self.reconcile_count += 1
+            return {
+                "added": added,
+                "removed": removed,
+                "changed": changed,
+                "restarted": restarted,
+                "unchanged": len(desired) - len(added) - len(changed) - len(restarted),
+                "failed": failed,
+            }
+
+    @property
+    def json(self):
+        with MutexLock(self.__lock) as _:
+            return [
+                {"key": key, "id": tid, "config": item}
+                for key, (item, tid) in self.__running.items()
+            ]
+
+
+# Flags of inotify(7)
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+# wd, mask, cookie, len of struct inotify_event
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _inotify_watch(path: str) -> Optional[int]:
+    """
+    Watch the directory of path by inotify, files replaced by rename are caught too
+    :param path:
+    :return: fd of inotify, None if not available
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    directory = os.path.dirname(os.path.abspath(path))
+    mask = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+    if libc.inotify_add_watch(fd, directory.encode(), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _file_signature(path: str) -> Optional[tuple]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class PermanentFileWatcher(Thread):
+    def __init__(self, path: str, callback: Callable[[], None], interval: float = 2, settle: float = 0.2):
+        """
+        Call back when the file changed, by inotify on Linux and by polling mtime elsewhere
+        :param path: file to watch
+        :param callback: called in this thread
+        :param interval: seconds between polling mtime if inotify is not available
+        :param settle: seconds to wait for the following writes of the same save
+        """
+        super(PermanentFileWatcher, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.callback = callback
+        self.interval = interval
+        self.settle = settle
+        self.mode = None
+        self.reload_count = 0
+        self.__stop_event = Event()
+
+    def __reload(self):
+        self.reload_count += 1
+        try:
+            self.callback()
+        except Exception as ex:
+            log.error("Error while reloading {}.".format(self.path), exc_info=ex)
+
+    @staticmethod
+    def __drain(fd: int, name: bytes) -> bool:
+        """
+        Read all the pending events
+        :param fd:
+        :param name: file name in the watched directory
+        :return: whether any of them is about the file
+        """
+        changed = False
+        while True:
+            try:
+                buffer = os.read(fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(buffer):
+                _, _, _, length = _EVENT_HEADER.unpack_from(buffer, offset)
+                offset += _EVENT_HEADER.size
+                if buffer[offset:offset + length].rstrip(b"\0") == name:
+                    changed = True
+                offset += length
+
+    def __watch_inotify(self, fd: int):
+        name = os.path.basename(self.path).encode()
+        while not self.__stop_event.is_set():
+            if not select.select([fd], [], [], 1)[0] or not self.__drain(fd, name):
+                continue
+            # Take the following events of the same save together
+            while not self.__stop_event.wait(self.settle) and select.select([fd], [], [], 0)[0]:
+                self.__drain(fd, name)
+            if not self.__stop_event.is_set():
+                self.__reload()
+
+    def __watch_mtime(self):
+        signature = _file_signature(self.path)
+        while not self.__stop_event.wait(self.interval):
+            current = _file_signature(self.path)
+            if current != signature:
+                signature = current
+                self.__reload()
+
+    def run(self) -> None:
+        fd = _inotify_watch(self.path)
+        if fd is None:
+            self.mode = "mtime"
+            self.__watch_mtime()
+            return
+        self.mode = "inotify"
+        try:
+            self.__watch_inotify(fd)
+        finally:
+            os.close(fd)
+
+    def stop(self):
+        self.__stop_event.set()
+
+    @property
+    def json(self):
+        return {
+            "path": self.path,
+            "mode": self.mode,
+            "reloads": self.reload_count,
+        }
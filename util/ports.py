@@ -0,0 +1,328 @@
+"""
+Port management of tunnels
+"""
+import errno
+import logging
+import selectors
+import socket
+import time
+from collections import deque
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Set, Tuple, Union
+
+from util.lock import MutexLock
+
+log = logging.getLogger(__file__)
+
+_PORT_COUNT = 65536
+
+
+def parse_port_range(text: str) -> Tuple[int, int]:
+    """
+    Parse port range like "20000-24999" (both included)
+    :param text:
+    :return:
+    """
+    low, high = (int(s) for s in text.split("-"))
+    if not 0 < low <= high < _PORT_COUNT:
+        raise ValueError("Invalid port range: {}".format(text))
+    return low, high
+
+
+class _Bitmap:
+    def __init__(self, size: int):
+        self.__data = bytearray((size + 7) // 8)
+
+    def __getitem__(self, i: int) -> bool:
+        return bool(self.__data[i >> 3] & (1 << (i & 7)))
+
+    def __setitem__(self, i: int, value: bool):
+        if value:
+            self.__data[i >> 3] |= 1 << (i & 7)
+        else:
+            self.__data[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+
+
+def _is_bindable(port: int) -> bool:
+    """
+    Check if the port is not occupied by other processes
+    :param port:
+    :return:
+    """
+    sock = socket.socket()
+    try:
+        sock.bind(('', port))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+class PortAllocator:
+    BRIDGE = "bridge"
+    EXPOSE = "expose"
+
+    def __init__(
+            self,
+            bridge_range: Tuple[int, int] = (20000, 24999),
+            expose_range: Tuple[int, int] = (25000, 29999)
+    ):
+        """
+        Allocate ports for tunnels from configured ranges
+        Taken ports are marked in a bitmap covering all the ports, so both allocated and pinned ports are
+        never booked twice. A port is reserved until the goproxy process is confirmed listening on it.
+        :param bridge_range: (low, high) both included
+        :param expose_range: (low, high) both included
+        """
+        self.__lock = Lock()
+        self.__taken = _Bitmap(_PORT_COUNT)
+        self.__listening = _Bitmap(_PORT_COUNT)
+        # Ports in the free lists
+        self.__queued = _Bitmap(_PORT_COUNT)
+        self.__ranges = {
+            PortAllocator.BRIDGE: bridge_range,
+            PortAllocator.EXPOSE: expose_range,
+        }
+        self.__free = {
+            kind: deque(range(low, high + 1)) for kind, (low, high) in self.__ranges.items()
+        }
+        for low, high in self.__ranges.values():
+            for port in range(low, high + 1):
+                self.__queued[port] = True
+        self.__reserved_count = 0
+        self.__taken_count = 0
+
+    def __kind_of(self, port: int):
+        for kind, (low, high) in self.__ranges.items():
+            if low <= port <= high:
+                return kind
+        return None
+
+    def allocate(self, kind: str) -> int:
+        """
+        Reserve a free port in the range of kind
+        :param kind: PortAllocator.BRIDGE or PortAllocator.EXPOSE
+        :return:
+        """
+        return self.reserve([kind])[0]
+
+    def __take_free(self, kind: str) -> int:
+        free = self.__free[kind]
+        while len(free) > 0:
+            port = free.popleft()
+            self.__queued[port] = False
+            if self.__taken[port]:
+                # Pinned by user while in free list
+                continue
+            self.__take(port)
+            return port
+        raise RuntimeError("No free port left in {} range {}-{}".format(kind, *self.__ranges[kind]))
+
+    def __bind_allocated(self, wanted: List[Union[int, str]], reserved: List[int]) -> List[int]:
+        """
+        Check the allocated ports are not occupied by other processes, sockets are bound out of the lock
+        Occupied ports are moved to the tail of free list and replaced, each port of range is tried once at most
+        :param wanted:
+        :param reserved: ports aligned with wanted, released all if failed
+        :return:
+        """
+        reserved = list(reserved)
+        tries = {kind: high - low + 1 for kind, (low, high) in self.__ranges.items()}
+        pending = [i for i, item in enumerate(wanted) if isinstance(item, str)]
+        while len(pending) > 0:
+            occupied = [i for i in pending if not _is_bindable(reserved[i])]
+            if len(occupied) <= 0:
+                break
+            with MutexLock(self.__lock) as _:
+                try:
+                    for i in occupied:
+                        kind = wanted[i]
+                        tries[kind] -= 1
+                        self.__release(reserved[i])
+                        if tries[kind] <= 0:
+                            raise RuntimeError("No free port left in {} range {}-{}".format(kind, *self.__ranges[kind]))
+                        reserved[i] = self.__take_free(kind)
+                except Exception:
+                    for port in reserved:
+                        self.__release(port)
+                    raise
+            pending = occupied
+        return reserved
+
+    def claim(self, port: int):
+        """
+        Reserve a port pinned by user
+        :param port:
+        :return:
+        """
+        with MutexLock(self.__lock) as _:
+            self.__claim(port)
+
+    def __claim(self, port: int):
+        if self.__taken[port]:
+            raise ValueError("Port {} is used by another tunnel".format(port))
+        self.__take(port)
+
+    def reserve(self, wanted: List[Union[int, str]]) -> List[int]:
+        """
+        Claim the pinned ports and allocate the others in one lock acquisition, all or nothing
+        :param wanted: pinned port, or PortAllocator.BRIDGE/PortAllocator.EXPOSE to allocate
+        :return: ports aligned with wanted
+        """
+        with MutexLock(self.__lock) as _:
+            reserved = self.__reserve(wanted)
+        return self.__bind_allocated(wanted, reserved)
+
+    def reserve_many(self, wanted_list: List[List[Union[int, str]]]) -> List[Union[List[int], Exception]]:
+        """
+        Reserve the ports of many tunnels in one lock acquisition, all or nothing for each tunnel
+        A tunnel failed to reserve doesn't affect the others, including the later ones pinning the same ports
+        :param wanted_list: wanted ports of each tunnel, see `reserve`
+        :return: ports aligned with each wanted, or the error if ports of that tunnel can't be reserved
+        """
+        results = []
+        with MutexLock(self.__lock) as _:
+            for wanted in wanted_list:
+                try:
+                    results.append(self.__reserve(wanted))
+                except (ValueError, RuntimeError) as ex:
+                    results.append(ex)
+        for i, (wanted, reserved) in enumerate(zip(wanted_list, results)):
+            if not isinstance(reserved, Exception):
+                try:
+                    results[i] = self.__bind_allocated(wanted, reserved)
+                except RuntimeError as ex:
+                    results[i] = ex
+        return results
+
+    def __reserve(self, wanted: List[Union[int, str]]) -> List[int]:
+        reserved = []
+        try:
+            for item in wanted:
+                if isinstance(item, str):
+                    reserved.append(self.__take_free(item))
+                else:
+                    self.__claim(item)
+                    reserved.append(item)
+        except Exception:
+            for port in reserved:
+                self.__release(port)
+            raise
+        return reserved
+
+    def __take(self, port: int):
+        self.__taken[port] = True
+        self.__taken_count += 1
+        self.__reserved_count += 1
+
+    def confirm(self, port: int):
+        """
+        Mark the reserved port is listened by goproxy
+        :param port:
+        :return:
+        """
+        with MutexLock(self.__lock) as _:
+            if self.__taken[port] and not self.__listening[port]:
+                self.__listening[port] = True
+                self.__reserved_count -= 1
+
+    def release(self, port: int):
+        """
+        Return the port to pool
+        :param port:
+        :return:
+        """
+        with MutexLock(self.__lock) as _:
+            self.__release(port)
+
+    def __release(self, port: int):
+        if not self.__taken[port]:
+            return
+        if not self.__listening[port]:
+            self.__reserved_count -= 1
+        self.__taken[port] = False
+        self.__listening[port] = False
+        self.__taken_count -= 1
+        kind = self.__kind_of(port)
+        if kind is not None and not self.__queued[port]:
+            self.__free[kind].append(port)
+            self.__queued[port] = True
+
+    def is_taken(self, port: int) -> bool:
+        return self.__taken[port]
+
+    @property
+    def json(self):
+        return {
+            "ranges": {kind: "{}-{}".format(*r) for kind, r in self.__ranges.items()},
+            "taken": self.__taken_count,
+            "reserved": self.__reserved_count,
+        }
+
+
+def probe_listening(
+        ports: Iterable[int],
+        timeout: float,
+        interval: float = 0.02,
+        on_ready: Callable[[int, float], None] = None,
+        abort: Callable[[], bool] = None
+) -> Dict[int, float]:
+    """
+    Probe the local ports concurrently with non-blocking connections until all of them are listening or timeout
+    :param ports:
+    :param timeout: seconds
+    :param interval: retry interval of the refused ports
+    :param on_ready: called with port and seconds since probing started once a port is listening
+    :param abort: checked every round, stop probing if it returns True
+    :return: seconds till each port confirmed listening
+    """
+    start = time.time()
+    deadline = start + timeout
+    pending = set(ports)
+    ready = dict()
+    selector = selectors.DefaultSelector()
+    try:
+        while pending and time.time() < deadline:
+            for port in pending:
+                sock = socket.socket()
+                sock.setblocking(False)
+                err = sock.connect_ex(("127.0.0.1", port))
+                if err in (0, errno.EINPROGRESS, errno.EAGAIN):
+                    selector.register(sock, selectors.EVENT_WRITE, port)
+                else:
+                    sock.close()
+            while selector.get_map():
+                events = selector.select(max(min(interval, deadline - time.time()), 0))
+                if not events:
+                    break
+                for key, _ in events:
+                    sock = key.fileobj
+                    if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                        ready[key.data] = time.time() - start
+                        if on_ready is not None:
+                            on_ready(key.data, ready[key.data])
+                    selector.unregister(sock)
+                    sock.close()
+            for key in list(selector.get_map().values()):
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+            pending -= ready.keys()
+            if pending and abort is not None and abort():
+                break
+            if pending:
+                time.sleep(max(min(interval, deadline - time.time()), 0))
+    finally:
+        selector.close()
+    return ready
+
+
+def wait_listening(ports: Iterable[int], timeout: float, interval: float = 0.02) -> Set[int]:
+    """
+    Probe the local ports concurrently with non-blocking connections until all of them are listening or timeout
+    :param ports:
+    :param timeout: seconds
+    :param interval: retry interval of the refused ports
+    :return: ports confirmed listening
+    """
+    return set(probe_listening(ports, timeout, interval))
@@ -0,0 +1,143 @@
+"""
+Process information from /proc
+"""
+import os
+import signal
+import subprocess
+import time
+from typing import List, Optional, Tuple
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def read_stat(pid: int) -> Optional[List[str]]:
+    """
+    Fields of /proc/<pid>/stat after the command name, the first one is state (field 3 in proc(5))
+    :param pid:
+    :return: None if the process not exists or /proc not available
+    """
+    try:
+        with open("/proc/{}/stat".format(pid), "rb") as fp:
+            content = fp.read().decode()
+    except OSError:
+        return None
+    # Command name may contain spaces and brackets
+    return content[content.rindex(")") + 2:].split()
+
+
+def read_start_time(pid: int) -> Optional[int]:
+    """
+    Start time of process in clock ticks after boot, identifies a process together with pid
+    :param pid:
+    :return: None if the process not exists
+    """
+    stat = read_stat(pid)
+    return int(stat[19]) if stat is not None else None
+
+
+def read_process_usage(pid: int) -> Optional[Tuple[int, float, int]]:
+    """
+    Resource usage of a process
+    :param pid:
+    :return: (rss in bytes, cpu seconds in user and kernel mode, count of open fds), None if the process not exists
+    """
+    stat = read_stat(pid)
+    if stat is None:
+        return None
+    try:
+        fd_count = len(os.listdir("/proc/{}/fd".format(pid)))
+    except OSError:
+        fd_count = 0
+    return int(stat[21]) * _PAGE_SIZE, (int(stat[11]) + int(stat[12])) / _CLOCK_TICKS, fd_count
+
+
+def read_io(pid: int) -> Optional[Tuple[int, int]]:
+    """
+    Bytes read and written by a process, including sockets
+    :param pid:
+    :return: (rchar, wchar), None if the process not exists or not permitted
+    """
+    try:
+        with open("/proc/{}/io".format(pid), "rb") as fp:
+            fields = dict(line.split(b": ") for line in fp.read().splitlines())
+    except OSError:
+        return None
+    return int(fields[b"rchar"]), int(fields[b"wchar"])
+
+
+def read_cmdline(pid: int) -> Optional[List[str]]:
+    try:
+        with open("/proc/{}/cmdline".format(pid), "rb") as fp:
+            return [arg.decode() for arg in fp.read().split(b"\0")[:-1]]
+    except OSError:
+        return None
+
+
+def process_start_time(process) -> Optional[int]:
+    """
+    Start time of a Popen/AdoptedProcess, cached in the object
+    :param process:
+    :return:
+    """
+    start_time = getattr(process, "start_time", None)
+    if start_time is None:
+        start_time = read_start_time(process.pid)
+        process.start_time = start_time
+    return start_time
+
+
+class AdoptedProcess:
+    def __init__(self, pid: int, start_time: int, args: List[str]):
+        """
+        A process started by the previous manager, works like Popen
+        It's not our child, so the exit code is unknown and reported as 0
+        :param pid:
+        :param start_time: start time read from /proc/<pid>/stat when it's started
+        :param args: command line
+        """
+        self.pid = pid
+        self.start_time = start_time
+        self.args = args
+        self.returncode = None
+
+    @staticmethod
+    def adopt(pid: int, start_time: int, args: List[str]) -> Optional["AdoptedProcess"]:
+        """
+        Verify the identity of process by start time and command line
+        :param pid:
+        :param start_time:
+        :param args:
+        :return: None if it's not the same process or exited
+        """
+        process = AdoptedProcess(pid, start_time, args)
+        cmdline = read_cmdline(pid)
+        # Interpreter is prepended if it's a script
+        if process.poll() is None and cmdline is not None and cmdline[-len(args):] == list(args):
+            return process
+        return None
+
+    def poll(self) -> Optional[int]:
+        if self.returncode is None:
+            stat = read_stat(self.pid)
+            if stat is None or stat[0] in ("Z", "X") or int(stat[19]) != self.start_time:
+                self.returncode = 0
+        return self.returncode
+
+    def wait(self, timeout: float = None) -> int:
+        deadline = None if timeout is None else time.time() + timeout
+        while self.poll() is None:
+            if deadline is not None and time.time() > deadline:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            time.sleep(0.05)
+        return self.returncode
+
+    def send_signal(self, sig: int):
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
@@ -0,0 +1,89 @@
+"""
+Token bucket rate limiter with bounded memory
+"""
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Hashable, List
+
+from util.lock import MutexLock
+
+
+class TokenBucketLimiter:
+    def __init__(self, rate: float, burst: float, capacity: int = 10000):
+        """
+        A token bucket per key, every consume takes one token
+        Full buckets are dropped, and the least recently consumed one is evicted beyond capacity,
+        so memory is bounded however many keys show up.
+        :param rate: tokens refilled per second, must be positive
+        :param burst: tokens of a full bucket
+        :param capacity: max buckets kept
+        """
+        if rate <= 0:
+            raise ValueError("Rate of token bucket should be positive")
+        self.rate = rate
+        self.burst = burst
+        self.capacity = capacity
+        self.limited_count = 0
+        self.evicted_count = 0
+        self.__lock = Lock()
+        # key -> [tokens, time of last refill]
+        self.__buckets: "OrderedDict[Hashable, List[float]]" = OrderedDict()
+
+    def __refill(self, key: Hashable, now: float):
+        bucket = self.__buckets.get(key)
+        if bucket is None:
+            return None
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] >= self.burst:
+            # Same as a new one
+            del self.__buckets[key]
+            return None
+        return bucket
+
+    def retry_after(self, key: Hashable) -> float:
+        """
+        Seconds until the bucket of key has a token again, without taking it
+        :param key:
+        :return: 0 if a token is available
+        """
+        with MutexLock(self.__lock) as _:
+            bucket = self.__refill(key, time.monotonic())
+            if bucket is None or bucket[0] >= 1:
+                return 0
+            self.limited_count += 1
+            return (1 - bucket[0]) / self.rate
+
+    def consume(self, key: Hashable):
+        """
+        Take a token from the bucket of key, the bucket never goes below empty
+        :param key:
+        :return:
+        """
+        with MutexLock(self.__lock) as _:
+            now = time.monotonic()
+            bucket = self.__refill(key, now)
+            if bucket is None:
+                bucket = [float(self.burst), now]
+                self.__buckets[key] = bucket
+                if len(self.__buckets) > self.capacity:
+                    self.__buckets.popitem(last=False)
+                    self.evicted_count += 1
+            else:
+                self.__buckets.move_to_end(key)
+            bucket[0] = max(bucket[0] - 1, 0)
+
+    def __len__(self) -> int:
+        return len(self.__buckets)
+
+    @property
+    def json(self):
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "tracked": len(self.__buckets),
+            "capacity": self.capacity,
+            "limited": self.limited_count,
+            "evicted": self.evicted_count,
+        }
@@ -0,0 +1,390 @@
+"""
+Terminate goproxy processes concurrently and off the request path
+"""
+import logging
+import os
+import selectors
+import signal
+import time
+from collections import deque
+from subprocess import Popen
+from threading import Event, Lock, Thread
+from typing import Callable, Iterable, List, Optional, Set
+
+from util import metrics
+
+log = logging.getLogger(__file__)
+
+# Seconds to wait for the killed processes in shutdown
+_KILL_GRACE = 1
+
+
+def _open_pidfd(pid: Optional[int]) -> Optional[int]:
+    """
+    Open a pidfd which becomes readable when the process exits, None if it's not supported
+    :param pid:
+    :return:
+    """
+    if pid is None or not hasattr(os, "pidfd_open"):
+        # Not supported, or not an OS process
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        return None
+
+
+class _Job:
+    def __init__(self, name: str, processes: List[Popen], timeout: float, callback: Callable = None):
+        self.name = name
+        self.processes = [p for p in processes if p is not None]
+        self.pending = set()
+        self.timeout = timeout
+        self.callback = callback
+        self.submit_time = time.time()
+        self.start_time = None
+        self.deadline = None
+        self.killed = False
+        # Set after all processes exited and callback returned
+        self.done = Event()
+
+    @property
+    def json(self):
+        return {
+            "name": self.name,
+            "pids": [p.pid for p in self.processes],
+            "pending_pids": sorted(p.pid for p in self.pending),
+            "submit_time": self.submit_time,
+            "killed": self.killed,
+        }
+
+
+class _TerminationSet:
+    def __init__(self, poll_interval: float = 0.05):
+        """
+        Processes being terminated, exits are awaited all together with pidfd
+        Fallback to poll the processes on platforms without pidfd
+        :param poll_interval: polling interval of the fallback mode
+        """
+        self.selector = selectors.DefaultSelector()
+        self.poll_interval = poll_interval
+        self.jobs: List[_Job] = []
+        self.__unwatched = set()
+        self.stopped_count = 0
+        self.killed_count = 0
+
+    def add(self, job: _Job, deadline: float = None):
+        """
+        Send SIGTERM to all the processes of job and start watching them
+        :param job:
+        :param deadline: time to kill the processes, after job timeout by default
+        :return:
+        """
+        job.start_time = time.time()
+        job.deadline = job.start_time + job.timeout if deadline is None else deadline
+        for process in job.processes:
+            if process.poll() is not None:
+                continue
+            try:
+                process.terminate()
+            except OSError as ex:
+                log.error("Error while terminating PID {}.".format(process.pid), exc_info=ex)
+            job.pending.add(process)
+            pidfd = _open_pidfd(process.pid)
+            if pidfd is None:
+                self.__unwatched.add((job, process))
+            else:
+                self.selector.register(pidfd, selectors.EVENT_READ, (job, process))
+        self.jobs.append(job)
+
+    def __reap(self, job: _Job, process: Popen):
+        process.poll()
+        if process.returncode is None:
+            return False
+        job.pending.discard(process)
+        self.stopped_count += 1
+        return True
+
+    def step(self, max_wait: float = None) -> List[_Job]:
+        """
+        Wait process exiting events till the earliest deadline or max_wait, escalate the overdue jobs
+        :param max_wait:
+        :return: jobs which all processes exited
+        """
+        timeout = max_wait
+        deadlines = [job.deadline for job in self.jobs if not job.killed]
+        if deadlines:
+            until_deadline = max(min(deadlines) - time.time(), 0)
+            timeout = until_deadline if timeout is None else min(timeout, until_deadline)
+        if self.__unwatched:
+            timeout = self.poll_interval if timeout is None else min(timeout, self.poll_interval)
+        if any(not job.pending for job in self.jobs):
+            # Exited before added, finish them at once
+            timeout = 0
+
+        for key, _ in self.selector.select(timeout):
+            if key.data is None:
+                continue
+            job, process = key.data
+            if self.__reap(job, process):
+                self.selector.unregister(key.fileobj)
+                os.close(key.fileobj)
+        for job, process in list(self.__unwatched):
+            if self.__reap(job, process):
+                self.__unwatched.discard((job, process))
+
+        now = time.time()
+        for job in self.jobs:
+            if job.pending and not job.killed and job.deadline <= now:
+                for process in job.pending:
+                    log.warning("PID {} of {} not exited in {} seconds, killing it.".format(
+                        process.pid, job.name, job.timeout
+                    ))
+                    try:
+                        process.kill()
+                        self.killed_count += 1
+                    except OSError as ex:
+                        log.error("Error while killing PID {}.".format(process.pid), exc_info=ex)
+                job.killed = True
+
+        finished = [job for job in self.jobs if not job.pending]
+        for job in finished:
+            metrics.stop_seconds.observe(now - job.start_time)
+        self.jobs = [job for job in self.jobs if job.pending]
+        return finished
+
+
+def terminate_processes(processes: Iterable[Popen], timeout: float = 5):
+    """
+    Terminate the processes at once and wait them together, kill the ones still alive after timeout
+    :param processes:
+    :param timeout:
+    :return:
+    """
+    termination = _TerminationSet()
+    termination.add(_Job("processes", list(processes), timeout))
+    while termination.jobs:
+        termination.step()
+
+
+class ProcessReaper(Thread):
+    def __init__(self, timeout: float = 5):
+        """
+        A thread terminating the submitted processes in background
+        :param timeout: seconds to wait after SIGTERM before SIGKILL
+        """
+        super(ProcessReaper, self).__init__()
+        self.timeout = timeout
+        self.is_stop = False
+        self.daemon = True
+        self.__queue = deque()
+        self.__queue_lock = Lock()
+        # Jobs submitted and not finished, queued or being terminated
+        self.__unfinished: List[_Job] = []
+        self.__termination = _TerminationSet()
+        self.__wake_r, self.__wake_w = os.pipe()
+        os.set_blocking(self.__wake_r, False)
+        os.set_blocking(self.__wake_w, False)
+        self.__termination.selector.register(self.__wake_r, selectors.EVENT_READ, None)
+        self.finished_count = 0
+
+    def submit(self, name: str, processes: Iterable[Popen], callback: Callable = None):
+        """
+        Queue processes to terminate, return immediately
+        :param name: name for logging, like tunnel id
+        :param processes:
+        :param callback: called in reaper thread without parameter after all processes exited
+        :return:
+        """
+        job = _Job(name, list(processes), self.timeout, callback)
+        with self.__queue_lock:
+            self.__queue.append(job)
+            self.__unfinished.append(job)
+        self.__wake()
+
+    def wait(self, name: str, timeout: float = None) -> bool:
+        """
+        Wait for the jobs of name submitted before, e.g. till the ports of a stopped tunnel released
+        :param name: name of the jobs
+        :param timeout: seconds
+        :return: False if any of them is not finished in timeout
+        """
+        with self.__queue_lock:
+            jobs = [job for job in self.__unfinished if job.name == name]
+        deadline = None if timeout is None else time.time() + timeout
+        for job in jobs:
+            if not job.done.wait(None if deadline is None else max(deadline - time.time(), 0)):
+                return False
+        return True
+
+    def __wake(self):
+        try:
+            os.write(self.__wake_w, b"\0")
+        except BlockingIOError:
+            # Already woken up
+            pass
+
+    def run(self) -> None:
+        while not self.is_stop:
+            try:
+                os.read(self.__wake_r, 4096)
+            except BlockingIOError:
+                pass
+            with self.__queue_lock:
+                queued, self.__queue = self.__queue, deque()
+            for job in queued:
+                log.info("Terminating {} (PID: {}).".format(job.name, [p.pid for p in job.processes]))
+                self.__termination.add(job)
+            for job in self.__termination.step():
+                self.finished_count += 1
+                log.info("{} terminated in {:.3f} seconds.".format(job.name, time.time() - job.submit_time))
+                if job.callback is not None:
+                    try:
+                        job.callback()
+                    except Exception as ex:
+                        log.error("Error in callback of {}.".format(job.name), exc_info=ex)
+                with self.__queue_lock:
+                    self.__unfinished.remove(job)
+                job.done.set()
+
+    def stop(self):
+        self.is_stop = True
+        self.__wake()
+
+    def drain(self) -> List[_Job]:
+        """
+        Take the queued jobs and the processes still being terminated, call it after the thread stopped
+        :return: jobs of the processes not exited yet
+        """
+        with self.__queue_lock:
+            queued, self.__queue = list(self.__queue), deque()
+        terminating, self.__termination.jobs = self.__termination.jobs, []
+        for job in terminating:
+            job.processes = list(job.pending)
+        return terminating + queued
+
+    @property
+    def json(self):
+        """
+        Status of the termination queue
+        :return:
+        """
+        with self.__queue_lock:
+            queued = [job.json for job in self.__queue]
+        terminating = [job.json for job in list(self.__termination.jobs)]
+        return {
+            "queued": queued,
+            "terminating": terminating,
+            "finished_jobs": self.finished_count,
+            "stopped_processes": self.__termination.stopped_count,
+            "killed_processes": self.__termination.killed_count,
+        }
+
+
+class ShutdownCoordinator:
+    def __init__(self, timeout: float = 10):
+        """
+        Stop the processes of all the tunnels at once within timeout
+        SIGTERM is sent to every process group together, all the exits are awaited against one deadline,
+        then the groups still alive are killed.
+        Works like ProcessReaper for `MultiTunnel.stop`, processes submitted are stopped by `run`.
+        :param timeout: seconds from run till SIGKILL
+        """
+        self.timeout = timeout
+        self.jobs: List[_Job] = []
+
+    def submit(self, name: str, processes: Iterable[Popen], callback: Callable = None):
+        self.jobs.append(_Job(name, list(processes), self.timeout, callback))
+
+    def add(self, job: _Job):
+        """
+        Take a job left in ProcessReaper
+        :param job:
+        :return:
+        """
+        self.jobs.append(job)
+
+    @staticmethod
+    def __has_members(group: int) -> bool:
+        """
+        If any process is still in the group, an empty group's id may be taken by a new process
+        :param group:
+        :return:
+        """
+        try:
+            os.killpg(group, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # Not ours any more
+            return False
+
+    @staticmethod
+    def __signal_groups(groups: Set[int], sig: int) -> int:
+        signaled = 0
+        for group in groups:
+            try:
+                os.killpg(group, sig)
+                signaled += 1
+            except ProcessLookupError:
+                # All the members exited
+                pass
+            except OSError as ex:
+                log.error("Error while signaling process group {}.".format(group), exc_info=ex)
+        return signaled
+
+    def run(self) -> dict:
+        """
+        Stop all the submitted processes, blocks at most timeout plus _KILL_GRACE seconds
+        :return: summary of the stopping
+        """
+        start = time.time()
+        deadline = start + self.timeout
+        own_group = os.getpgrp()
+        groups = set()
+        living = 0
+        for job in self.jobs:
+            for process in job.processes:
+                if process.poll() is not None:
+                    continue
+                living += 1
+                if process.pid is None:
+                    continue
+                try:
+                    group = os.getpgid(process.pid)
+                except OSError:
+                    continue
+                if group != own_group:
+                    groups.add(group)
+        self.__signal_groups(groups, signal.SIGTERM)
+        # Processes out of the groups (relay, manager's group) are terminated one by one
+        termination = _TerminationSet()
+        for job in self.jobs:
+            termination.add(job, deadline)
+        while termination.jobs:
+            remaining = deadline + _KILL_GRACE - time.time()
+            if remaining <= 0:
+                # Not even killed, maybe stuck in uninterruptible sleep
+                break
+            for job in termination.step(remaining):
+                if job.callback is not None:
+                    try:
+                        job.callback()
+                    except Exception as ex:
+                        log.error("Error in callback of {}.".format(job.name), exc_info=ex)
+        # Children forked by goproxy are not watched, they are left in the groups
+        killed_groups = self.__signal_groups({g for g in groups if self.__has_members(g)}, signal.SIGKILL)
+        unstopped = sum(len(job.pending) for job in termination.jobs)
+        summary = {
+            "jobs": len(self.jobs),
+            "processes": living,
+            "process_groups": len(groups),
+            "terminated_processes": living - termination.killed_count - unstopped,
+            "killed_processes": termination.killed_count,
+            "killed_groups": killed_groups,
+            "unstopped_processes": unstopped,
+            "seconds": time.time() - start,
+        }
+        self.jobs = []
+        return summary
@@ -0,0 +1,217 @@
+"""
+Registry of the living tunnels
+"""
+import time
+from threading import Lock
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from util import events, metrics
+from util.events import EventLog
+from util.goproxy import MultiTunnel
+from util.index import TunnelIndex
+from util.lock import MutexLock
+
+
+_LOCK_WAIT = metrics.lock_wait_seconds.labels("registry_shard")
+_LOCK_HOLD = metrics.lock_hold_seconds.labels("registry_shard")
+
+
+class _Shard:
+    def __init__(self):
+        self.lock = Lock()
+        # Copy on write, never mutated after published
+        self.tunnels: Dict[int, MultiTunnel] = dict()
+        # Time of the last heartbeat event logged by tunnel id, mutated in lock
+        self.heartbeat_logged: Dict[int, float] = dict()
+
+
+class TunnelRegistry:
+    def __init__(self, shard_count: int = 16, heartbeat_event_interval: float = 1):
+        """
+        Tunnels striped by id into shards
+        Mutations lock only one shard and publish a new copy of it, readers never take a lock.
+        Every change is appended to the event log and applied to the indexes.
+        :param shard_count: count of shards
+        :param heartbeat_event_interval: heartbeat events of a tunnel are logged once in this period at most
+        """
+        self.__shards = [_Shard() for _ in range(shard_count)]
+        self.__id_lock = Lock()
+        self.__last_id = 0
+        self.events = EventLog()
+        self.heartbeat_event_interval = heartbeat_event_interval
+        self.index = TunnelIndex()
+
+    def __shard(self, tid: int) -> _Shard:
+        return self.__shards[tid % len(self.__shards)]
+
+    @property
+    def version(self) -> int:
+        """
+        Version of the latest change
+        :return:
+        """
+        return self.events.version
+
+    def new_id(self) -> int:
+        """
+        Generate a new tunnel id based on current time in millisecond
+        :return:
+        """
+        with MutexLock(self.__id_lock) as _:
+            current_tick = int(time.time() * 1000)
+            if self.__last_id < current_tick:
+                self.__last_id = current_tick
+            else:
+                self.__last_id += 1
+            return self.__last_id
+
+    def add(self, tid: int, tunnel: MultiTunnel):
+        shard = self.__shard(tid)
+        with MutexLock(shard.lock, _LOCK_WAIT, _LOCK_HOLD) as _:
+            tunnels = dict(shard.tunnels)
+            tunnels[tid] = tunnel
+            shard.tunnels = tunnels
+            # Logged and indexed in the shard lock to keep the order of changes of the same tunnel
+            self.events.append(events.CREATE, tid, tunnel.json)
+            self.index.add(tid, tunnel)
+        if tunnel.lease is not None:
+            tunnel.lease.members.add(tid)
+
+    def __by_shard(self, tids: Iterable[int]) -> Dict[int, List[int]]:
+        grouped = dict()
+        for tid in tids:
+            grouped.setdefault(tid % len(self.__shards), []).append(tid)
+        return grouped
+
+    def add_many(self, items: List[Tuple[int, MultiTunnel]]):
+        """
+        Add the tunnels with one lock acquisition and one copy per shard
+        :param items: (tid, tunnel)
+        :return:
+        """
+        tunnel_of = dict(items)
+        for index, tids in self.__by_shard(tunnel_of).items():
+            shard = self.__shards[index]
+            with MutexLock(shard.lock, _LOCK_WAIT, _LOCK_HOLD) as _:
+                tunnels = dict(shard.tunnels)
+                for tid in tids:
+                    tunnels[tid] = tunnel_of[tid]
+                shard.tunnels = tunnels
+                for tid in tids:
+                    self.events.append(events.CREATE, tid, tunnel_of[tid].json)
+                    self.index.add(tid, tunnel_of[tid])
+        for tid, tunnel in items:
+            if tunnel.lease is not None:
+                tunnel.lease.members.add(tid)
+
+    def pop(
+            self,
+            tid: int,
+            predicate: Callable[[MultiTunnel], bool] = None,
+            event_type: str = events.REMOVE
+    ) -> Optional[MultiTunnel]:
+        """
+        Remove the tunnel from registry
+        :param tid:
+        :param predicate: remove only if predicate(tunnel) is true, checked in the shard lock
+        :param event_type: type of the event logged, REMOVE or EXPIRE
+        :return: the removed tunnel, None if not found or not matched
+        """
+        shard = self.__shard(tid)
+        with MutexLock(shard.lock, _LOCK_WAIT, _LOCK_HOLD) as _:
+            tunnel = shard.tunnels.get(tid)
+            if tunnel is None or (predicate is not None and not predicate(tunnel)):
+                return None
+            tunnels = dict(shard.tunnels)
+            del tunnels[tid]
+            shard.tunnels = tunnels
+            self.events.append(event_type, tid)
+            self.index.remove(tid)
+            shard.heartbeat_logged.pop(tid, None)
+        if tunnel.lease is not None:
+            tunnel.lease.members.discard(tid)
+        return tunnel
+
+    def pop_many(self, tids: Iterable[int], event_type: str = events.REMOVE) -> Dict[int, MultiTunnel]:
+        """
+        Remove the tunnels with one lock acquisition and one copy per shard
+        :param tids:
+        :param event_type: type of the events logged, REMOVE or EXPIRE
+        :return: the removed tunnels by id, the ones not found are absent
+        """
+        removed = dict()
+        for index, shard_tids in self.__by_shard(set(tids)).items():
+            shard = self.__shards[index]
+            with MutexLock(shard.lock, _LOCK_WAIT, _LOCK_HOLD) as _:
+                tunnels = dict(shard.tunnels)
+                for tid in shard_tids:
+                    tunnel = tunnels.pop(tid, None)
+                    if tunnel is not None:
+                        removed[tid] = tunnel
+                        self.events.append(event_type, tid)
+                        self.index.remove(tid)
+                        shard.heartbeat_logged.pop(tid, None)
+                shard.tunnels = tunnels
+        for tid, tunnel in removed.items():
+            if tunnel.lease is not None:
+                tunnel.lease.members.discard(tid)
+        return removed
+
+    def get(self, tid: int) -> Optional[MultiTunnel]:
+        return self.__shard(tid).tunnels.get(tid)
+
+    def heartbeat(self, tid: int) -> bool:
+        """
+        Reset last check time of the tunnel without locking
+        The shard lock is taken only to log the heartbeat event, once per heartbeat_event_interval of a tunnel.
+        :param tid:
+        :return: False if tunnel not found
+        """
+        shard = self.__shard(tid)
+        tunnel = shard.tunnels.get(tid)
+        if tunnel is None:
+            return False
+        tunnel.check()
+        check_time = tunnel.last_check_time
+        if check_time - shard.heartbeat_logged.get(tid, 0) >= self.heartbeat_event_interval:
+            with MutexLock(shard.lock, _LOCK_WAIT, _LOCK_HOLD) as _:
+                # Checked again, logged by another heartbeat or removed meanwhile
+                if tid in shard.tunnels and \
+                        check_time - shard.heartbeat_logged.get(tid, 0) >= self.heartbeat_event_interval:
+                    shard.heartbeat_logged[tid] = check_time
+                    self.events.append(events.HEARTBEAT, tid, {"last_check_time": check_time})
+        return True
+
+    def __contains__(self, tid: int) -> bool:
+        return tid in self.__shard(tid).tunnels
+
+    def __len__(self) -> int:
+        return sum(len(shard.tunnels) for shard in self.__shards)
+
+    def items(self) -> List[Tuple[int, MultiTunnel]]:
+        """
+        A snapshot of all the tunnels sorted by id
+        :return:
+        """
+        return sorted(
+            (item for shard in self.__shards for item in shard.tunnels.items()),
+            key=lambda item: item[0]
+        )
+
+    def __iter__(self) -> Iterator[int]:
+        return iter([tid for tid, _ in self.items()])
+
+    def find(self, **conditions) -> Tuple[List[Tuple[int, MultiTunnel]], bool]:
+        """
+        Tunnels matching the conditions by indexes, see `TunnelIndex.find`
+        :param conditions:
+        :return: ((tid, tunnel) in order of id, more)
+        """
+        ids, more = self.index.find(self, **conditions)
+        found = []
+        for tid in ids:
+            tunnel = self.get(tid)
+            if tunnel is not None:
+                # Removed after found
+                found.append((tid, tunnel))
+        return found, more
@@ -0,0 +1,377 @@
+"""
+Experimental in-process relay backend, bridges and reverse servers of all the tunnels run on one asyncio loop
+It's not compatible with goproxy client, every agent has to be replaced by the relay agent started by
+`python -m util.relay -P <bridge host>:<bridge port> -C <crt> -K <key> [--k <key>]`
+
+Protocol over TLS, both sides present the same certificate like goproxy:
+- agent opens a control connection to bridge and sends `CONTROL <key>\\n`
+- for each connection accepted by server, bridge sends `CONNECT <token> <innet port>\\n` on the control connection,
+  token is random and only valid for this connection
+- agent connects to the innet port, opens a data connection to bridge and sends `DATA <key> <token>\\n`,
+  then bytes are relayed
+"""
+import abc
+import argparse
+import asyncio
+import logging
+import secrets
+import signal
+import ssl
+import subprocess
+from threading import Event, Thread
+from typing import Dict, Optional, Set, Tuple
+
+from util.backend import TunnelBackend
+
+log = logging.getLogger(__file__)
+
+DEFAULT_KEY = "default"
+_HANDSHAKE_TIMEOUT = 10
+
+
+async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, buffer_size: int):
+    # Copied in user space: one end of every relayed pair is TLS (data connection to bridge), so neither splice(2)
+    # nor loop.sock_sendfile (file to socket only) can move the bytes, Python ssl has no kernel TLS offload.
+    try:
+        while True:
+            data = await reader.read(buffer_size)
+            if not data:
+                break
+            writer.write(data)
+            # Stop reading till the peer takes the buffered data
+            await writer.drain()
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        try:
+            if writer.can_write_eof():
+                writer.write_eof()
+            else:
+                writer.close()
+        except (ConnectionError, OSError, RuntimeError):
+            pass
+
+
+async def _join(
+        a: Tuple[asyncio.StreamReader, asyncio.StreamWriter],
+        b: Tuple[asyncio.StreamReader, asyncio.StreamWriter],
+        buffer_size: int
+):
+    """
+    Relay two connections till both directions closed
+    Buffers are bounded: the reader limit and the write buffer high water mark are buffer_size.
+    :param a:
+    :param b:
+    :param buffer_size:
+    :return:
+    """
+    for _, writer in (a, b):
+        writer.transport.set_write_buffer_limits(high=buffer_size)
+    await asyncio.gather(_pipe(a[0], b[1], buffer_size), _pipe(b[0], a[1], buffer_size))
+    a[1].close()
+    b[1].close()
+
+
+class RelayEngine(Thread):
+    def __init__(self, certfile: str, keyfile: str, buffer_size: int = 65536):
+        """
+        The event loop running all the relay bridges and servers
+        :param certfile: certificate of bridge, agents have to present the same one
+        :param keyfile:
+        :param buffer_size: max bytes buffered per connection direction
+        """
+        super(RelayEngine, self).__init__()
+        self.daemon = True
+        self.buffer_size = buffer_size
+        self.loop = asyncio.new_event_loop()
+        self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH, cafile=certfile)
+        self.ssl_context.load_cert_chain(certfile, keyfile)
+        self.ssl_context.verify_mode = ssl.CERT_REQUIRED
+        self.bridges: Dict[int, "_RelayBridge"] = dict()
+
+    def run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run_coroutine(self, coroutine, timeout: float = _HANDSHAKE_TIMEOUT):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class RelayProcess(abc.ABC):
+    def __init__(self, engine: RelayEngine, args: list):
+        """
+        A bridge or server running on relay engine, works like Popen
+        :param engine:
+        :param args: description like command line
+        """
+        self.engine = engine
+        self.pid = None
+        self.args = args
+        self.returncode = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.writers: Set[asyncio.StreamWriter] = set()
+        self.__exited = Event()
+
+    async def listen(self, port: int, ssl_context: ssl.SSLContext = None):
+        self.server = await asyncio.start_server(
+            self.handle, port=port, ssl=ssl_context, reuse_address=True, limit=self.engine.buffer_size
+        )
+
+    @abc.abstractmethod
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Serve a connection accepted by listener
+        :param reader:
+        :param writer:
+        :return:
+        """
+
+    def _exit(self, returncode: int):
+        """
+        Close the listener and all the connections, run in loop
+        :param returncode:
+        :return:
+        """
+        if self.returncode is not None:
+            return
+        if self.server is not None:
+            self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        self.writers.clear()
+        self.returncode = returncode
+        self.__exited.set()
+
+    def poll(self) -> Optional[int]:
+        return self.returncode
+
+    def wait(self, timeout: float = None) -> int:
+        if not self.__exited.wait(timeout):
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        return self.returncode
+
+    def send_signal(self, sig: int):
+        if self.returncode is not None:
+            return
+        if self.engine.loop.is_running():
+            self.engine.loop.call_soon_threadsafe(self._exit, -sig)
+        else:
+            self._exit(-sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class _RelayBridge(RelayProcess):
+    def __init__(self, engine: RelayEngine, port: int):
+        super(_RelayBridge, self).__init__(engine, ["relay", "bridge", ":{}".format(port)])
+        self.port = port
+        self.controls: Dict[str, asyncio.StreamWriter] = dict()
+        # token -> (key, future of data connection)
+        self.pending: Dict[str, Tuple[str, asyncio.Future]] = dict()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.writers.add(writer)
+        try:
+            command = (await asyncio.wait_for(reader.readline(), _HANDSHAKE_TIMEOUT)).decode().split()
+        except (asyncio.TimeoutError, ConnectionError, OSError, UnicodeDecodeError):
+            command = []
+        if len(command) == 3 and command[0] == "DATA":
+            key, future = self.pending.get(command[2], (None, None))
+            # Token is only taken by the agent it was sent to
+            if future is not None and key == command[1] and not future.done():
+                del self.pending[command[2]]
+                # Owned by server from now on
+                future.set_result((reader, writer))
+                return
+            log.warning("Unknown data connection to bridge {} dropped.".format(self.port))
+        elif len(command) == 2 and command[0] == "CONTROL":
+            key = command[1]
+            previous = self.controls.get(key)
+            if previous is not None:
+                previous.close()
+            self.controls[key] = writer
+            try:
+                while await reader.readline():
+                    pass
+            except (ConnectionError, OSError):
+                pass
+            if self.controls.get(key) is writer:
+                del self.controls[key]
+        self.writers.discard(writer)
+        writer.close()
+
+    async def open(self, key: str, innet_port: int) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """
+        Ask the agent to connect innet port and open a data connection
+        :param key:
+        :param innet_port:
+        :return:
+        """
+        control = self.controls.get(key)
+        if control is None:
+            raise ConnectionError("Agent of key {} not connected to bridge {}".format(key, self.port))
+        token = secrets.token_urlsafe(16)
+        future = self.engine.loop.create_future()
+        self.pending[token] = (key, future)
+        try:
+            control.write("CONNECT {} {}\n".format(token, innet_port).encode())
+            return await asyncio.wait_for(future, _HANDSHAKE_TIMEOUT)
+        finally:
+            self.pending.pop(token, None)
+
+    def _exit(self, returncode: int):
+        super(_RelayBridge, self)._exit(returncode)
+        if self.engine.bridges.get(self.port) is self:
+            del self.engine.bridges[self.port]
+
+
+class _RelayServer(RelayProcess):
+    def __init__(self, engine: RelayEngine, bridge_port: int, expose_port: int, innet_port: int, key: str):
+        super(_RelayServer, self).__init__(
+            engine, ["relay", "server", ":{}".format(bridge_port), ":{}@:{}".format(expose_port, innet_port), key]
+        )
+        self.bridge_port = bridge_port
+        self.innet_port = innet_port
+        self.key = key
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.writers.add(writer)
+        try:
+            bridge = self.engine.bridges.get(self.bridge_port)
+            if bridge is None:
+                raise ConnectionError("Bridge at port {} is not running".format(self.bridge_port))
+            agent = await bridge.open(self.key, self.innet_port)
+            try:
+                await _join((reader, writer), agent, self.engine.buffer_size)
+            finally:
+                bridge.writers.discard(agent[1])
+                agent[1].close()
+        except (asyncio.TimeoutError, ConnectionError, OSError) as ex:
+            # Agent offline or port probing, not an error of manager
+            log.info("Relay to innet port {} failed: {}".format(self.innet_port, ex))
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+
+class RelayBackend(TunnelBackend):
+    """
+    Run bridge and server on a relay engine in manager process
+    """
+    name = "relay"
+
+    def __init__(self, engine: RelayEngine):
+        self.engine = engine
+        if not engine.is_alive():
+            engine.start()
+
+    def start_bridge(self, bridge_port: int, group: int = None) -> RelayProcess:
+        bridge = _RelayBridge(self.engine, bridge_port)
+
+        async def start():
+            await bridge.listen(bridge_port, self.engine.ssl_context)
+            self.engine.bridges[bridge_port] = bridge
+
+        self.engine.run_coroutine(start())
+        return bridge
+
+    def start_server(
+            self, bridge_port: int, expose_port: int, innet_port: int, key: str = None, group: int = None
+    ) -> RelayProcess:
+        server = _RelayServer(self.engine, bridge_port, expose_port, innet_port, key or DEFAULT_KEY)
+        self.engine.run_coroutine(server.listen(expose_port))
+        return server
+
+
+async def _agent_connect(
+        bridge: Tuple[str, int],
+        context: ssl.SSLContext,
+        key: str,
+        token: str,
+        innet: Tuple[str, int],
+        buffer_size: int
+):
+    data = await asyncio.open_connection(bridge[0], bridge[1], ssl=context, limit=buffer_size)
+    data[1].write("DATA {} {}\n".format(key, token).encode())
+    try:
+        target = await asyncio.open_connection(innet[0], innet[1], limit=buffer_size)
+    except OSError as ex:
+        log.warning("Can't connect innet port {}: {}".format(innet[1], ex))
+        data[1].close()
+        return
+    await _join(data, target, buffer_size)
+
+
+async def run_agent(
+        bridge_host: str,
+        bridge_port: int,
+        certfile: str,
+        keyfile: str,
+        key: str = DEFAULT_KEY,
+        innet_host: str = "127.0.0.1",
+        retry_interval: float = 3,
+        buffer_size: int = 65536
+):
+    """
+    Agent of relay backend, keep connected to bridge and serve the connections to innet ports
+    :param bridge_host:
+    :param bridge_port:
+    :param certfile: same certificate as bridge
+    :param keyfile:
+    :param key: client key of the tunnel
+    :param innet_host: host of innet ports
+    :param retry_interval: seconds before reconnecting bridge
+    :param buffer_size: max bytes buffered per connection direction
+    :return:
+    """
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=certfile)
+    context.load_cert_chain(certfile, keyfile)
+    # Verified by the certificate itself instead of host name
+    context.check_hostname = False
+    # Event loop keeps weak references of tasks only
+    connecting = set()
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(bridge_host, bridge_port, ssl=context)
+            writer.write("CONTROL {}\n".format(key).encode())
+            log.info("Connected to bridge {}:{}.".format(bridge_host, bridge_port))
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode().split()
+                if len(command) == 3 and command[0] == "CONNECT" and command[2].isdigit():
+                    task = asyncio.ensure_future(_agent_connect(
+                        (bridge_host, bridge_port), context, key, command[1],
+                        (innet_host, int(command[2])), buffer_size
+                    ))
+                    connecting.add(task)
+                    task.add_done_callback(connecting.discard)
+            writer.close()
+        except (ConnectionError, OSError) as ex:
+            log.warning("Bridge {}:{} unavailable: {}".format(bridge_host, bridge_port, ex))
+        await asyncio.sleep(retry_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Agent of relay backend")
+    parser.add_argument("-P", dest="bridge", required=True, help="bridge address, like example.com:20000")
+    parser.add_argument("-C", dest="certfile", required=True, help="certificate file")
+    parser.add_argument("-K", dest="keyfile", required=True, help="key file of certificate")
+    parser.add_argument("--k", dest="key", default=DEFAULT_KEY, help="client key of the tunnel")
+    parser.add_argument("--innet-host", default="127.0.0.1", help="host of the innet ports")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    host, port = args.bridge.rsplit(":", 1)
+    asyncio.run(run_agent(host, int(port), args.certfile, args.keyfile, args.key, args.innet_host))
+
+
+if __name__ == '__main__':
+    main()
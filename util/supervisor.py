@@ -0,0 +1,193 @@
+"""
+Supervise the goproxy processes of tunnels, restart the crashed ones
+"""
+import heapq
+import itertools
+import logging
+import os
+import selectors
+import time
+from collections import deque
+from threading import Lock, Thread
+from typing import Dict, List, Tuple, TYPE_CHECKING
+
+from util import metrics
+from util.lock import MutexLock
+from util.reaper import _open_pidfd
+
+if TYPE_CHECKING:
+    from util.goproxy import MultiTunnel
+
+log = logging.getLogger(__file__)
+
+# States of tunnel
+STARTING = "starting"
+RUNNING = "running"
+# Some of the exposes are still forwarding
+DEGRADED = "degraded"
+RESTARTING = "restarting"
+# Restart budget used up
+FAILED = "failed"
+
+
+class ProcessSupervisor(Thread):
+    def __init__(
+            self,
+            backoff_base: float = 1,
+            backoff_max: float = 60,
+            restart_budget: int = 5,
+            budget_window: float = 600,
+            poll_interval: float = 1
+    ):
+        """
+        Watch the exits of tunnel processes by pidfd and restart them with exponential backoff
+        Processes stopped by manager (removed tunnels, idle lazy tunnels) are not in the tunnel any more, ignored.
+        :param backoff_base: seconds before the first restart, doubled by each restart in budget window
+        :param backoff_max: max seconds before restart
+        :param restart_budget: restarts allowed in budget window, tunnel failed if exceeded
+        :param budget_window: seconds
+        :param poll_interval: polling interval of the processes without pidfd
+        """
+        super(ProcessSupervisor, self).__init__()
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.restart_budget = restart_budget
+        self.budget_window = budget_window
+        self.poll_interval = poll_interval
+        self.is_stop = False
+        self.daemon = True
+        self.restart_count = 0
+        self.failed_count = 0
+        self.__selector = selectors.DefaultSelector()
+        self.__unwatched = set()
+        self.__watched: Dict[int, Tuple["MultiTunnel", object]] = dict()
+        # (due time, seq, tunnel)
+        self.__schedule: List[Tuple[float, int, "MultiTunnel"]] = []
+        self.__scheduled = set()
+        self.__counter = itertools.count()
+        self.__queue = deque()
+        self.__queue_lock = Lock()
+        self.__wake_r, self.__wake_w = os.pipe()
+        os.set_blocking(self.__wake_r, False)
+        os.set_blocking(self.__wake_w, False)
+        self.__selector.register(self.__wake_r, selectors.EVENT_READ, None)
+
+    def watch(self, tunnel: "MultiTunnel", process):
+        """
+        Watch a process of tunnel, the same process is watched once only
+        :param tunnel:
+        :param process: Popen or the objects work like Popen
+        :return:
+        """
+        with MutexLock(self.__queue_lock) as _:
+            self.__queue.append((tunnel, process))
+        try:
+            os.write(self.__wake_w, b"\0")
+        except BlockingIOError:
+            # Already woken up
+            pass
+
+    def __register(self, tunnel: "MultiTunnel", process):
+        if id(process) in self.__watched:
+            return
+        self.__watched[id(process)] = (tunnel, process)
+        pidfd = _open_pidfd(process.pid)
+        if pidfd is None:
+            self.__unwatched.add(id(process))
+        else:
+            self.__selector.register(pidfd, selectors.EVENT_READ, id(process))
+
+    def __exited(self, key: int):
+        tunnel, process = self.__watched.pop(key)
+        process.poll()
+        if tunnel.stopped or not tunnel.owns(process):
+            # Stopped by manager
+            return
+        tunnel.exits.append({
+            "pid": process.pid,
+            "args": [str(arg) for arg in process.args],
+            "returncode": process.returncode,
+            "time": time.time(),
+        })
+        log.warning("PID {} ({}) exited with code {}.".format(process.pid, process.args[1], process.returncode))
+        metrics.process_exits.labels(process.args[1]).inc()
+        if tunnel in self.__scheduled:
+            return
+        now = time.time()
+        while tunnel.restart_times and tunnel.restart_times[0] < now - self.budget_window:
+            tunnel.restart_times.popleft()
+        if len(tunnel.restart_times) >= self.restart_budget:
+            tunnel.state = FAILED
+            self.failed_count += 1
+            log.error("Tunnel at bridge port {} restarted {} times in {} seconds, given up.".format(
+                tunnel.bridge_port, len(tunnel.restart_times), self.budget_window
+            ))
+            return
+        delay = min(self.backoff_base * (2 ** len(tunnel.restart_times)), self.backoff_max)
+        tunnel.state = DEGRADED if tunnel.forwarding else RESTARTING
+        heapq.heappush(self.__schedule, (now + delay, next(self.__counter), tunnel))
+        self.__scheduled.add(tunnel)
+
+    def __restart_due(self):
+        now = time.time()
+        while self.__schedule and self.__schedule[0][0] <= now:
+            _, _, tunnel = heapq.heappop(self.__schedule)
+            self.__scheduled.discard(tunnel)
+            tunnel.restart_times.append(now)
+            try:
+                if tunnel.restart():
+                    self.restart_count += 1
+                    tunnel.restart_count += 1
+                    metrics.process_restarts.inc()
+            except Exception as ex:
+                log.error("Error while restarting tunnel at bridge port {}.".format(tunnel.bridge_port), exc_info=ex)
+                # Counted in budget, try again later
+                self.__scheduled.add(tunnel)
+                heapq.heappush(self.__schedule, (
+                    now + min(self.backoff_base * (2 ** len(tunnel.restart_times)), self.backoff_max),
+                    next(self.__counter),
+                    tunnel
+                ))
+
+    def run(self) -> None:
+        while not self.is_stop:
+            timeout = None
+            if self.__schedule:
+                timeout = max(self.__schedule[0][0] - time.time(), 0)
+            if self.__unwatched:
+                timeout = self.poll_interval if timeout is None else min(timeout, self.poll_interval)
+            for key, _ in self.__selector.select(timeout):
+                if key.data is None:
+                    try:
+                        os.read(self.__wake_r, 4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                self.__selector.unregister(key.fileobj)
+                os.close(key.fileobj)
+                self.__exited(key.data)
+            for key in list(self.__unwatched):
+                if self.__watched[key][1].poll() is not None:
+                    self.__unwatched.discard(key)
+                    self.__exited(key)
+            with MutexLock(self.__queue_lock) as _:
+                queued, self.__queue = self.__queue, deque()
+            for tunnel, process in queued:
+                self.__register(tunnel, process)
+            self.__restart_due()
+
+    def stop(self):
+        self.is_stop = True
+        try:
+            os.write(self.__wake_w, b"\0")
+        except BlockingIOError:
+            pass
+
+    @property
+    def json(self):
+        return {
+            "watched_processes": len(self.__watched),
+            "scheduled_restarts": len(self.__schedule),
+            "restarts": self.restart_count,
+            "failed_tunnels": self.failed_count,
+        }
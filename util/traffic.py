@@ -0,0 +1,136 @@
+"""
+Traffic accounting of tunnels from /proc, out of the data path
+"""
+import logging
+import time
+from collections import Counter
+from threading import Event, Thread
+from typing import Dict, Iterator, Optional, Tuple, TYPE_CHECKING
+
+from util.procfs import read_io
+
+if TYPE_CHECKING:
+    from util.registry import TunnelRegistry
+
+log = logging.getLogger(__file__)
+
+_TCP_ESTABLISHED = "01"
+
+
+def read_tcp_connections() -> Iterator[Tuple[str, int, str, int]]:
+    """
+    Established TCP connections of this host from /proc/net/tcp and /proc/net/tcp6
+    :return: (local address, local port, remote address, remote port), addresses in hex as they are in /proc
+    """
+    for path in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(path, "r") as fp:
+                lines = fp.readlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split(None, 4)
+            if fields[3] != _TCP_ESTABLISHED:
+                continue
+            local_address, local_port = fields[1].split(":")
+            remote_address, remote_port = fields[2].split(":")
+            yield local_address, int(local_port, 16), remote_address, int(remote_port, 16)
+
+
+def count_connections() -> Tuple[Dict[int, int], Dict[int, int]]:
+    """
+    Count the established connections by local port
+    :return: (all connections, connections from other hosts)
+    """
+    connections = list(read_tcp_connections())
+    local_endpoints = {(address, port) for address, port, _, _ in connections}
+    count_all = Counter()
+    count_remote = Counter()
+    for local_address, local_port, remote_address, remote_port in connections:
+        count_all[local_port] += 1
+        # Both ends of a connection inside this host are in the table
+        if (remote_address, remote_port) not in local_endpoints:
+            count_remote[local_port] += 1
+    return count_all, count_remote
+
+
+class TrafficSampler(Thread):
+    def __init__(self, tunnels: "TunnelRegistry", interval: float = 10):
+        """
+        Attribute connections and bytes to tunnels periodically, the result is set to `tunnel.traffic`
+        Tunnels in traffic liveness mode are checked if any connection observed on their expose ports, the agent
+        keeps its bridge connection open even when idle, so bridge connections are reported only.
+        /proc is parsed once per interval for all the tunnels: connections are attributed by the local port,
+        expose ports and dedicated bridge ports belong to only one tunnel;
+        bytes are the I/O of the goproxy processes of tunnel from /proc/<pid>/io.
+        :param tunnels: tunnels registry
+        :param interval: seconds between two samples
+        """
+        super(TrafficSampler, self).__init__()
+        self.tunnels = tunnels
+        self.interval = interval
+        self.daemon = True
+        self.sample_time: Optional[float] = None
+        self.__remote_connections: Dict[int, int] = dict()
+        self.__stop_event = Event()
+        # tid -> (sample time, read bytes, write bytes)
+        self.__last: Dict[int, Tuple[float, int, int]] = dict()
+
+    def sample(self):
+        now = time.time()
+        count_all, count_remote = count_connections()
+        last, self.__last = self.__last, dict()
+        for tid, tunnel in self.tunnels.items():
+            read_bytes = write_bytes = 0
+            for process in tunnel.processes:
+                io = read_io(process.pid)
+                if io is not None:
+                    read_bytes += io[0]
+                    write_bytes += io[1]
+            read_rate = write_rate = None
+            if tid in last:
+                last_time, last_read, last_write = last[tid]
+                # Restarted processes count from 0 again
+                read_rate = max(read_bytes - last_read, 0) / (now - last_time)
+                write_rate = max(write_bytes - last_write, 0) / (now - last_time)
+            self.__last[tid] = (now, read_bytes, write_bytes)
+            bridge_connections = count_remote[tunnel.bridge_port] if tunnel.shared_bridge is None else None
+            expose_connections = {
+                str(expose.expose_port): count_all[expose.expose_port] for expose in tunnel.exposes
+            }
+            # Bytes are not counted, goproxy keeps talking between server and bridge without any client
+            active = any(count > 0 for count in expose_connections.values())
+            if active and tunnel.traffic_liveness:
+                self.tunnels.heartbeat(tid)
+            tunnel.traffic = {
+                "active": active,
+                "bridge_connections": bridge_connections,
+                "expose_connections": expose_connections,
+                "read_bytes": read_bytes,
+                "write_bytes": write_bytes,
+                "read_rate": read_rate,
+                "write_rate": write_rate,
+                "sample_time": now,
+            }
+        self.__remote_connections = count_remote
+        self.sample_time = now
+
+    def remote_connections(self, port: int) -> int:
+        """
+        Connections from other hosts to the local port in the last sample
+        :param port:
+        :return:
+        """
+        return self.__remote_connections.get(port, 0)
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.sample()
+            except Exception as ex:
+                log.error("Error while sampling traffic.", exc_info=ex)
+            if self.__stop_event.wait(self.interval):
+                break
+
+    def stop(self):
+        self.__stop_event.set()